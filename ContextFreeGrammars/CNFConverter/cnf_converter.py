@@ -1,23 +1,51 @@
 #! /usr/bin/env python3
 
-import sys
+import io
+import argparse
 import nltk
+from collections import deque
+from decimal import Decimal
 from unittest import TestCase
 
 
 class CNFConverter:
     """
-    This class converts a given Context Free Grammar into Chomsky Normal Form
+    This class converts a given Context Free Grammar into Chomsky Normal Form, keeping the probability of the strings
+    each non-terminal derives if the grammar is a PCFG
     """
 
-    def __init__(self):
+    def __init__(self, share_dummies=True):
+        """
+        Initialize the converter
+        :param share_dummies: whether long productions that start with the same symbols share the dummy non-terminals
+        covering them
+        """
 
         # a count of how many dummy non-terminals have been created to ensure they're unique
         self.dummy_count = 0
 
+        # the dummy non-terminal covering each sequence of symbols, if dummies are shared
+        self.dummies = {} if share_dummies else None
+
         # a dictionary containing the new productions in the CNF format
         self.cnf_grammar = {}
 
+        # the CNF right-hand side each non-unit production was converted to, so each is only converted once
+        self.conversions = {}
+
+        # the CNF right-hand sides of the non-unit productions of each non-terminal, with their probabilities
+        self.expansions = {}
+
+        # the non-terminal created for each terminal in hybrid productions
+        self.terminal_nonterminals = {}
+
+        # the names of the grammar's non-terminals and of the ones created, so new names never collide with them
+        self.symbols = set()
+
+        # whether the grammar being converted is a PCFG, and the probability of each new (lhs, rhs) if it is
+        self.weighted = False
+        self.probabilities = {}
+
     @staticmethod
     def is_hybrid(rhs):
         """
@@ -34,7 +62,7 @@ class CNFConverter:
         :param rhs: the right-hand side
         :return: bool
         """
-        return len(rhs) is 1 and nltk.grammar.is_nonterminal(rhs[0])
+        return len(rhs) == 1 and nltk.grammar.is_nonterminal(rhs[0])
 
     @staticmethod
     def is_long(rhs):
@@ -52,7 +80,7 @@ class CNFConverter:
         :param rhs: the right-hand side
         :return: bool
         """
-        return (len(rhs) is 2 and all(nltk.grammar.is_nonterminal(x) for x in rhs)) or (len(rhs) is 1 and nltk.grammar.is_terminal(rhs[0]))
+        return (len(rhs) == 2 and all(nltk.grammar.is_nonterminal(x) for x in rhs)) or (len(rhs) == 1 and nltk.grammar.is_terminal(rhs[0]))
 
     @staticmethod
     def production_string(rhs):
@@ -63,91 +91,269 @@ class CNFConverter:
         """
         return " ".join([x.symbol() if nltk.grammar.is_nonterminal(x) else '"{0}"'.format(x) for x in rhs])
 
-    def add_production(self, lhs, rhs):
+    @staticmethod
+    def probability_string(prob):
+        """
+        Returns the given probability in NLTK's PCFG format, which doesn't allow exponents
+        :param prob: the probability
+        :return: str
+        """
+        return format(Decimal(repr(prob)), "f")
+
+    def probability(self, production):
+        """
+        The probability of the given production if the grammar is weighted
+        :param production: the production
+        :return: the probability, or None if the grammar is not weighted
+        """
+        return production.prob() if self.weighted else None
+
+    def add_production(self, lhs, rhs, prob=None):
         """
-        Add the given production into the dictionary of CNF rules
+        Add the given production into the dictionary of CNF rules, adding its probability to any production with the
+        same left and right-hand sides if the grammar is weighted
         :param lhs: the left-hand side of the new production
         :param rhs: the right-hand side of the new production
+        :param prob: the probability of the new production, or None if the grammar is not weighted
         :return: void
         """
-        self.cnf_grammar.setdefault(lhs, []).append(rhs)
+        if prob is None:
+            self.cnf_grammar.setdefault(lhs, []).append(rhs)
+        elif (lhs, rhs) in self.probabilities:
+            self.probabilities[(lhs, rhs)] += prob
+        else:
+            self.cnf_grammar.setdefault(lhs, []).append(rhs)
+            self.probabilities[(lhs, rhs)] = prob
+
+    def new_nonterminal(self, name):
+        """
+        Name a new non-terminal, adding a number to the given name if the grammar or an earlier new non-terminal has it
+        :param name: the name to use if it's free
+        :return: the name of the new non-terminal
+        """
+        new_name = name
+        suffix = 0
+        while new_name in self.symbols:
+            suffix += 1
+            new_name = name + "_" + str(suffix)
+
+        self.symbols.add(new_name)
+        return new_name
 
-    def convert_hybrid_productions(self, production):
+    def convert_hybrid_productions(self, rhs):
         """
-        Convert a hybrid production into valid CNF by creating new non-terminals for any terminals in the production
-        :param production: a hybrid production
-        :return:
+        Convert a hybrid right-hand side by creating new non-terminals for any terminals in it
+        :param rhs: a hybrid right-hand side
+        :return: the right-hand side with each terminal replaced by its new non-terminal
         """
-        terminal_list = []
         new_rhs = []
 
-        for node in production.rhs():
+        for node in rhs:
             if nltk.grammar.is_nonterminal(node):
                 new_rhs.append(node)
             else:
-                terminal_list.append(node)
-                # replace each terminal with a new non-terminal
-                new_rhs.append(nltk.Nonterminal(node.upper()))
-
-        if self.is_long(new_rhs):
-            self.convert_long_productions(production.lhs().symbol(), new_rhs)
-        else:
-            self.add_production(production.lhs().symbol(), self.production_string(new_rhs))
+                # replace each terminal with a new non-terminal, which always derives it
+                if node not in self.terminal_nonterminals:
+                    self.terminal_nonterminals[node] = self.new_nonterminal(node.upper())
+                    self.add_production(self.terminal_nonterminals[node], self.production_string([node]),
+                                        1.0 if self.weighted else None)
+                new_rhs.append(nltk.Nonterminal(self.terminal_nonterminals[node]))
 
-        # add new productions for each new non-terminal created
-        for string in terminal_list:
-            self.add_production(string.upper(), self.production_string([string]))
+        return new_rhs
 
-    def convert_unit_productions(self, grammar, lhs, rhs):
+    def convert_long_productions(self, rhs):
         """
-        Convert a unit production into valid CNF by re-writing the right-hand side with the right-hand side of all derivable, non-unit productions
-        :param grammar: the CFG grammar
-        :param lhs: the left-hand side
+        Convert a long right-hand side by introducing non-terminals for all but its last symbol and spreading it over
+        productions, reusing the non-terminal for any sequence of symbols that already has one
         :param rhs: the right-hand side
-        :return: void
+        :return: the right-hand side of two non-terminals that replaces it
+        """
+        if len(rhs) == 2:
+            return self.production_string(rhs)
+
+        prefix = tuple(x.symbol() for x in rhs[:-1])
+        if self.dummies is not None and prefix in self.dummies:
+            return self.dummies[prefix] + " " + rhs[-1].symbol()
+
+        self.dummy_count += 1
+        dummy_nonterminal = self.new_nonterminal("X" + str(self.dummy_count))
+        if self.dummies is not None:
+            self.dummies[prefix] = dummy_nonterminal
+
+        self.add_production(dummy_nonterminal, self.convert_long_productions(rhs[:-1]), 1.0 if self.weighted else None)
+        return dummy_nonterminal + " " + rhs[-1].symbol()
+
+    def convert_production(self, production):
+        """
+        Convert a non-unit production into valid CNF the first time it is seen, adding any new productions it needs
+        :param production: a non-unit production
+        :return: the CNF right-hand side for the production's left-hand side, or None if it has none
         """
-        next_rules = grammar.productions(lhs=rhs)
-        for next_rule in next_rules:
-            if self.is_unit(next_rule.rhs()):
-                self.convert_unit_productions(grammar, lhs, next_rule.rhs()[0])
-            elif self.is_long(next_rule.rhs()):
-                self.convert_long_productions(lhs, list(next_rule.rhs()))
+        if production not in self.conversions:
+            rhs = list(production.rhs())
+            # terminals in any production longer than one symbol need non-terminals of their own
+            if len(rhs) > 1 and any(nltk.grammar.is_terminal(x) for x in rhs):
+                rhs = self.convert_hybrid_productions(rhs)
+
+            if self.is_long(rhs):
+                self.conversions[production] = self.convert_long_productions(rhs)
+            elif self.is_cnf(rhs):
+                self.conversions[production] = self.production_string(rhs)
             else:
-                self.add_production(lhs, self.production_string(next_rule.rhs()))
+                self.conversions[production] = None
+
+        return self.conversions[production]
+
+    def expand(self, grammar, symbol):
+        """
+        Find the CNF right-hand sides of all the non-unit productions of the given non-terminal, the first time it is seen
+        :param grammar: the CFG grammar
+        :param symbol: the non-terminal
+        :return: list of (right-hand side, probability or None)
+        """
+        if symbol not in self.expansions:
+            conversions = [(self.convert_production(rule), self.probability(rule))
+                           for rule in grammar.productions(lhs=symbol) if not self.is_unit(rule.rhs())]
+            self.expansions[symbol] = [(rhs, prob) for rhs, prob in conversions if rhs is not None]
+        return self.expansions[symbol]
 
-    def convert_long_productions(self, lhs, rhs):
+    @staticmethod
+    def unit_weights(unit_rules, lhs, tolerance=1e-15, max_weight=1e4):
         """
-        Convert a long production into valid CNF by introducing unique non-terminals and spreading them over productions
+        Sum the probabilities of every chain of unit productions from the given non-terminal to each non-terminal it
+        derives, pushing probability along the unit productions from a worklist until what is left to push through a
+        cycle is below the tolerance
+        :param unit_rules: dictionary mapping each non-terminal to a list of (rhs, prob) for its unit productions
         :param lhs: the left-hand side
-        :param rhs: the right-hand side
+        :param tolerance: the smallest probability pushed to a non-terminal that has already been reached
+        :param max_weight: the largest total probability allowed before the unit productions are taken to cycle forever
+        :return: list of (non-terminal, total probability), counting the lhs only for the chains that cycle back to it
+        """
+        weights = {}
+        residual = {lhs: 1.0}
+        worklist = deque([lhs])
+        while worklist:
+            symbol = worklist.popleft()
+            mass = residual.pop(symbol)
+            weights[symbol] = weights.get(symbol, 0.0) + mass
+            if weights[symbol] > max_weight:
+                raise ValueError("the unit productions of " + lhs.symbol() + " cycle with probability 1")
+
+            for rhs, prob in unit_rules.get(symbol, []):
+                if mass * prob < tolerance and rhs in weights:
+                    continue
+                if rhs not in residual:
+                    residual[rhs] = 0.0
+                    worklist.append(rhs)
+                residual[rhs] += mass * prob
+
+        # the chain of no unit productions is the lhs's own rules, which are converted separately
+        weights[lhs] -= 1.0
+        return [(symbol, weight) for symbol, weight in weights.items() if weight > 0]
+
+    def unit_closure(self, grammar):
+        """
+        Find every non-terminal that can be derived from each non-terminal by unit productions alone, following each unit
+        production from a worklist at most once per non-terminal so that cycles of unit productions end, or summing the
+        probabilities of the chains of unit productions if the grammar is weighted
+        :param grammar: the CFG grammar
+        :return: dictionary mapping each non-terminal with unit productions to a list of (non-terminal it derives,
+        probability or None)
+        """
+        unit_rules = {}
+        for rule in grammar.productions():
+            if self.is_unit(rule.rhs()):
+                unit_rules.setdefault(rule.lhs(), []).append((rule.rhs()[0], self.probability(rule)))
+
+        closure = {}
+        for lhs in unit_rules:
+            if self.weighted:
+                closure[lhs] = self.unit_weights(unit_rules, lhs)
+                continue
+
+            derived = []
+            seen = {lhs}
+            worklist = deque([lhs])
+            while worklist:
+                for rhs, _ in unit_rules.get(worklist.popleft(), []):
+                    if rhs not in seen:
+                        seen.add(rhs)
+                        derived.append((rhs, None))
+                        worklist.append(rhs)
+            closure[lhs] = derived
+
+        return closure
+
+    def convert_unit_productions(self, grammar, lhs, derived):
+        """
+        Convert the unit productions of a non-terminal into valid CNF by re-writing them with the right-hand sides of all
+        the non-unit productions of the non-terminals they derive, weighted by the probability of deriving each
+        :param grammar: the CFG grammar
+        :param lhs: the left-hand side
+        :param derived: list of (non-terminal derived from the left-hand side by unit productions, probability or None)
         :return: void
         """
-        if len(rhs) is 2:
-            self.add_production(lhs, self.production_string(rhs))
-            return
-        else:
-            self.dummy_count += 1
-            dummy_nonterminal = "X" + str(self.dummy_count)
-
-            self.add_production(lhs, dummy_nonterminal + " " + rhs[len(rhs) - 1].symbol())
-            rhs.pop(len(rhs) - 1)
-            self.convert_long_productions(dummy_nonterminal, rhs)
+        for symbol, weight in derived:
+            for rhs, prob in self.expand(grammar, symbol):
+                self.add_production(lhs.symbol(), rhs, None if weight is None else weight * prob)
 
     def convert_grammar(self, cfg_grammar):
         """
         Convert every production in a CFG grammar into valid CNF
-        :param cfg_grammar: the CFG grammar
+        :param cfg_grammar: the CFG grammar, or a PCFG to convert with its probabilities
         :return: void
         """
+        self.weighted = isinstance(cfg_grammar, nltk.PCFG)
+        self.symbols.update(symbol.symbol() for rule in cfg_grammar.productions() for symbol in (rule.lhs(),) + rule.rhs()
+                            if nltk.grammar.is_nonterminal(symbol))
+        closure = self.unit_closure(cfg_grammar)
+
         for rule in cfg_grammar.productions():
-            if self.is_cnf(rule.rhs()):
-                self.add_production(rule.lhs().symbol(), self.production_string(rule.rhs()))
-            if self.is_hybrid(rule.rhs()):
-                self.convert_hybrid_productions(rule)
             if self.is_unit(rule.rhs()):
-                self.convert_unit_productions(cfg_grammar, rule.lhs().symbol(), rule.rhs()[0])
-            if self.is_long(rule.rhs()):
-                self.convert_long_productions(rule.lhs().symbol(), list(rule.rhs()))
+                # all of a non-terminal's unit productions are converted together the first time one is seen
+                if rule.lhs() in closure:
+                    self.convert_unit_productions(cfg_grammar, rule.lhs(), closure.pop(rule.lhs()))
+            else:
+                rhs = self.convert_production(rule)
+                if rhs is not None:
+                    self.add_production(rule.lhs().symbol(), rhs, self.probability(rule))
+
+    def write_grammar(self, start, output):
+        """
+        Write the CNF grammar in NLTK grammar format, or NLTK PCFG format if the grammar is weighted
+        :param start: the start symbol
+        :param output: the open file to write to
+        :return: void
+        """
+        output.write("%start " + start + "\n")
+
+        for key, value in self.cnf_grammar.items():
+            if self.weighted:
+                for rhs in value:
+                    output.write(key + " -> " + rhs + " [" + self.probability_string(self.probabilities[(key, rhs)]) +
+                                 "]\n")
+            else:
+                output.write(key + " -> " + " | ".join(value) + "\n")
+
+
+def rule_count_report(cfg_grammar):
+    """
+    Count the rules of the given grammar before and after converting it to CNF, with and without shared dummy
+    non-terminals
+    :param cfg_grammar: the CFG grammar
+    :return: the report as a string
+    """
+    lines = ["cfg: {0} non-terminals, {1} rules".format(len({rule.lhs() for rule in cfg_grammar.productions()}),
+                                                       len(cfg_grammar.productions()))]
+
+    for name, share_dummies in [("cnf", False), ("cnf with shared dummies", True)]:
+        converter = CNFConverter(share_dummies)
+        converter.convert_grammar(cfg_grammar)
+        lines.append("{0}: {1} non-terminals, {2} rules, {3} dummy non-terminals".format(
+            name, len(converter.cnf_grammar), sum(len(rules) for rules in converter.cnf_grammar.values()),
+            converter.dummy_count))
+
+    return "\n".join(lines)
 
 
 class TestCNFConverter(TestCase):
@@ -226,15 +432,101 @@ class TestCNFConverter(TestCase):
             "X1": ["NP_WPS VERB_VBS"],
             "X2": ["X3 NP_NN"],
             "X3": ["NP_DT VERB_DOZ"],
-            "NREL_VBZ": ["X4 INFCL_VB"],
-            "DECL_DOZ": ["X5 pt_char_per"],
-            "X4": ["NP_WPS VERB_VBS"],
-            "X5": ["X6 NP_NN"],
-            "X6": ["NP_DT VERB_DOZ"]
+            "NREL_VBZ": ["X1 INFCL_VB"],
+            "DECL_DOZ": ["X2 pt_char_per"]
+        }
+
+        self.assertDictEqual(converter.cnf_grammar, expected_grammar)
+
+    def test_unit_cycle(self):
+        """
+        Test cycles of unit productions
+        :return: void
+        """
+        grammar = nltk.CFG.fromstring('S -> A\n A -> B | "a"\n B -> A | C\n C -> "the" B')
+
+        converter = CNFConverter()
+        converter.cnf_grammar = {}
+        converter.convert_grammar(grammar)
+
+        expected_grammar = {
+            "S": ['"a"', "THE B"],
+            "A": ["THE B", '"a"'],
+            "B": ['"a"', "THE B"],
+            "C": ["THE B"],
+            "THE": ['"the"']
+        }
+
+        self.assertDictEqual(converter.cnf_grammar, expected_grammar)
+
+    def test_shared_dummies(self):
+        """
+        Test long productions starting with the same symbols share dummy non-terminals
+        :return: void
+        """
+        grammar = nltk.CFG.fromstring("A -> B C D E\n F -> B C D G\n H -> B C I")
+
+        converter = CNFConverter()
+        converter.cnf_grammar = {}
+        converter.convert_grammar(grammar)
+
+        expected_grammar = {
+            "A": ["X1 E"],
+            "F": ["X1 G"],
+            "H": ["X2 I"],
+            "X1": ["X2 D"],
+            "X2": ["B C"]
         }
 
         self.assertDictEqual(converter.cnf_grammar, expected_grammar)
 
+        report = rule_count_report(grammar).split("\n")
+        self.assertEqual(["cfg: 3 non-terminals, 3 rules", "cnf: 8 non-terminals, 8 rules, 5 dummy non-terminals",
+                          "cnf with shared dummies: 5 non-terminals, 5 rules, 2 dummy non-terminals"], report)
+
+    def test_weighted_conversion(self):
+        """
+        Test the probabilities of a PCFG are carried through hybrid, long and unit productions, even through a cycle
+        :return: void
+        """
+        grammar = nltk.PCFG.fromstring('S -> A [0.5] | "s" [0.5]\n A -> S [0.5] | "x" "y" C D [0.5]\n C -> "c" [1.0]\n'
+                                       'D -> "d" [1.0]')
+
+        converter = CNFConverter()
+        converter.convert_grammar(grammar)
+
+        expected_grammar = {
+            "S": ["X1 D", '"s"'],
+            "A": ["X1 D", '"s"'],
+            "X1": ["X2 C"],
+            "X2": ["X Y"],
+            "X": ['"x"'],
+            "Y": ['"y"'],
+            "C": ['"c"'],
+            "D": ['"d"']
+        }
+
+        # the chains S -> A -> S ... and A -> S -> A ... each add up to 4/3
+        expected_probabilities = {
+            ("S", "X1 D"): 1 / 3,
+            ("S", '"s"'): 2 / 3,
+            ("A", "X1 D"): 2 / 3,
+            ("A", '"s"'): 1 / 3
+        }
+
+        self.assertCountEqual(expected_grammar.keys(), converter.cnf_grammar.keys())
+        for lhs in expected_grammar:
+            self.assertCountEqual(expected_grammar[lhs], converter.cnf_grammar[lhs])
+        for rule, prob in expected_probabilities.items():
+            self.assertAlmostEqual(prob, converter.probabilities[rule])
+        self.assertEqual(1.0, converter.probabilities[("X1", "X2 C")])
+
+        output = io.StringIO()
+        converter.write_grammar("S", output)
+        cnf_grammar = nltk.PCFG.fromstring(output.getvalue())
+        self.assertEqual("S", cnf_grammar.start().symbol())
+        self.assertTrue(all(CNFConverter.is_cnf(rule.rhs()) for rule in cnf_grammar.productions()))
+
     def test_hybrid_long(self):
         """
         Test hybrid and long productions
@@ -255,28 +547,60 @@ class TestCNFConverter(TestCase):
         }
 
         self.assertDictEqual(converter.cnf_grammar, expected_grammar)
-        
+
+    def test_name_collisions(self):
+        """
+        Test the new non-terminals for terminals and long productions don't take the names of existing non-terminals
+        :return: void
+        """
+        grammar = nltk.PCFG.fromstring('S -> "np" NP [0.5] | X1 B C [0.5]\n NP -> "x" [0.5] | "y" [0.5]\n'
+                                       'X1 -> "x1" [1.0]\n B -> "b" [1.0]\n C -> "c" [1.0]')
+
+        converter = CNFConverter()
+        converter.convert_grammar(grammar)
+
+        expected_grammar = {
+            "S": ["NP_1 NP", "X1_1 C"],
+            "NP_1": ['"np"'],
+            "NP": ['"x"', '"y"'],
+            "X1_1": ["X1 B"],
+            "X1": ['"x1"'],
+            "B": ['"b"'],
+            "C": ['"c"']
+        }
+
+        self.assertDictEqual(expected_grammar, converter.cnf_grammar)
+
+        output = io.StringIO()
+        converter.write_grammar("S", output)
+        cnf_grammar = nltk.PCFG.fromstring(output.getvalue())
+        self.assertEqual(2, len(cnf_grammar.productions(lhs=nltk.Nonterminal("NP"))))
+
 
 def main():
     """
     Parse the system arguments, call the CNFConverter class and write results to the output file
     :return:
     """
-    grammar_file = sys.argv[1]
-    cfg_grammar = nltk.data.load(grammar_file)
-
-    output_file = sys.argv[2]
-    output = open(output_file, "w")
+    arg_parser = argparse.ArgumentParser(description="Convert a context free grammar into Chomsky Normal Form")
+    arg_parser.add_argument("grammar_file", help="the grammar to convert to CNF, a PCFG if its name ends in .pcfg")
+    arg_parser.add_argument("output_file", help="the output file for the CNF conversion in NLTK grammar format, or NLTK "
+                                                "PCFG format for a PCFG")
+    arg_parser.add_argument("--report", action="store_true",
+                            help="print the number of rules before and after conversion, with and without shared dummy "
+                                 "non-terminals")
+    args = arg_parser.parse_args()
 
-    output.write("%start " + cfg_grammar.start().symbol() + "\n")
+    cfg_grammar = nltk.data.load(args.grammar_file)
 
     converter = CNFConverter()
     converter.convert_grammar(cfg_grammar)
 
-    for key, value in converter.cnf_grammar.items():
-        output.write(key + " -> " + " | ".join(value) + "\n")
+    with open(args.output_file, "w") as output:
+        converter.write_grammar(cfg_grammar.start().symbol(), output)
 
-    output.close()
+    if args.report:
+        print(rule_count_report(cfg_grammar))
 
 
 if __name__ == "__main__":
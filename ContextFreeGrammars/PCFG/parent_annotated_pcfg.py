@@ -1,84 +1,198 @@
 #! /usr/bin/env python3
 
-import sys
+import io
+import json
+import tempfile
 from nltk import Tree, Nonterminal
 from unittest import TestCase
+from pcfg import counts_to_list, list_to_counts, rule_probabilities, write_rules, compile_rules, induce_in_parallel, \
+    induction_main
 
 
 class PCFG:
     """
-    This class induces a probabilistic context free grammar from a treebank
+    This class induces a probabilistic context free grammar from a treebank, annotating each nonterminal with its
+    ancestors and binarizing wide rules with Markovized intermediate symbols
     """
 
-    grammar_counts = {}
-    start = ''
+    def __init__(self, start='', vertical=2, horizontal=2):
+        """
+        Initialize the class with empty rule counts
+        :param start: the start symbol, if known, otherwise the label of the first tree counted
+        :param vertical: the vertical Markov order, 1 for no annotation, 2 to annotate each nonterminal with its parent,
+        3 for its parent and grandparent, and so on
+        :param horizontal: the horizontal Markov order, the number of the following siblings remembered by the
+        intermediate symbols made when binarizing rules with more than two children
+        """
+        if vertical < 1 or horizontal < 0:
+            raise ValueError("the vertical order must be at least 1 and the horizontal order at least 0")
+
+        # a dictionary of the counts of each right-hand side for each parent annotated left-hand side
+        self.grammar_counts = {}
+        self.start = start
+        self.vertical = vertical
+        self.horizontal = horizontal
 
-    def count_rules(self, tree, parent):
+    def annotate(self, label, ancestors):
         """
-        For each level in the given tree, increment the corresponding count in the dictionary
-        :param tree: the given tree
-        :param parent: the parent label
+        Annotate the label with as many of its ancestors as the vertical order allows
+        :param label: the label
+        :param ancestors: the labels of the ancestors, nearest first
+        :return: the annotated label
+        """
+        return "^".join((label,) + ancestors[:self.vertical - 1])
+
+    def add_rule(self, lhs, rhs, unk=False):
+        """
+        Increment the count of the given rule, starting every rule, and an UNK rule for a preterminal lhs, from a
+        pseudo-count of 1
+        :param lhs: the left-hand side
+        :param rhs: the right-hand side
+        :param unk: whether the lhs should have an UNK rule, which only preterminals need to tag unknown words
         :return: void
         """
-        lhs = tree.label()
-
-        if self.start is '':
-            self.start = lhs
-
-        # if this tree's children are subtrees, count the rules in each of those too
-        if len(tree) > 1:
-            rhs = Nonterminal(tree[0].label() + "^" + lhs + " " + tree[1].label() + "^" + lhs)
-            self.count_rules(tree[0], lhs)
-            self.count_rules(tree[1], lhs)
-        # if this tree has one child, and it's a subtree, count the rules in there too
-        elif isinstance(tree[0], Tree):
-            rhs = Nonterminal(tree[0].label() + "^" + lhs)
-            self.count_rules(tree[0], lhs)
-        # if this tree's child is a leaf, no recursion is necessary
-        else:
-            rhs = tree[0]
-
-        if lhs != self.start:
-            lhs = lhs + "^" + parent
         self.grammar_counts.setdefault(lhs, {}).setdefault(rhs, 1)
 
-        if "UNK" not in self.grammar_counts[lhs]:
+        if unk and "UNK" not in self.grammar_counts[lhs]:
             self.grammar_counts[lhs]["UNK"] = 1
 
         self.grammar_counts[lhs][rhs] += 1
 
+    def count_rules(self, tree):
+        """
+        For each level in the given tree, increment the corresponding count in the dictionary, walking the tree with a
+        stack rather than recursion and counting each subtree's children before the subtree itself
+        :param tree: the given tree
+        :return: void
+        """
+        if self.start == '':
+            self.start = tree.label()
+
+        # each subtree is visited twice, first to push its children and then to count its own rule
+        stack = [(tree, (), False)]
+        while stack:
+            subtree, ancestors, children_pushed = stack.pop()
+            children = [child for child in subtree if isinstance(child, Tree)]
+
+            if not children_pushed:
+                stack.append((subtree, ancestors, True))
+                child_ancestors = ((subtree.label(),) + ancestors)[:self.vertical - 1]
+                stack.extend((child, child_ancestors, False) for child in reversed(children))
+                continue
+
+            lhs = self.annotate(subtree.label(), ancestors)
+
+            # if this tree's child is a leaf, it is a lexical rule
+            if not children:
+                self.add_rule(lhs, subtree[0], unk=True)
+                continue
+
+            labels = [self.annotate(child.label(), (subtree.label(),) + ancestors) for child in children]
+
+            # binarize wider rules from the left, naming each intermediate symbol after the siblings it remembers
+            parent = lhs
+            for index in range(len(children) - 2):
+                following = [child.label() for child in children[index + 1:index + 1 + self.horizontal]]
+                intermediate = parent + "<" + "-".join(following) + ">"
+                self.add_rule(lhs, Nonterminal(labels[index] + " " + intermediate))
+                lhs = intermediate
+
+            self.add_rule(lhs, Nonterminal(" ".join(labels[-2:])))
+
     def induce_cfg(self, trees):
         """
-        Induce a probabilistic CFG from the given set of trees
-        :param trees:
+        Induce a probabilistic CFG from the given set of trees, which can be any iterable of lines such as an open file
+        :param trees: the trees, one per line
         :return: void
         """
         for tree in trees:
-            if tree.strip() is '':
+            if tree.strip() == '':
                 continue
-            self.count_rules(Tree.fromstring(tree.strip()), '')
+            self.count_rules(Tree.fromstring(tree.strip()))
+
+    def merge_counts(self, other):
+        """
+        Add the rule counts of another inducer to this one, as if its trees had been counted after this one's
+        :param other: the other inducer
+        :return: void
+        """
+        if (self.vertical, self.horizontal) != (other.vertical, other.horizontal):
+            raise ValueError("can't merge counts annotated with different Markov orders")
+
+        if self.start == '':
+            self.start = other.start
+
+        for lhs, counts in other.grammar_counts.items():
+            merged = self.grammar_counts.setdefault(lhs, {})
+            for rhs, count in counts.items():
+                # both sets of counts include the pseudo-count of 1 for each rhs, which should only be counted once
+                merged[rhs] = merged[rhs] + count - 1 if rhs in merged else count
+
+    def save_counts(self, counts_file):
+        """
+        Write the rule counts to a file so they can be merged later
+        :param counts_file: the open file to write to
+        :return: void
+        """
+        json.dump({"start": self.start, "vertical": self.vertical, "horizontal": self.horizontal,
+                   "counts": counts_to_list(self.grammar_counts)}, counts_file)
+
+    @staticmethod
+    def load_counts(counts_file):
+        """
+        Read rule counts written by save_counts
+        :param counts_file: the open file to read from
+        :return: an inducer with the rule counts
+        """
+        saved = json.load(counts_file)
+        inducer = PCFG(saved["start"], saved["vertical"], saved["horizontal"])
+        inducer.grammar_counts = list_to_counts(saved["counts"])
+        return inducer
+
+    def write_pcfg(self, grammar_file):
+        """
+        Write the rules in the dictionary with their corresponding probabilities to a file, one rule at a time
+        :param grammar_file: the open file to write to
+        :return: void
+        """
+        write_rules(rule_probabilities(self.grammar_counts, self.start), grammar_file)
 
     def print_pcfg(self):
         """
         Print out the rules in the dictionary with their corresponding probabilities
         :return: the string of rules for the PCFG
         """
-        output = ""
+        output = io.StringIO()
+        self.write_pcfg(output)
+        return output.getvalue().strip()
 
-        for rhs in self.grammar_counts[self.start]:
-            total_lhs = sum(self.grammar_counts[self.start].values())
-            prob = self.grammar_counts[self.start][rhs] / total_lhs
-            output += self.start + " -> " + (str(rhs) if isinstance(rhs, Nonterminal) else "\"" + rhs + "\"") + " [" + str(prob) + "]\n"
+    def compile_pcfg(self, source_hash=""):
+        """
+        Compile the rules in the dictionary into the parser's binary grammar without writing them as text first
+        :param source_hash: the hash of the grammar file written for these rules, if any
+        :return: the compiled grammar
+        """
+        return compile_rules(rule_probabilities(self.grammar_counts, self.start), self.start, source_hash)
 
-        for lhs in self.grammar_counts.keys():
-            if lhs is self.start:
-                continue
-            total_lhs = sum(self.grammar_counts[lhs].values())
-            for rhs in self.grammar_counts[lhs]:
-                prob = self.grammar_counts[lhs][rhs]/total_lhs
-                output += lhs + " -> " + (str(rhs) if isinstance(rhs, Nonterminal) else "\"" + rhs + "\"") + " [" + str(prob) + "]\n"
 
-        return output.strip()
+def rule_count_report(treebank_files, verticals=(1, 2, 3), horizontals=(0, 1, 2)):
+    """
+    Count the nonterminals and rules of the grammar induced from the treebanks with each Markov order
+    :param treebank_files: the treebank files
+    :param verticals: the vertical orders to try
+    :param horizontals: the horizontal orders to try
+    :return: the report as a string, one line for each pair of orders
+    """
+    lines = ["vertical horizontal nonterminals rules"]
+    for vertical in verticals:
+        for horizontal in horizontals:
+            inducer = PCFG(vertical=vertical, horizontal=horizontal)
+            for treebank_file in treebank_files:
+                with open(treebank_file, "r") as treebank:
+                    inducer.induce_cfg(treebank)
+            rules = sum(len(counts) for counts in inducer.grammar_counts.values())
+            lines.append("{0} {1} {2} {3}".format(vertical, horizontal, len(inducer.grammar_counts), rules))
+    return "\n".join(lines)
 
 
 class TestPCFG(TestCase):
@@ -104,22 +218,98 @@ class TestPCFG(TestCase):
 
         self.assertCountEqual([x.strip("\n") for x in expected_grammar], induced_list)
 
+    def test_parallel_induction(self):
+        """
+        Tests for counting the treebank in shards across processes, which must give exactly the sequential grammar
+        :return: void
+        """
+        inducer = PCFG()
+        with open('./TestFiles/trees', "r") as trees:
+            inducer.induce_cfg(trees)
+
+        for shards in [1, 2, 3]:
+            parallel_inducer = induce_in_parallel(PCFG, './TestFiles/trees', 2, shards)
+            self.assertEqual(inducer.print_pcfg(), parallel_inducer.print_pcfg())
+
+    def test_merge_saved_counts(self):
+        """
+        Tests for saving the counts of separate parts of the treebank and merging them later
+        :return: void
+        """
+        with open('./TestFiles/trees', "r") as trees:
+            test_trees = trees.readlines()
+
+        inducer = PCFG()
+        inducer.induce_cfg(test_trees)
+
+        merged = PCFG()
+        for part in [test_trees[:2], test_trees[2:]]:
+            shard = PCFG()
+            shard.induce_cfg(part)
+            with tempfile.TemporaryFile("w+") as counts_file:
+                shard.save_counts(counts_file)
+                counts_file.seek(0)
+                merged.merge_counts(PCFG.load_counts(counts_file))
+
+        self.assertEqual(inducer.print_pcfg(), merged.print_pcfg())
+
+    def test_markovization(self):
+        """
+        Tests for the vertical and horizontal Markov orders
+        :return: void
+        """
+        with open('./TestFiles/trees', "r") as trees:
+            test_trees = trees.readlines()
+
+        inducer = PCFG(vertical=1)
+        inducer.induce_cfg(test_trees)
+        self.assertIn(Nonterminal("Det N"), inducer.grammar_counts["NP"])
+        self.assertFalse(any("^" in lhs for lhs in inducer.grammar_counts))
+
+        inducer = PCFG(vertical=3)
+        inducer.induce_cfg(test_trees)
+        self.assertIn(Nonterminal("Det^NP^VP N^NP^VP"), inducer.grammar_counts["NP^VP^S"])
+        self.assertIn("cat", inducer.grammar_counts["N^NP^NP"])
+
+        wide_tree = ["(S (NP John) (VP sleeps) (PP (P on) (NP Sunday)) (ADV soundly))"]
+        for horizontal, intermediates in [(0, ["S<>"]), (1, ["S<VP>", "S<PP>"]), (2, ["S<VP-PP>", "S<PP-ADV>"])]:
+            inducer = PCFG(horizontal=horizontal)
+            inducer.induce_cfg(wide_tree)
+            self.assertIn(Nonterminal("NP^S " + intermediates[0]), inducer.grammar_counts["S"])
+            self.assertIn(Nonterminal("PP^S ADV^S"), inducer.grammar_counts[intermediates[-1]])
+            self.assertNotIn("UNK", inducer.grammar_counts[intermediates[-1]])
+            self.assertNotIn("UNK", inducer.grammar_counts["S"])
+            self.assertIn("UNK", inducer.grammar_counts["P^PP"])
+
+        with self.assertRaises(ValueError):
+            PCFG(vertical=2).merge_counts(PCFG(vertical=3))
+
+    def test_rule_count_report(self):
+        """
+        Tests for the report of the size of the grammar with each Markov order
+        :return: void
+        """
+        report = rule_count_report(['./TestFiles/trees']).split("\n")
+
+        with open('./TestFiles/annotated_grammar', "r") as grammar:
+            expected_grammar = grammar.readlines()
+
+        self.assertEqual(10, len(report))
+        self.assertIn("2 2 {0} {1}".format(len({rule.split()[0] for rule in expected_grammar}), len(expected_grammar)),
+                      report)
+
 
 def main():
     """
     Parse the system arguments, call the PCFG class and write results to the output file
     :return:
     """
-    treebank_file = sys.argv[1]
-    treebank = open(treebank_file, "r")
-    trees = treebank.readlines()
-
-    output_file = sys.argv[2]
-    with open(output_file, "w") as f:
-
-        inducer = PCFG()
-        inducer.induce_cfg(trees)
-        print(inducer.print_pcfg(), file=f)
+    induction_main(PCFG, {
+        "vertical": {"type": int, "default": 2,
+                     "help": "the number of levels of each nonterminal's ancestry to annotate it with, counting itself"},
+        "horizontal": {"type": int, "default": 2,
+                       "help": "the number of siblings remembered when binarizing rules with more than two children"}
+    }, rule_count_report)
 
 
 if __name__ == "__main__":
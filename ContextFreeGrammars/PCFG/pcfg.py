@@ -1,6 +1,14 @@
 #! /usr/bin/env python3
 
+import os
+import io
 import sys
+import json
+import argparse
+import tempfile
+import nltk
+from functools import partial
+from multiprocessing import Pool
 from nltk import Tree, Nonterminal
 from unittest import TestCase
 
@@ -10,68 +18,336 @@ class PCFG:
     This class induces a probabilistic context free grammar from a treebank
     """
 
-    grammar_counts = {}
-    root = ''
+    def __init__(self, root=''):
+        """
+        Initialize the class with empty rule counts
+        :param root: the root symbol, if known, otherwise the label of the first tree counted
+        """
+        # a dictionary of the counts of each right-hand side for each left-hand side
+        self.grammar_counts = {}
+        self.root = root
 
     def count_rules(self, tree):
         """
-        For each level in the given tree, increment the corresponding count in the dictionary
+        For each level in the given tree, increment the corresponding count in the dictionary, walking the tree with a
+        stack rather than recursion and counting each subtree's children before the subtree itself
         :param tree: the given tree
         :return: void
         """
-        lhs = tree.label()
-
-        if self.root is '':
-            self.root = lhs
-
-        # if this tree's children are subtrees, count the rules in each of those too
-        if len(tree) > 1:
-            rhs = Nonterminal(tree[0].label() + " " + tree[1].label())
-            self.count_rules(tree[0])
-            self.count_rules(tree[1])
-        # if this tree has one child, and it's a subtree, count the rules in there too
-        elif isinstance(tree[0], Tree):
-            rhs = Nonterminal(tree[0].label())
-            self.count_rules(tree[0])
-        # if this tree's child is a leaf, no recursion is necessary
-        else:
-            rhs = tree[0]
+        if self.root == '':
+            self.root = tree.label()
+
+        # each subtree is visited twice, first to push its children and then to count its own rule
+        stack = [(tree, False)]
+        while stack:
+            subtree, children_pushed = stack.pop()
+
+            # if this tree's children are subtrees, count the rules in each of those too
+            if len(subtree) > 1:
+                children = [subtree[0], subtree[1]]
+            # if this tree has one child, and it's a subtree, count the rules in there too
+            elif isinstance(subtree[0], Tree):
+                children = [subtree[0]]
+            # if this tree's child is a leaf, there is nothing more to visit
+            else:
+                children = []
+
+            if not children_pushed:
+                stack.append((subtree, True))
+                stack.extend((child, False) for child in reversed(children))
+                continue
+
+            if children:
+                rhs = Nonterminal(" ".join(child.label() for child in children))
+            else:
+                rhs = subtree[0]
 
-        self.grammar_counts.setdefault(lhs, {}).setdefault(rhs, 0)
-        self.grammar_counts[lhs][rhs] += 1
+            counts = self.grammar_counts.setdefault(subtree.label(), {})
+            counts[rhs] = counts.get(rhs, 0) + 1
 
     def induce_cfg(self, trees):
         """
-        Induce a probabilistic CFG from the given set of trees
-        :param trees:
+        Induce a probabilistic CFG from the given set of trees, which can be any iterable of lines such as an open file
+        :param trees: the trees, one per line
         :return: void
         """
         for tree in trees:
-            if tree.strip() is '':
+            if tree.strip() == '':
                 continue
             self.count_rules(Tree.fromstring(tree.strip()))
 
+    def merge_counts(self, other):
+        """
+        Add the rule counts of another inducer to this one, as if its trees had been counted after this one's
+        :param other: the other inducer
+        :return: void
+        """
+        if self.root == '':
+            self.root = other.root
+
+        for lhs, counts in other.grammar_counts.items():
+            merged = self.grammar_counts.setdefault(lhs, {})
+            for rhs, count in counts.items():
+                merged[rhs] = merged.get(rhs, 0) + count
+
+    def save_counts(self, counts_file):
+        """
+        Write the rule counts to a file so they can be merged later
+        :param counts_file: the open file to write to
+        :return: void
+        """
+        json.dump({"start": self.root, "counts": counts_to_list(self.grammar_counts)}, counts_file)
+
+    @staticmethod
+    def load_counts(counts_file):
+        """
+        Read rule counts written by save_counts
+        :param counts_file: the open file to read from
+        :return: an inducer with the rule counts
+        """
+        saved = json.load(counts_file)
+        inducer = PCFG(saved["start"])
+        inducer.grammar_counts = list_to_counts(saved["counts"])
+        return inducer
+
+    def write_pcfg(self, grammar_file):
+        """
+        Write the rules in the dictionary with their corresponding probabilities to a file, one rule at a time
+        :param grammar_file: the open file to write to
+        :return: void
+        """
+        write_rules(rule_probabilities(self.grammar_counts, self.root), grammar_file)
+
     def print_pcfg(self):
         """
         Print out the rules in the dictionary with their corresponding probabilities
         :return: the string of rules for the PCFG
         """
-        output = ""
+        output = io.StringIO()
+        self.write_pcfg(output)
+        return output.getvalue().strip()
 
-        for rhs in self.grammar_counts[self.root]:
-            total_lhs = sum(self.grammar_counts[self.root].values())
-            prob = self.grammar_counts[self.root][rhs] / total_lhs
-            output += self.root + " -> " + (str(rhs) if isinstance(rhs, Nonterminal) else "\"" + rhs + "\"") + " [" + str(prob) + "]\n"
+    def compile_pcfg(self, source_hash=""):
+        """
+        Compile the rules in the dictionary into the parser's binary grammar without writing them as text first
+        :param source_hash: the hash of the grammar file written for these rules, if any
+        :return: the compiled grammar
+        """
+        return compile_rules(rule_probabilities(self.grammar_counts, self.root), self.root, source_hash)
+
+
+def rule_probabilities(grammar_counts, start):
+    """
+    Turn the rule counts into probabilities, with the rules for the start symbol first, summing the counts for each
+    left-hand side only once
+    :param grammar_counts: dictionary of the counts of each rhs for each lhs
+    :param start: the start symbol
+    :return: generator of (lhs, rhs, prob)
+    """
+    lhs_order = ([start] if start in grammar_counts else []) + [lhs for lhs in grammar_counts if lhs != start]
+    for lhs in lhs_order:
+        counts = grammar_counts[lhs]
+        total_lhs = sum(counts.values())
+        for rhs, count in counts.items():
+            yield lhs, rhs, count / total_lhs
 
-        for lhs in self.grammar_counts.keys():
-            if lhs is self.root:
-                continue
-            total_lhs = sum(self.grammar_counts[lhs].values())
-            for rhs in self.grammar_counts[lhs]:
-                prob = self.grammar_counts[lhs][rhs]/total_lhs
-                output += lhs + " -> " + (str(rhs) if isinstance(rhs, Nonterminal) else "\"" + rhs + "\"") + " [" + str(prob) + "]\n"
 
-        return output.strip()
+def write_rules(rules, grammar_file):
+    """
+    Write each rule to the file in NLTK's PCFG format as soon as it is made
+    :param rules: iterable of (lhs, rhs, prob)
+    :param grammar_file: the open file to write to
+    :return: void
+    """
+    for lhs, rhs, prob in rules:
+        grammar_file.write(lhs + " -> " + (str(rhs) if isinstance(rhs, Nonterminal) else "\"" + rhs + "\"") +
+                           " [" + str(prob) + "]\n")
+
+
+def compiled_grammar():
+    """
+    Import the parser's compiled grammar format, which is only needed to compile grammars, so the rest of the induction
+    doesn't depend on the parser or numpy
+    :return: the CompiledGrammar class
+    """
+    parser_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "Parser")
+    if parser_directory not in sys.path:
+        sys.path.append(parser_directory)
+    from compiled_grammar import CompiledGrammar
+    return CompiledGrammar
+
+
+def compile_rules(rules, start, source_hash=""):
+    """
+    Compile the rules into the parser's binary grammar
+    :param rules: iterable of (lhs, rhs, prob)
+    :param start: the start symbol
+    :param source_hash: the hash of the grammar file written for these rules, if any
+    :return: the compiled grammar
+    """
+    return compiled_grammar().from_rules(start, ((lhs, tuple(str(rhs).split()) if isinstance(rhs, Nonterminal) else rhs,
+                                                  prob) for lhs, rhs, prob in rules), source_hash)
+
+
+def counts_to_list(grammar_counts):
+    """
+    Convert a dictionary of rule counts into lists that keep their order and whether each rhs is a nonterminal
+    :param grammar_counts: dictionary of the counts of each rhs for each lhs
+    :return: list of [lhs, [[rhs, is nonterminal, count], ...]]
+    """
+    return [[lhs, [[str(rhs) if isinstance(rhs, Nonterminal) else rhs, isinstance(rhs, Nonterminal), count]
+                   for rhs, count in counts.items()]]
+            for lhs, counts in grammar_counts.items()]
+
+
+def list_to_counts(count_list):
+    """
+    Convert the lists made by counts_to_list back into a dictionary of rule counts
+    :param count_list: list of [lhs, [[rhs, is nonterminal, count], ...]]
+    :return: dictionary of the counts of each rhs for each lhs
+    """
+    return {lhs: {(Nonterminal(rhs) if is_nonterminal else rhs): count for rhs, is_nonterminal, count in counts}
+            for lhs, counts in count_list}
+
+
+def shard_offsets(treebank_file, shards):
+    """
+    Split the treebank file into byte ranges of about the same size
+    :param treebank_file: the treebank file
+    :param shards: the number of shards
+    :return: list of (begin, end) byte offsets
+    """
+    size = os.path.getsize(treebank_file)
+    bounds = [size * shard // shards for shard in range(shards + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def read_shard(treebank_file, begin, end):
+    """
+    Read the lines that start within the given byte range of the treebank file
+    :param treebank_file: the treebank file
+    :param begin: the first byte of the range
+    :param end: the byte after the range
+    :return: generator of lines
+    """
+    with open(treebank_file, "rb") as treebank:
+        # a line belongs to the shard its first byte is in, so skip the end of a line started before this shard
+        if begin > 0:
+            treebank.seek(begin - 1)
+            treebank.readline()
+        while treebank.tell() < end:
+            line = treebank.readline()
+            if not line:
+                break
+            yield line.decode("utf-8")
+
+
+def first_label(treebank_file):
+    """
+    Find the label of the root of the first tree in the treebank, which is the start symbol for the whole treebank
+    :param treebank_file: the treebank file
+    :return: the label, or an empty string if there are no trees
+    """
+    with open(treebank_file, "r") as treebank:
+        for tree in treebank:
+            if tree.strip() != '':
+                return Tree.fromstring(tree.strip()).label()
+    return ''
+
+
+def count_shard(inducer_class, treebank_file, begin, end, start):
+    """
+    Count the rules in one shard of the treebank
+    :param inducer_class: the inducer class to count with, or a function making an inducer from the start symbol
+    :param treebank_file: the treebank file
+    :param begin: the first byte of the shard
+    :param end: the byte after the shard
+    :param start: the start symbol of the whole treebank
+    :return: the inducer with the shard's rule counts
+    """
+    inducer = inducer_class(start)
+    inducer.induce_cfg(read_shard(treebank_file, begin, end))
+    return inducer
+
+
+def induce_in_parallel(inducer_class, treebank_file, workers, shards=None):
+    """
+    Count the rules of the treebank in shards across a pool of processes and merge the counts in order, giving exactly
+    the same counts as counting the whole treebank in one process
+    :param inducer_class: the inducer class to count with, or a function making an inducer from the start symbol
+    :param treebank_file: the treebank file
+    :param workers: the number of processes
+    :param shards: the number of shards, by default four for each process
+    :return: the inducer with the merged rule counts
+    """
+    start = first_label(treebank_file)
+    jobs = [(inducer_class, treebank_file, begin, end, start)
+            for begin, end in shard_offsets(treebank_file, shards or workers * 4)]
+
+    inducer = inducer_class(start)
+    with Pool(workers) as pool:
+        for shard in pool.starmap(count_shard, jobs):
+            inducer.merge_counts(shard)
+    return inducer
+
+
+def induction_main(inducer_class, options=None, report=None):
+    """
+    Parse the system arguments, induce a grammar with the given inducer class and write the grammar or its rule counts
+    :param inducer_class: the inducer class
+    :param options: dictionary of the extra keyword arguments of the inducer class, each with the keyword arguments of
+    its command line option
+    :param report: function from a list of treebank files to a report on them, written instead of the grammar with
+    --report
+    :return: void
+    """
+    options = options or {}
+
+    arg_parser = argparse.ArgumentParser(description="Induce a PCFG from a treebank")
+    arg_parser.add_argument("input_files", nargs="+",
+                            help="the treebank files, one parse per line in Chomsky Normal Form, or with --merge the rule "
+                                 "count files to merge")
+    arg_parser.add_argument("output_file", help="the output filename")
+    arg_parser.add_argument("--workers", type=int, default=1, help="the number of processes to count rules with")
+    arg_parser.add_argument("--counts", action="store_true",
+                            help="write the rule counts, to be merged later, instead of the grammar")
+    arg_parser.add_argument("--merge", action="store_true", help="merge rule count files instead of reading treebanks")
+    arg_parser.add_argument("--compiled", action="store_true",
+                            help="also write the grammar compiled for the parser to <output_file>.compiled")
+    for name, option in options.items():
+        arg_parser.add_argument("--" + name, **option)
+    if report:
+        arg_parser.add_argument("--report", action="store_true", help="write a report on the treebanks instead")
+    args = arg_parser.parse_args()
+
+    if report and args.report:
+        with open(args.output_file, "w") as f:
+            print(report(args.input_files), file=f)
+        return
+
+    inducer_class = partial(inducer_class, **{name: getattr(args, name) for name in options})
+
+    inducer = inducer_class()
+    for input_file in args.input_files:
+        if args.merge:
+            with open(input_file, "r") as counts_file:
+                inducer.merge_counts(inducer.load_counts(counts_file))
+        elif args.workers > 1:
+            inducer.merge_counts(induce_in_parallel(inducer_class, input_file, args.workers))
+        else:
+            # read the treebank one line at a time so that only the rule counts are kept in memory
+            with open(input_file, "r") as treebank:
+                inducer.induce_cfg(treebank)
+
+    with open(args.output_file, "w") as f:
+        if args.counts:
+            inducer.save_counts(f)
+        else:
+            inducer.write_pcfg(f)
+
+    if args.compiled and not args.counts:
+        # the parser uses the compiled file as long as the hash matches the grammar it was written with
+        inducer.compile_pcfg(compiled_grammar().hash_file(args.output_file)).save(args.output_file + ".compiled")
 
 
 class TestPCFG(TestCase):
@@ -97,22 +373,90 @@ class TestPCFG(TestCase):
 
         self.assertCountEqual([x.strip("\n") for x in expected_grammar], induced_list)
 
+    def test_streaming_induction(self):
+        """
+        Tests for inducing the grammar straight from an open file, with separate counts for each instance
+        :return: void
+        """
+        inducer = PCFG()
+        with open('./TestFiles/trees', "r") as trees:
+            inducer.induce_cfg(trees)
+
+        with open('./TestFiles/grammar', "r") as grammar:
+            expected_grammar = grammar.readlines()
+
+        self.assertCountEqual([x.strip("\n") for x in expected_grammar], inducer.print_pcfg().split("\n"))
+
+        other_inducer = PCFG()
+        other_inducer.induce_cfg(["(S (NP John) (VP sleeps))"])
+        self.assertEqual("S", other_inducer.root)
+        self.assertEqual({"S", "NP", "VP"}, set(other_inducer.grammar_counts))
+        self.assertEqual(1, inducer.grammar_counts["NP"][Nonterminal("NP PP")])
+
+    def test_parallel_induction(self):
+        """
+        Tests for counting the treebank in shards across processes, which must give exactly the sequential grammar
+        :return: void
+        """
+        inducer = PCFG()
+        with open('./TestFiles/trees', "r") as trees:
+            inducer.induce_cfg(trees)
+
+        for shards in [1, 2, 3, 8]:
+            parallel_inducer = induce_in_parallel(PCFG, './TestFiles/trees', 2, shards)
+            self.assertEqual(inducer.print_pcfg(), parallel_inducer.print_pcfg())
+
+    def test_merge_saved_counts(self):
+        """
+        Tests for saving the counts of separate parts of the treebank and merging them later
+        :return: void
+        """
+        with open('./TestFiles/trees', "r") as trees:
+            test_trees = trees.readlines()
+
+        inducer = PCFG()
+        inducer.induce_cfg(test_trees)
+
+        merged = PCFG()
+        for part in [test_trees[:1], test_trees[1:]]:
+            shard = PCFG()
+            shard.induce_cfg(part)
+            with tempfile.TemporaryFile("w+") as counts_file:
+                shard.save_counts(counts_file)
+                counts_file.seek(0)
+                merged.merge_counts(PCFG.load_counts(counts_file))
+
+        self.assertEqual(inducer.print_pcfg(), merged.print_pcfg())
+
+    def test_write_pcfg(self):
+        """
+        Tests for writing the grammar one rule at a time and compiling it for the parser
+        :return: void
+        """
+        inducer = PCFG()
+        with open('./TestFiles/trees', "r") as trees:
+            inducer.induce_cfg(trees)
+
+        output = io.StringIO()
+        inducer.write_pcfg(output)
+        with open('./TestFiles/grammar', "r") as grammar:
+            self.assertCountEqual(grammar.read().splitlines(), output.getvalue().splitlines())
+        self.assertTrue(output.getvalue().startswith("S -> "))
+
+        expected = compiled_grammar().from_pcfg(nltk.PCFG.fromstring(output.getvalue()))
+        compiled = inducer.compile_pcfg()
+        self.assertEqual("S", compiled.start)
+        self.assertEqual(expected.symbols, compiled.symbols)
+        self.assertEqual(expected.lexical_index(), compiled.lexical_index())
+        self.assertEqual(expected.binary_index(), compiled.binary_index())
+
 
 def main():
     """
     Parse the system arguments, call the PCFG class and write results to the output file
     :return:
     """
-    treebank_file = sys.argv[1]
-    treebank = open(treebank_file, "r")
-    trees = treebank.readlines()
-
-    output_file = sys.argv[2]
-    with open(output_file, "w") as f:
-
-        inducer = PCFG()
-        inducer.induce_cfg(trees)
-        print(inducer.print_pcfg(), file=f)
+    induction_main(PCFG)
 
 
 if __name__ == "__main__":
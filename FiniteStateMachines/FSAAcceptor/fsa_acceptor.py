@@ -1,5 +1,10 @@
 from string import whitespace
+import io
 import sys
+import argparse
+from collections import OrderedDict
+from itertools import islice, tee
+from multiprocessing import Pool
 from unittest import TestCase
 
 
@@ -8,12 +13,37 @@ class FSAAcceptor:
     This class determines if a given string is accepted by a given FSA
     """
 
-    def __init__(self, fsa_rules):
+    def __init__(self, fsa_rules, backtrack=False, steps_size=100000, cache_size=100000):
         """
-        Initialize the class by loading the FSA
+        Initialize the class by loading the FSA and compiling its transition table
         :param fsa_rules: a description of an FSA
+        :param backtrack: whether to check strings by backtracking through one path at a time, rather than following
+        the set of all the states the FSA could be in
+        :param steps_size: the number of the most recent moves from a set of states on a symbol to remember
+        :param cache_size: the number of the most recently checked strings to remember the results of in accept_many
         """
         self.fsa = self.load_fsa(fsa_rules)
+        self.backtrack = backtrack
+
+        # the result for each of the most recently checked strings, oldest first
+        self.results = OrderedDict()
+        self.cache_size = cache_size
+
+        # the set of states reachable from each state by epsilon arcs alone, including itself
+        self.closures = self.epsilon_closures(self.fsa)
+
+        # the set of states reachable from each state on each symbol, followed by any number of epsilon arcs
+        self.table = {state: {symbol: frozenset().union(*(self.closures[next_state] for next_state in next_states))
+                              for symbol, next_states in arcs.items() if symbol != ''}
+                      for state, arcs in self.fsa['transitions'].items()}
+
+        self.start_states = self.closures.get(self.fsa['start_state'], frozenset([self.fsa['start_state']]))
+        self.final_states = frozenset(self.fsa['final_states'])
+
+        # the set of states the FSA moves to from each of the sets of states it has been in most recently, on each
+        # symbol, oldest first, so that checking many strings can't build a DFA with exponentially many sets of states
+        self.steps = OrderedDict()
+        self.steps_size = steps_size
 
     @staticmethod
     def load_fsa(fsa_rules):
@@ -47,6 +77,31 @@ class FSAAcceptor:
 
         return fsa
 
+    @staticmethod
+    def epsilon_closures(fsa):
+        """
+        Find the states reachable from each state by epsilon arcs alone, with a stack so that cycles of epsilon arcs end
+        :param fsa: dictionary representation of the FSA
+        :return: dictionary mapping each state to a frozen set of states
+        """
+        states = set(fsa['transitions'])
+        for arcs in fsa['transitions'].values():
+            for next_states in arcs.values():
+                states.update(next_states)
+
+        closures = {}
+        for state in states:
+            closure = {state}
+            stack = [state]
+            while stack:
+                for next_state in fsa['transitions'].get(stack.pop(), {}).get('', []):
+                    if next_state not in closure:
+                        closure.add(next_state)
+                        stack.append(next_state)
+            closures[state] = frozenset(closure)
+
+        return closures
+
     def can_accept_string(self, string):
         """
         Can this FSA accept the given string?
@@ -55,11 +110,79 @@ class FSAAcceptor:
         """
         characters = [character.strip(whitespace + '"\'()') for character in string.split()]
 
-        return self.can_reach_final_state(characters, 0, self.fsa['start_state'])
+        if self.backtrack:
+            return self.can_reach_final_state(characters, 0, self.fsa['start_state'])
+
+        return not self.final_states.isdisjoint(self.reachable_states(characters))
+
+    def accept_cached(self, string):
+        """
+        Can this FSA accept the given string? Remembers the results of recent strings so repeated strings are only
+        split and checked once
+        :param string: the string to check for acceptance
+        :return: bool
+        """
+        if string in self.results:
+            self.results.move_to_end(string)
+            return self.results[string]
+
+        accepted = self.can_accept_string(string)
+        self.results[string] = accepted
+        if len(self.results) > self.cache_size:
+            self.results.popitem(last=False)
+        return accepted
+
+    def accept_many(self, strings, workers=1, chunk_size=1000):
+        """
+        Check each of the given strings for acceptance, reading them lazily so any iterable such as an open file can be
+        used, optionally across a pool of worker processes that each have a copy of this acceptor
+        :param strings: iterable of strings to check
+        :param workers: the number of worker processes
+        :param chunk_size: the number of strings sent to a worker process at a time
+        :return: generator of bools in the same order as the strings
+        """
+        if workers <= 1:
+            for string in strings:
+                yield self.accept_cached(string)
+            return
+
+        strings = iter(strings)
+        with Pool(workers, init_worker, (self,)) as pool:
+            # the pool reads all of the strings it is given straight away, so give it a few chunks for each worker at a time
+            batch = list(islice(strings, chunk_size * workers * 4))
+            while batch:
+                for accepted in pool.imap(accept_in_worker, batch, chunk_size):
+                    yield accepted
+                batch = list(islice(strings, chunk_size * workers * 4))
+
+    def reachable_states(self, characters):
+        """
+        Follow the set of all the states the FSA could be in, one character at a time, remembering the set of states each
+        set moves to on each character
+        :param characters: the string of characters
+        :return: the frozen set of states the FSA could be in after reading the characters
+        """
+        states = self.start_states
+
+        for character in characters:
+            step = (states, character)
+            if step in self.steps:
+                self.steps.move_to_end(step)
+                states = self.steps[step]
+            else:
+                states = frozenset().union(*(self.table.get(state, {}).get(character, ()) for state in states))
+                self.steps[step] = states
+                if len(self.steps) > self.steps_size:
+                    self.steps.popitem(last=False)
+            if not states:
+                break
+
+        return states
 
     def can_reach_final_state(self, characters, index, current_state):
         """
-        Can we reach a final state from the current state?
+        Can we reach a final state from the current state? This tries one path at a time, so it can take exponential time
+        on ambiguous FSAs and never ends on a cycle of epsilon arcs
         :param characters: the string of characters
         :param index: the current index of the string
         :param current_state: the current state
@@ -81,6 +204,29 @@ class FSAAcceptor:
         return accepted
 
 
+# the acceptor copied to each worker process by accept_many
+worker_acceptor = None
+
+
+def init_worker(acceptor):
+    """
+    Keep a copy of the acceptor in a worker process
+    :param acceptor: the FSA acceptor
+    :return: void
+    """
+    global worker_acceptor
+    worker_acceptor = acceptor
+
+
+def accept_in_worker(string):
+    """
+    Check a string with this worker process's acceptor
+    :param string: the string to check for acceptance
+    :return: bool
+    """
+    return worker_acceptor.accept_cached(string)
+
+
 class TestFSAAcceptor(TestCase):
     """
     This class contains tests for the FSAAcceptor class
@@ -164,25 +310,100 @@ class TestFSAAcceptor(TestCase):
         self.assertFalse(acceptor.can_accept_string(self.test_string4))
         self.assertFalse(acceptor.can_accept_string(self.test_string5))
 
+    def test_modes_agree(self):
+        """
+        Tests the set of states agrees with backtracking on every test FSA and string
+        :return: void
+        """
+        for fsa_filename in ['./TestFiles/fsa1', './TestFiles/fsa2', './TestFiles/fsa3', './TestFiles/fsa4']:
+            with open(fsa_filename, "r") as fsa_file:
+                fsa_rules = fsa_file.readlines()
+
+            acceptor = FSAAcceptor(fsa_rules)
+            backtracking_acceptor = FSAAcceptor(fsa_rules, backtrack=True)
+            forgetful_acceptor = FSAAcceptor(fsa_rules, steps_size=1)
+
+            for string in [self.test_string1, self.test_string2, self.test_string3, self.test_string4,
+                           self.test_string5]:
+                self.assertEqual(backtracking_acceptor.can_accept_string(string), acceptor.can_accept_string(string))
+                self.assertEqual(acceptor.can_accept_string(string), forgetful_acceptor.can_accept_string(string))
+                self.assertLessEqual(len(forgetful_acceptor.steps), 1)
+
+    def test_epsilon_cycle(self):
+        """
+        Tests an FSA with a cycle of epsilon arcs and many ambiguous paths
+        :return: void
+        """
+        fsa_rules = ['2', '(0 (1 *e*))', '(1 (0 *e*))', '(0 (0 "a"))', '(1 (1 "a"))', '(1 (2 "b"))']
+
+        acceptor = FSAAcceptor(fsa_rules)
+
+        self.assertTrue(acceptor.can_accept_string(" ".join(['"a"'] * 5000 + ['"b"'])))
+        self.assertFalse(acceptor.can_accept_string(" ".join(['"a"'] * 5000)))
+        self.assertFalse(acceptor.can_accept_string('"b" "a"'))
+
+    def test_accept_many(self):
+        """
+        Tests checking many strings at once, with repeated strings and across worker processes
+        :return: void
+        """
+        with open('./TestFiles/fsa3', "r") as fsa_file:
+            fsa_rules = fsa_file.readlines()
+
+        strings = [self.test_string1, self.test_string2, self.test_string3, self.test_string4, self.test_string5] * 3
+        expected = [False, False, True, False, True] * 3
+
+        acceptor = FSAAcceptor(fsa_rules, cache_size=2)
+        self.assertEqual(expected, list(acceptor.accept_many(iter(strings))))
+        self.assertEqual([self.test_string4, self.test_string5], list(acceptor.results))
+        self.assertEqual(expected, list(acceptor.accept_many(strings, workers=2, chunk_size=2)))
+
+        output = io.StringIO()
+        write_results(acceptor, io.StringIO(self.test_string3 + "\n" + self.test_string4 + "\n"), output)
+        self.assertEqual(self.test_string3 + " => yes\n" + self.test_string4 + " => no\n", output.getvalue())
+
+
+def write_results(acceptor, input_file, output_file, workers=1):
+    """
+    Check each line of the input file for acceptance and write the result for each as soon as it is known
+    :param acceptor: the FSA acceptor
+    :param input_file: the open file of strings, one per line
+    :param output_file: the open file to write the results to
+    :param workers: the number of worker processes
+    :return: void
+    """
+    strings, copy = tee(line.strip() for line in input_file)
+    for string, accepted in zip(strings, acceptor.accept_many(copy, workers)):
+        output_file.write(string + " => " + ("yes" if accepted else "no") + "\n")
+
 
 def main():
     """
     Parse the system arguments, call the FSAAcceptor class and write results to the output file
     :return:
     """
-    fsa_filename = sys.argv[1]
-    test_filename = sys.argv[2]
-
-    with open(fsa_filename, "r") as fsa_file:
+    arg_parser = argparse.ArgumentParser(description="Write whether an FSA accepts each input string")
+    arg_parser.add_argument("fsa_file", help="an FSA file in Carmel format")
+    arg_parser.add_argument("input_file", nargs="?", default="-",
+                            help="the strings to check, one per line with each character in double quotes, or - to read "
+                                 "them from standard input")
+    arg_parser.add_argument("--backtrack", action="store_true",
+                            help="check each string by backtracking through one path at a time")
+    arg_parser.add_argument("--workers", type=int, default=1, help="the number of processes to check strings with")
+    arg_parser.add_argument("--cache-size", type=int, default=100000,
+                            help="the number of recent strings to remember the results of")
+    args = arg_parser.parse_args()
+
+    with open(args.fsa_file, "r") as fsa_file:
         fsa_rules = fsa_file.readlines()
 
-    acceptor = FSAAcceptor(fsa_rules)
-
-    with open(test_filename, "r") as test_file:
-        test_strings = test_file.readlines()
+    acceptor = FSAAcceptor(fsa_rules, args.backtrack, args.cache_size)
 
-    for string in test_strings:
-        print(string.strip() + " => " + ("yes" if acceptor.can_accept_string(string) else "no"))
+    if args.input_file == "-":
+        write_results(acceptor, sys.stdin, sys.stdout, args.workers)
+    else:
+        with open(args.input_file, "r") as input_file:
+            write_results(acceptor, input_file, sys.stdout, args.workers)
 
 
 if __name__ == "__main__":
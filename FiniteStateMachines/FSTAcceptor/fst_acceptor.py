@@ -1,15 +1,35 @@
 from string import whitespace
 import sys
+import heapq
+from math import log, inf
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from unittest import TestCase
 
 
-class FSTAcceptor:
+class Transduction(namedtuple("Transduction", ["accepted", "output", "probability", "path"])):
     """
-    This class determines if a given string is accepted by a given FST
+    The result of transducing one string: whether the FST accepts it, and the output tokens, probability and arcs
+    (state, next state, output, probability) of its most probable path
     """
 
-    output_string = ""
-    output_probability = 1
+    __slots__ = ()
+
+    @property
+    def output_string(self):
+        """
+        The output tokens in double quotes, *e* for an empty output or *none* if the string isn't accepted
+        :return: str
+        """
+        if not self.accepted:
+            return "*none*"
+        return " ".join("\"" + output + "\"" for output in self.output) or "*e*"
+
+
+class FSTAcceptor:
+    """
+    This class determines if a given string is accepted by a given FST, and finds the output of its most probable path
+    """
 
     def __init__(self, fst_rules):
         """
@@ -17,11 +37,18 @@ class FSTAcceptor:
         :param fst_rules: a description of an FST
         """
         self.fst = self.load_fst(fst_rules)
+        self.state_count = len(set(self.fst['transitions']) | set(self.fst['final_states']) |
+                               {arc[0] for arcs in self.fst['transitions'].values() for arc_list in arcs.values()
+                                for arc in arc_list})
+
+        # the output and probability of the most probable path for the last string checked
+        self.output_string = ""
+        self.output_probability = 1
 
     @staticmethod
     def load_fst(fst_rules):
         """
-        Load the given FST into a dictionary
+        Load the given FST into a dictionary, rejecting arcs with a negative probability
         :param fst_rules: a description of an FST
         :return: dictionary representation of the FST
         """
@@ -42,10 +69,12 @@ class FSTAcceptor:
                 input_string = rule[2].strip(whitespace + '"\'()')
                 output_string = rule[3].strip(whitespace + '"\'()')
                 probability = float(rule[4].strip(whitespace + '"\'()') if len(rule) > 4 else 1)
+                if probability < 0:
+                    raise ValueError("the arc " + line.strip() + " has a negative probability")
 
                 if "*e*" in input_string:
                     input_string = ''
-                if fst['start_state'] is '':
+                if fst['start_state'] == '':
                     fst['start_state'] = first_state
                 if first_state not in fst['transitions'].keys():
                     fst['transitions'][first_state] = {}
@@ -54,55 +83,110 @@ class FSTAcceptor:
 
         return fst
 
+    def transduce(self, string):
+        """
+        Find the output of the most probable path through the FST for the given string, without changing the acceptor,
+        so one acceptor can be shared between threads
+        :param string: the string to transduce
+        :return: the Transduction
+        """
+        characters = [x.strip(whitespace + '"\'()') for x in string.split()]
+
+        path = self.best_path(characters)
+        if path is None:
+            return Transduction(False, (), 0, ())
+
+        probability = 1
+        for _, _, _, arc_probability in path:
+            probability *= arc_probability
+
+        return Transduction(True, tuple(output for _, _, output, _ in path if output != '*e*'), probability, tuple(path))
+
     def can_accept_string(self, string):
         """
-        Can this FST accept the given string?
+        Can this FST accept the given string? If it can, the output and probability of the most probable path are kept,
+        so use transduce instead when the acceptor is shared between threads
         :param string: the string to check for acceptance
         :return: bool
         """
-        characters = [x.strip(whitespace + '"\'()') for x in string.split()]
-        self.output_string = ''
-        self.output_probability = 1
+        transduction = self.transduce(string)
+        self.output_string = transduction.output_string if transduction.accepted else ''
+        self.output_probability = transduction.probability if transduction.accepted else 1
 
-        accepted = self.input_to_output(characters, 0, self.fst['start_state'])
+        return transduction.accepted
 
-        if accepted and self.output_string is "":
-            self.output_string = "*e*"
+    @staticmethod
+    def log_probability(probability):
+        """
+        The log of the given probability, so the path with the highest sum of logs is the most probable
+        :param probability: the probability
+        :return: the log of the probability, or -inf if it's 0, so paths of arcs with probability 0 are still accepted
+        """
+        return log(probability) if probability > 0 else -inf
+
+    def follow_epsilons(self, cell, index):
+        """
+        Extend the best paths to each state after reading the same characters through any epsilon arcs, always extending
+        the most probable path first like Dijkstra's algorithm, so cycles of epsilon arcs end. Arcs with a probability
+        above 1 can make a better path to a state that was already extended, which is extended again, so a cycle of
+        epsilon arcs whose probabilities multiply to more than 1 would improve forever, and raises a ValueError instead
+        :param cell: dictionary mapping each state reached to (log prob, back pointer)
+        :param index: the number of characters read
+        :return: void
+        """
+        queue = [(-score, state) for state, (score, _) in cell.items()]
+        heapq.heapify(queue)
 
-        return accepted
+        # the number of epsilon arcs on the best path to each state, which is only more than the number of states if the
+        # path goes around a cycle that raises its probability
+        lengths = dict.fromkeys(cell, 0)
 
-    def input_to_output(self, characters, index, current_state):
+        while queue:
+            cost, state = heapq.heappop(queue)
+            if -cost < cell[state][0]:
+                continue
+            for next_state, output, probability in self.fst['transitions'].get(state, {}).get('', []):
+                score = -cost + self.log_probability(probability)
+                if next_state not in cell or score > cell[next_state][0]:
+                    lengths[next_state] = lengths[state] + 1
+                    if lengths[next_state] > self.state_count:
+                        raise ValueError("a cycle of epsilon arcs through state " + next_state +
+                                         " has a probability above 1")
+                    cell[next_state] = (score, (index, state, output, probability))
+                    heapq.heappush(queue, (-score, next_state))
+
+    def best_path(self, characters):
         """
-        Can we reach a final state from the current state?
+        Find the most probable path through the FST that reads the characters, keeping the best log probability of
+        reaching each state after reading each number of characters, and a pointer back to the arc it came from
         :param characters: the string of characters
-        :param index: the current index of the string
-        :param current_state: the current state
-        :return: bool
+        :return: the list of arcs (state, next state, output, probability) on the path, or None if there is no path
         """
-        accepted = False
-        # if we've reached the end of the string and we're in a final state, we can accept the string
-        if index == len(characters) and current_state in self.fst['final_states']:
-            return True
-        # otherwise continue to attempt to transition towards a final state
-        elif current_state in self.fst['transitions']:
-            if index < len(characters) and characters[index] in self.fst['transitions'][current_state]:
-                transitions = sorted(self.fst['transitions'][current_state][characters[index]], key=lambda x: x[2])
-                for transition in transitions:
-                    accepted = accepted or self.input_to_output(characters, index + 1, transition[0])
-                    if accepted:
-                        self.output_string = ("\"" + transition[1] + "\" " if transition[1] != '*e*' else '') + self.output_string
-                        self.output_probability *= transition[2]
-                        break
-            if '' in self.fst['transitions'][current_state] and not accepted:
-                transitions = sorted(self.fst['transitions'][current_state][''], key=lambda x: x[2])
-                for transition in transitions:
-                    accepted = accepted or self.input_to_output(characters, index, transition[0])
-                    if accepted:
-                        self.output_string = ("\"" + transition[1] + "\" " if transition[1] != '*e*' else '') + self.output_string
-                        self.output_probability *= transition[2]
-                        break
-
-        return accepted
+        table = [{} for _ in range(len(characters) + 1)]
+        table[0][self.fst['start_state']] = (0.0, None)
+
+        for index, character in enumerate(characters):
+            self.follow_epsilons(table[index], index)
+            for state, (score, _) in table[index].items():
+                for next_state, output, probability in self.fst['transitions'].get(state, {}).get(character, []):
+                    next_score = score + self.log_probability(probability)
+                    if next_state not in table[index + 1] or next_score > table[index + 1][next_state][0]:
+                        table[index + 1][next_state] = (next_score, (index, state, output, probability))
+        self.follow_epsilons(table[-1], len(characters))
+
+        final_states = [state for state in self.fst['final_states'] if state in table[-1]]
+        if not final_states:
+            return None
+
+        # follow the back pointers from the most probable final state
+        path = []
+        index, state = len(characters), max(final_states, key=lambda x: table[-1][x][0])
+        while table[index][state][1] is not None:
+            previous_index, previous_state, output, probability = table[index][state][1]
+            path.append((previous_state, state, output, probability))
+            index, state = previous_index, previous_state
+
+        return path[::-1]
 
 
 class TestFSTAcceptor(TestCase):
@@ -180,6 +264,64 @@ class TestFSTAcceptor(TestCase):
         self.assertTrue(acceptor.can_accept_string(self.test_empty_string))
         self.assertEqual('"g"', acceptor.output_string.strip())
 
+    def test_best_path(self):
+        """
+        Tests the most probable path is found, rather than the first
+        :return: void
+        """
+        fst_rules = ['1', '(0 (1 "a" "x" 0.2))', '(0 (1 "a" "y" 0.8))', '(0 (2 *e* "z" 0.9))', '(2 (1 "a" "w" 0.95))',
+                     '(1 (1 *e* "q" 0.5))', '(1 (0 "a" *e* 0.5))']
+
+        acceptor = FSTAcceptor(fst_rules)
+
+        self.assertTrue(acceptor.can_accept_string('"a"'))
+        self.assertEqual('"z" "w"', acceptor.output_string)
+        self.assertAlmostEqual(0.855, acceptor.output_probability)
+
+        self.assertFalse(acceptor.can_accept_string('"b"'))
+
+        self.assertTrue(acceptor.can_accept_string(" ".join(['"a"'] * 5001)))
+        self.assertEqual(" ".join(['"z" "w"'] * 2501), acceptor.output_string)
+
+        acceptor = FSTAcceptor(['2', '(0 (1 "a" "x" 0.5))', '(1 (2 *e* "y" 2))', '(0 (2 "a" "z" 0.8))',
+                                '(2 (2 "b" "w" 0))'])
+        self.assertEqual(Transduction(True, ("x", "y"), 1.0, (("0", "1", "x", 0.5), ("1", "2", "y", 2.0))),
+                         acceptor.transduce('"a"'))
+        self.assertEqual(Transduction(True, ("x", "y", "w"), 0.0, (("0", "1", "x", 0.5), ("1", "2", "y", 2.0),
+                                                                   ("2", "2", "w", 0.0))), acceptor.transduce('"a" "b"'))
+
+        acceptor = FSTAcceptor(['1', '(0 (1 "a" "x" 0.5))', '(1 (2 *e* "y" 2))', '(2 (1 *e* "z" 0.9))'])
+        with self.assertRaises(ValueError):
+            acceptor.transduce('"a"')
+        with self.assertRaises(ValueError):
+            FSTAcceptor(['1', '(0 (1 "a" "x" -0.5))'])
+
+    def test_transduce(self):
+        """
+        Tests transducing returns a result for each string, the same from many threads at once
+        :return: void
+        """
+        with open('./TestFiles/fst3', "r") as fst_file:
+            fst_rules = fst_file.readlines()
+
+        acceptor = FSTAcceptor(fst_rules)
+
+        transduction = acceptor.transduce(self.test_string2)
+        self.assertEqual(Transduction(True, ("b", "c", "b", "c", "g"), 1.0, (
+            ("0", "1", "b", 1.0), ("1", "2", "c", 1.0), ("2", "0", "*e*", 1.0), ("0", "1", "b", 1.0),
+            ("1", "2", "c", 1.0), ("2", "3", "g", 1.0))), transduction)
+        self.assertEqual('"b" "c" "b" "c" "g"', transduction.output_string)
+        with self.assertRaises(AttributeError):
+            transduction.accepted = False
+
+        self.assertEqual(Transduction(False, (), 0, ()), acceptor.transduce(self.test_string1))
+        self.assertEqual("*none*", acceptor.transduce(self.test_string1).output_string)
+        self.assertEqual('"g"', acceptor.transduce('"d" "d"').output_string)
+
+        strings = [" ".join(['"a"'] * length + ['"d"'] * (length % 3)) for length in range(50)] * 4
+        with ThreadPoolExecutor(8) as executor:
+            self.assertEqual([acceptor.transduce(string) for string in strings], list(executor.map(acceptor.transduce, strings)))
+
 
 def main():
     """
@@ -198,10 +340,8 @@ def main():
         test_strings = test_file.readlines()
 
     for string in test_strings:
-        output = acceptor.can_accept_string(string)
-        output_string = acceptor.output_string
-        output_prob = acceptor.output_probability
-        print(string.strip(whitespace) + " => " + (output_string + " " + str(output_prob) if output else "*none* 0"))
+        transduction = acceptor.transduce(string)
+        print(string.strip(whitespace) + " => " + transduction.output_string + " " + str(transduction.probability))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,76 @@
+#! /usr/bin/env python3
+
+import sys
+import time
+import random
+from timeit import default_timer
+from concurrent.futures import ThreadPoolExecutor
+from fst_acceptor import FSTAcceptor
+
+
+def random_strings(acceptor, length, count):
+    """
+    Build random strings of the given length from the input symbols of the FST
+    :param acceptor: the FST acceptor
+    :param length: the number of characters in each string
+    :param count: the number of strings to build
+    :return: list of strings with each character in double quotes
+    """
+    symbols = sorted({symbol for arcs in acceptor.fst['transitions'].values() for symbol in arcs if symbol != ''})
+    return [" ".join("\"" + random.choice(symbols) + "\"" for _ in range(length)) for _ in range(count)]
+
+
+def serve(acceptor, string, latency):
+    """
+    Serve one request, waiting as if the string were read from and the result written to the network
+    :param acceptor: the shared FST acceptor
+    :param string: the string to transduce
+    :param latency: the number of seconds spent waiting for I/O
+    :return: the Transduction
+    """
+    time.sleep(latency)
+    return acceptor.transduce(string)
+
+
+def time_threads(acceptor, strings, threads, latency):
+    """
+    Time how long a pool of threads sharing one acceptor takes to serve all of the strings
+    :param acceptor: the shared FST acceptor
+    :param strings: the strings to transduce
+    :param threads: the number of threads
+    :param latency: the number of seconds each request spends waiting for I/O
+    :return: a tuple of the number of strings served per second and the results
+    """
+    start = default_timer()
+    with ThreadPoolExecutor(threads) as executor:
+        results = list(executor.map(lambda string: serve(acceptor, string, latency), strings))
+    return len(strings) / (default_timer() - start), results
+
+
+def main():
+    """
+    Parse the system arguments, and time transducing random strings with 1, 2, 4, 8 and 16 threads sharing one loaded FST,
+    each request waiting 10ms for I/O, and print the results
+    :return: void
+    """
+    fst_filename = sys.argv[1]
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 400
+
+    with open(fst_filename, "r") as fst_file:
+        acceptor = FSTAcceptor(fst_file.readlines())
+
+    random.seed(0)
+    strings = random_strings(acceptor, 10, count)
+
+    base_rate, expected = time_threads(acceptor, strings, 1, 0.01)
+    print("1 thread: {0:.0f} strings per second".format(base_rate))
+
+    for threads in [2, 4, 8, 16]:
+        rate, results = time_threads(acceptor, strings, threads, 0.01)
+        if results != expected:
+            raise AssertionError("the results with {0} threads differ from the results with 1".format(threads))
+        print("{0} threads: {1:.0f} strings per second, {2:.1f}x".format(threads, rate, rate / base_rate))
+
+
+if __name__ == "__main__":
+    main()
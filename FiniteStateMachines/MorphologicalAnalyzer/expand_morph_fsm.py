@@ -1,5 +1,10 @@
 from string import whitespace
+from array import array
+import os
 import sys
+import json
+import hashlib
+import tempfile
 from unittest import TestCase
 
 
@@ -8,6 +13,13 @@ class ExpandMorphFSM:
     This class expands a given FSM of morphosyntactic rules using the given lexicon
     """
 
+    # the first bytes of every compiled FST file
+    magic = b"MORPHFST"
+
+    # the arrays stored in a compiled FST file, in order
+    array_names = ["node_parent", "node_character", "node_name", "node_output", "ending_node", "ending_character",
+                   "ending_state", "ending_output", "arc_state", "arc_character", "arc_next", "arc_output"]
+
     def __init__(self, lexicon, morph_rules):
         """
         Initialize the class by loading the lexicon
@@ -19,12 +31,33 @@ class ExpandMorphFSM:
         self.state_count = 0
         self.label_count = 0
 
+        # the expanded states at the ends of the arcs for each label
+        self.label_arcs = {}
+
+        # the letter trie of the words on the arcs leaving each expanded state, with the root of each state's trie, and
+        # for each trie node its children, the arcs for the words ending after it, the output of all the words through
+        # it (or None if there is more than one), and the name of its expanded state (or None once it's removed)
+        self.roots = {}
+        self.children = []
+        self.endings = []
+        self.outputs = []
+        self.names = []
+
+        # the arcs of each expanded state of the tries, the state for each set of arcs, and the number of trie nodes
+        # with each state, so states that accept the same rest of a word are only added once and removed when unused
+        self.state_arcs = {}
+        self.register = {}
+        self.references = {}
+
+        # the strings and arrays of a compiled FST whose tries haven't been read yet
+        self.compiled = None
+
     @staticmethod
     def load_lexicon(lexicon):
         """
         Load the given lexicon into a dictionary
         :param lexicon: the given lexicon
-        :return: dictionary representation of the lexicon
+        :return: dictionary from each label to a dictionary with its words as keys, in the order they're first seen
         """
         labels = {}
 
@@ -32,7 +65,7 @@ class ExpandMorphFSM:
             if not line.strip():
                 continue
             word_label = line.split()
-            labels.setdefault(word_label[1], []).append(word_label[0])
+            labels.setdefault(word_label[1], {})[word_label[0]] = None
 
         return labels
 
@@ -67,7 +100,8 @@ class ExpandMorphFSM:
 
     def expand_morph_fsm(self):
         """
-        Expand this FSM given the lexicon
+        Expand this FSM given the lexicon, spelling out the words of all the labels on the arcs leaving each state in one
+        letter trie, and merging the states of all the tries that accept the same rest of a word
         :return: void
         """
         state_map = {}
@@ -80,80 +114,446 @@ class ExpandMorphFSM:
                     second_state_name = state_map.setdefault(second_state, self.get_next_state_name(True))
                     if not self.expanded['final_state'] and second_state == self.fsm['final_state']:
                         self.expanded['final_state'] = second_state_name
-                    self.expand_arc(first_state_name, second_state_name, label)
+                    if not label:
+                        self.add_arc(first_state_name, second_state_name, label, '')
+                    else:
+                        self.label_arcs.setdefault(label, []).append((first_state_name, second_state_name))
+
+        nodes = set()
+        for label in self.label_arcs:
+            for word in self.lexicon.get(label, {}):
+                nodes.update(self.insert_word(word, label))
+        self.update_nodes(nodes)
+
+    def add_word(self, word, label):
+        """
+        Add a word to the lexicon and to the expanded FSM, only changing the states on the word's paths, so the expanded
+        FSM stays the same as if it had been expanded with the word
+        :param word: the word
+        :param label: the label of the word
+        :return: void
+        """
+        if word in self.lexicon.get(label, {}):
+            return
+        self.restore_tries()
+        self.lexicon.setdefault(label, {})[word] = None
+        self.update_nodes(self.insert_word(word, label))
+
+    def remove_word(self, word, label):
+        """
+        Remove a word from the lexicon and from the expanded FSM, removing the states only it used
+        :param word: the word
+        :param label: the label of the word
+        :return: void
+        """
+        if word not in self.lexicon.get(label, {}):
+            raise KeyError(word + "/" + label + " is not in the lexicon")
+        self.restore_tries()
+        del self.lexicon[label][word]
+        if not self.lexicon[label]:
+            del self.lexicon[label]
+
+        output = word + "/" + label
+        nodes = set()
+        for first_state, second_state in self.label_arcs.get(label, []):
+            path = self.find_path(first_state, word)
+            if path is None:
+                continue
+            self.endings[path[-1]].discard((word[-1], second_state, output))
+
+            # take the nodes no other word goes through out of the trie
+            for index in range(len(path) - 1, 0, -1):
+                if self.endings[path[index]] or self.children[path[index]]:
+                    break
+                del self.children[path[index - 1]][word[index - 1]]
+            nodes.update(path)
+        self.update_nodes(nodes)
+
+    def restore_tries(self):
+        """
+        Read the tries of a compiled FST from its arrays, if they haven't been read yet
+        :return: void
+        """
+        if self.compiled is None:
+            return
+        strings, arrays = self.compiled
+        self.compiled = None
+
+        self.names = [strings[name] for name in arrays["node_name"]]
+        self.outputs = [strings[output] if output >= 0 else None for output in arrays["node_output"]]
+        self.children = [{} for _ in self.names]
+        self.endings = [set() for _ in self.names]
+        for node, (parent, character) in enumerate(zip(arrays["node_parent"], arrays["node_character"])):
+            if parent < 0:
+                self.roots[self.names[node]] = node
+            else:
+                self.children[parent][strings[character]] = node
+                self.references[self.names[node]] = self.references.get(self.names[node], 0) + 1
+        for node, character, second_state, output in zip(arrays["ending_node"], arrays["ending_character"],
+                                                         arrays["ending_state"], arrays["ending_output"]):
+            self.endings[node].add((strings[character], strings[second_state], strings[output]))
+
+        # the arcs of the states of the tries, which are all the arcs of their states but the epsilon arcs of the rules
+        transitions = self.expanded['transitions']
+        for name in list(self.references) + list(self.roots):
+            arcs = tuple(sorted((character, second_state, output)
+                                for character, state_arcs in transitions.get(name, {}).items() if character
+                                for second_state, output in state_arcs))
+            self.state_arcs[name] = arcs
+            if name not in self.roots:
+                self.register[arcs] = name
+
+    def find_path(self, first_state, word):
+        """
+        Find the trie nodes for the letters of the word before the last, starting from the root of the state's trie
+        :param first_state: the expanded state the trie is rooted at
+        :param word: the word
+        :return: list of the trie nodes, or None if the word isn't in the trie
+        """
+        if first_state not in self.roots:
+            return None
+        path = [self.roots[first_state]]
+        for character in word[:-1]:
+            if character not in self.children[path[-1]]:
+                return None
+            path.append(self.children[path[-1]][character])
+        return path
+
+    def insert_word(self, word, label):
+        """
+        Insert the word into the tries of the states with arcs for its label, without changing the expanded FSM
+        :param word: the word
+        :param label: the label of the word
+        :return: list of the trie nodes the word goes through
+        """
+        output = word + "/" + label
+        nodes = []
+        for first_state, second_state in self.label_arcs.get(label, []):
+            if first_state not in self.roots:
+                self.roots[first_state] = self.new_node(first_state)
+            node = self.roots[first_state]
+            nodes.append(node)
+            for character in word[:-1]:
+                if character not in self.children[node]:
+                    self.children[node][character] = self.new_node()
+                node = self.children[node][character]
+                nodes.append(node)
+            self.endings[node].add((word[-1], second_state, output))
+        return nodes
+
+    def new_node(self, name=None):
+        """
+        Add a node to the tries
+        :param name: the name of the node's expanded state, if it is already known
+        :return: the index of the new node
+        """
+        self.children.append({})
+        self.endings.append(set())
+        self.outputs.append(None)
+        self.names.append(name)
+        return len(self.names) - 1
 
-    def expand_arc(self, first_state, second_state, label):
+    def update_nodes(self, nodes):
         """
-        Expand this arc from the FSM
-        :param first_state: the origin state
-        :param second_state: the destination state
-        :param label: the label of the arc
+        Update the expanded states of the given trie nodes and of their parents. The children always come after their
+        parents, so the nodes are updated from the leaves up, each after all the nodes it has arcs to
+        :param nodes: the trie nodes that have changed
         :return: void
         """
-        if not label:
-            self.add_arc(first_state, second_state, label, '')
+        for node in sorted(nodes, reverse=True):
+            self.update_node(node)
+
+    def update_node(self, node):
+        """
+        Find the arcs of the expanded state for a trie node, and change the node to the state with those arcs. The last
+        letter of each word goes straight to the state the word's arc went to, and the word and its label are output on
+        the first arc after which no other word can follow, so the rest of each word can be shared with other words
+        :param node: the trie node
+        :return: void
+        """
+        root = self.names[node] in self.roots
+        if not root and not self.endings[node] and not self.children[node]:
+            # no words go through the node any more
+            if self.names[node] is not None:
+                self.release_state(self.names[node])
+            self.names[node] = None
             return
-        for word in self.lexicon[label]:
-            if len(word) is 1:
-                self.add_arc(first_state, second_state, word[0], word + "/" + label + " ")
-                return
-            second_state_name = self.get_next_state_name(False)
-            second_state_name = self.add_arc(first_state, second_state_name, word[0], '')
-            for index in range(1, len(word)-1):
-                first_state_name = second_state_name
-                second_state_name = self.get_next_state_name(False)
-                second_state_name = self.add_arc(first_state_name, second_state_name, word[index], '')
-            self.add_arc(second_state_name, second_state, word[-1], word + "/" + label + " ")
+
+        outputs = {output for _, _, output in self.endings[node]}
+        outputs.update(self.outputs[child] for child in self.children[node].values())
+        self.outputs[node] = outputs.pop() if len(outputs) == 1 else None
+
+        # the output is only written on the arcs from the root or from a state that more than one word goes through
+        written = not root and self.outputs[node] is not None
+        arcs = [(character, second_state, '' if written else output)
+                for character, second_state, output in self.endings[node]]
+        arcs += [(character, self.names[child], self.outputs[child] if not written and self.outputs[child] is not None
+                  else '') for character, child in self.children[node].items()]
+        arcs = tuple(sorted(arcs))
+
+        if root:
+            old_arcs = self.state_arcs.get(self.names[node], ())
+            for arc in set(old_arcs) - set(arcs):
+                self.remove_arc(self.names[node], arc[1], arc[0], arc[2])
+            for arc in arcs:
+                self.add_arc(self.names[node], arc[1], arc[0], arc[2])
+            self.state_arcs[self.names[node]] = arcs
+        elif self.names[node] is None or self.state_arcs[self.names[node]] != arcs:
+            if self.names[node] is not None:
+                self.release_state(self.names[node])
+            self.names[node] = self.acquire_state(arcs)
+
+    def acquire_state(self, arcs):
+        """
+        Get the expanded state with the given arcs, adding it if there isn't one
+        :param arcs: sorted tuple of the arcs, each a tuple of the character, the destination state and the output
+        :return: the name of the state
+        """
+        if arcs in self.register:
+            name = self.register[arcs]
+            self.references[name] += 1
+            return name
+
+        name = self.register[arcs] = self.get_next_state_name(False)
+        self.state_arcs[name] = arcs
+        self.references[name] = 1
+        for character, second_state, output in arcs:
+            self.add_arc(name, second_state, character, output)
+        return name
+
+    def release_state(self, name):
+        """
+        Stop using the given expanded state for one trie node, removing it once no trie node uses it
+        :param name: the name of the state
+        :return: void
+        """
+        self.references[name] -= 1
+        if not self.references[name]:
+            del self.register[self.state_arcs[name]]
+            del self.state_arcs[name]
+            del self.references[name]
+            del self.expanded['transitions'][name]
 
     def add_arc(self, first_state, second_state, character, output):
         """
-        Add an arc to the expanded FSM
+        Add an arc to the expanded FSM, if it doesn't already exist
         :param first_state: the origin state of the arc
         :param second_state: the destination state of the arc
         :param character: the input character for the arc
         :param output: the output character for the arc
-        :return: the name of the destination state
+        :return: void
         """
-        self.expanded['transitions'].setdefault(first_state, {}).setdefault(character, '')
-        # only add the arc it it doesn't already exist
-        if not self.expanded['transitions'][first_state][character]:
-            self.expanded['transitions'][first_state][character] = (second_state, output)
+        arcs = self.expanded['transitions'].setdefault(first_state, {}).setdefault(character, [])
+        if (second_state, output) not in arcs:
+            arcs.append((second_state, output))
 
-        # if it exists but ends at a final state, insert a new state and an epsilon transition to the final state
-        elif self.expanded['transitions'][first_state][character][0] in self.expanded['final_state']:
-            old_value = self.expanded['transitions'][first_state][character]
-            self.expanded['transitions'][first_state][character] = (second_state, output)
+    def remove_arc(self, first_state, second_state, character, output):
+        """
+        Remove an arc from the expanded FSM, and the origin state's arcs if it has none left, as if it never had any
+        :param first_state: the origin state of the arc
+        :param second_state: the destination state of the arc
+        :param character: the input character for the arc
+        :param output: the output character for the arc
+        :return: void
+        """
+        arcs = self.expanded['transitions'][first_state][character]
+        arcs.remove((second_state, output))
+        if not arcs:
+            del self.expanded['transitions'][first_state][character]
+            if not self.expanded['transitions'][first_state]:
+                del self.expanded['transitions'][first_state]
+
+    def save(self, filename, source_hash=""):
+        """
+        Write the expanded FSM and its tries to the given file, replacing it atomically. The strings are written once in
+        a JSON header, and the trie nodes, word endings and arcs as arrays of their ids
+        :param filename: the compiled FST file
+        :param source_hash: the hash of the lexicon and morphological rules the FSM was expanded from
+        :return: void
+        """
+        self.restore_tries()
+
+        strings = {}
+        arrays = {name: array('i') for name in self.array_names}
+
+        # the removed nodes are left out, and the rest keep their order, so children still come after their parents
+        nodes = [node for node in range(len(self.names)) if self.names[node] is not None]
+        index = {node: new_node for new_node, node in enumerate(nodes)}
+        parents = {}
+        for node in nodes:
+            for character, child in self.children[node].items():
+                parents[child] = (index[node], strings.setdefault(character, len(strings)))
+
+        for node in nodes:
+            parent, character = parents.get(node, (-1, -1))
+            arrays["node_parent"].append(parent)
+            arrays["node_character"].append(character)
+            arrays["node_name"].append(strings.setdefault(self.names[node], len(strings)))
+            output = self.outputs[node]
+            arrays["node_output"].append(-1 if output is None else strings.setdefault(output, len(strings)))
+            for character, second_state, output in self.endings[node]:
+                arrays["ending_node"].append(index[node])
+                arrays["ending_character"].append(strings.setdefault(character, len(strings)))
+                arrays["ending_state"].append(strings.setdefault(second_state, len(strings)))
+                arrays["ending_output"].append(strings.setdefault(output, len(strings)))
 
-            self.expanded['transitions'].setdefault(second_state, {}).setdefault('', '')
-            self.expanded['transitions'][second_state][''] = old_value
+        for first_state in self.expanded['transitions']:
+            for character in self.expanded['transitions'][first_state]:
+                for second_state, output in self.expanded['transitions'][first_state][character]:
+                    arrays["arc_state"].append(strings.setdefault(first_state, len(strings)))
+                    arrays["arc_character"].append(strings.setdefault(character, len(strings)))
+                    arrays["arc_next"].append(strings.setdefault(second_state, len(strings)))
+                    arrays["arc_output"].append(strings.setdefault(output, len(strings)))
+
+        header = json.dumps({"hash": source_hash, "fsm": self.fsm,
+                             "lexicon": {label: list(words) for label, words in self.lexicon.items()},
+                             "start_state": self.expanded['start_state'], "final_state": self.expanded['final_state'],
+                             "state_count": self.state_count, "label_count": self.label_count,
+                             "label_arcs": self.label_arcs, "strings": list(strings), "byteorder": sys.byteorder,
+                             "arrays": {name: len(arrays[name]) for name in self.array_names}}).encode("utf-8")
+
+        directory = os.path.dirname(os.path.abspath(filename))
+        with tempfile.NamedTemporaryFile("wb", dir=directory, delete=False) as f:
+            f.write(self.magic)
+            f.write(len(header).to_bytes(8, "little"))
+            f.write(header)
+            for name in self.array_names:
+                arrays[name].tofile(f)
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, filename)
 
-        return self.expanded['transitions'][first_state][character][0]
+    @staticmethod
+    def read_header(f):
+        """
+        Read the header of a compiled FST file
+        :param f: the compiled FST file, opened in binary mode
+        :return: the header dictionary, or None if the file isn't a compiled FST
+        """
+        if f.read(len(ExpandMorphFSM.magic)) != ExpandMorphFSM.magic:
+            return None
+        length = int.from_bytes(f.read(8), "little")
+        return json.loads(f.read(length).decode("utf-8"))
+
+    @staticmethod
+    def open(filename):
+        """
+        Read a compiled FST file, without expanding the FSM again
+        :param filename: the compiled FST file
+        :return: the ExpandMorphFSM, which can still have words added and removed, its tries being read the first time
+        """
+        with open(filename, "rb") as f:
+            header = ExpandMorphFSM.read_header(f)
+            if header is None:
+                raise ValueError(filename + " is not a compiled FST")
+
+            arrays = {}
+            for name in ExpandMorphFSM.array_names:
+                arrays[name] = array('i')
+                arrays[name].fromfile(f, header["arrays"][name])
+                if header["byteorder"] != sys.byteorder:
+                    arrays[name].byteswap()
+
+        strings = header["strings"]
+        expander = ExpandMorphFSM([], [])
+        expander.fsm = header["fsm"]
+        expander.lexicon = {label: dict.fromkeys(words) for label, words in header["lexicon"].items()}
+        expander.expanded['start_state'] = header["start_state"]
+        expander.expanded['final_state'] = header["final_state"]
+        expander.state_count = header["state_count"]
+        expander.label_count = header["label_count"]
+        expander.label_arcs = {label: [tuple(arc) for arc in arcs] for label, arcs in header["label_arcs"].items()}
+
+        transitions = expander.expanded['transitions']
+        for first_state, character, second_state, output in zip(arrays["arc_state"], arrays["arc_character"],
+                                                                arrays["arc_next"], arrays["arc_output"]):
+            transitions.setdefault(strings[first_state], {}).setdefault(strings[character], []).append(
+                (strings[second_state], strings[output]))
+
+        # the tries are only needed to add or remove words, so they are only read from the arrays then
+        expander.compiled = (strings, arrays)
+
+        return expander
+
+    @staticmethod
+    def hash_files(*filenames):
+        """
+        Hash the contents of the given files together
+        :param filenames: the files to hash
+        :return: the hex digest of the files
+        """
+        digest = hashlib.sha256()
+        for filename in filenames:
+            with open(filename, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def load(lexicon_filename, morph_rules_filename, compiled_file=None):
+        """
+        Load the compiled FST for the given lexicon and morphological rules, expanding the FSM and compiling it first if
+        there is no compiled file or if the lexicon or rules have changed since it was compiled
+        :param lexicon_filename: the lexicon file
+        :param morph_rules_filename: the morphological rules file
+        :param compiled_file: the compiled FST file, by default the lexicon file with a .compiled extension
+        :return: the ExpandMorphFSM
+        """
+        compiled_file = compiled_file or lexicon_filename + ".compiled"
+        source_hash = ExpandMorphFSM.hash_files(lexicon_filename, morph_rules_filename)
+
+        if os.path.exists(compiled_file):
+            with open(compiled_file, "rb") as f:
+                header = ExpandMorphFSM.read_header(f)
+            if header is not None and header["hash"] == source_hash:
+                return ExpandMorphFSM.open(compiled_file)
+
+        with open(lexicon_filename, "r") as lexicon_file:
+            lexicon = lexicon_file.readlines()
+
+        with open(morph_rules_filename, "r") as morph_rules_file:
+            morph_rules = morph_rules_file.readlines()
+
+        expander = ExpandMorphFSM(lexicon, morph_rules)
+        expander.expand_morph_fsm()
+        try:
+            expander.save(compiled_file, source_hash)
+        except OSError:
+            # the expanded FSM can still be used if the compiled file can't be written
+            pass
+
+        return expander
+
+    def size(self):
+        """
+        Count the states and arcs of the expanded FSM
+        :return: tuple of the number of states and the number of arcs
+        """
+        states = set(self.expanded['transitions'])
+        arcs = 0
+        for first_state in self.expanded['transitions']:
+            for character in self.expanded['transitions'][first_state]:
+                for second_state, _ in self.expanded['transitions'][first_state][character]:
+                    states.add(second_state)
+                    arcs += 1
+        return len(states), arcs
 
     def print_in_carmel_format(self):
         """
         Print the FSM in carmel format
         :return: a string representation of the FSM in carmel format
         """
-        output_string = ""
-        output_string += self.expanded['final_state'] + "\n"
+        lines = [self.expanded['final_state']]
         start_state = self.expanded['start_state']
 
-        for character in self.expanded['transitions'][start_state]:
-            second_state = self.expanded['transitions'][start_state][character][0]
-            output = self.expanded['transitions'][start_state][character][1]
-            input_char = " \"" + character + "\"" if character else " *e*"
-            output_char = " \"" + output.strip() + "\"" if output.strip() else " *e*"
-            output_string += "(" + start_state + " (" + second_state + input_char + output_char + "))\n"
-
-        for first_state in self.expanded['transitions']:
-            if first_state != start_state:
-                for character in self.expanded['transitions'][first_state]:
-                    second_state = self.expanded['transitions'][first_state][character][0]
-                    output = self.expanded['transitions'][first_state][character][1]
+        # the start state's arcs come first, since carmel takes the start state from the first arc
+        first_states = [start_state] + [state for state in self.expanded['transitions'] if state != start_state]
+        for first_state in first_states:
+            for character in self.expanded['transitions'].get(first_state, {}):
+                for second_state, output in self.expanded['transitions'][first_state][character]:
                     input_char = " \"" + character + "\"" if character else " *e*"
                     output_char = " \"" + output.strip() + "\"" if output.strip() else " *e*"
-                    output_string += "(" + first_state + " (" + second_state + input_char + output_char + "))\n"
-        return output_string.strip()
+                    lines.append("(" + first_state + " (" + second_state + input_char + output_char + "))")
+        return "\n".join(lines)
 
     def get_next_state_name(self, is_label):
         """
@@ -196,7 +596,122 @@ class TestExpandFSM(TestCase):
         with open('./TestFiles/FST', "r") as expected_output:
             expected_list = expected_output.readlines()
 
-        self.assertEqual(len(expected_list), len(output_list))
+        self.assertCountEqual([line.strip("\n") for line in expected_list], output_list)
+
+    def test_shared_states(self):
+        """
+        Tests that the words share the states for their common prefixes and suffixes, and that words going to more than
+        one state keep all their arcs
+        :return: void
+        """
+        lexicon = ["walk stem", "talk stem", "ed past", "s 3sg"]
+        morph_rules = ["q2", "(q0 (q1 stem))", "(q0 (q2 stem))", "(q1 (q2 past))", "(q1 (q2 3sg))"]
+
+        expander = ExpandMorphFSM(lexicon, morph_rules)
+        expander.expand_morph_fsm()
+
+        expected = ['label_3',
+                    '(label_1 (q4 "t" "talk/stem"))',
+                    '(label_1 (q4 "w" "walk/stem"))',
+                    '(q1 (label_3 "d" *e*))',
+                    '(label_2 (q1 "e" "ed/past"))',
+                    '(label_2 (label_3 "s" "s/3sg"))',
+                    '(q2 (label_2 "k" *e*))',
+                    '(q2 (label_3 "k" *e*))',
+                    '(q3 (q2 "l" *e*))',
+                    '(q4 (q3 "a" *e*))']
+
+        self.assertEqual(expected, expander.print_in_carmel_format().split("\n"))
+        self.assertEqual((7, 9), expander.size())
+
+    def test_add_remove_words(self):
+        """
+        Tests that adding and removing words gives the same FSM as expanding the lexicon with or without them
+        :return: void
+        """
+        with open('./TestFiles/lexicon', "r") as lexicon:
+            test_lexicon = lexicon.readlines()
+
+        with open('./TestFiles/morph_rules', "r") as morph_rules:
+            test_morph_rules = morph_rules.readlines()
+
+        words = [("spoken", "irreg_past_verb_form"), ("talk", "reg_verb_stem"), ("ing", "pres_part")]
+        partial_lexicon = [line for line in test_lexicon if tuple(line.split()) not in words]
+
+        expander = ExpandMorphFSM(test_lexicon, test_morph_rules)
+        expander.expand_morph_fsm()
+
+        partial_expander = ExpandMorphFSM(partial_lexicon, test_morph_rules)
+        partial_expander.expand_morph_fsm()
+
+        edited = ExpandMorphFSM(partial_lexicon, test_morph_rules)
+        edited.expand_morph_fsm()
+        for word, label in words:
+            edited.add_word(word, label)
+
+        self.assertEqual(expander.size(), edited.size())
+        self.assertEqual(expander.lexicon, edited.lexicon)
+
+        for word, label in words:
+            edited.remove_word(word, label)
+
+        self.assertEqual(partial_expander.size(), edited.size())
+        self.assertEqual(partial_expander.lexicon, edited.lexicon)
+        self.assertRaises(KeyError, edited.remove_word, "talk", "reg_verb_stem")
+
+        # removing every word of a label leaves no arcs from the states its arcs start at
+        fsm_rules = ['2', '(0 (1 A))', '(1 (2 *e*))']
+        edited = ExpandMorphFSM(['ab A', 'cd B'], fsm_rules + ['(0 (1 B))', '(1 (3 A))'])
+        edited.expand_morph_fsm()
+        edited.remove_word("ab", "A")
+        edited.remove_word("cd", "B")
+        empty_expander = ExpandMorphFSM([], fsm_rules + ['(0 (1 B))', '(1 (3 A))'])
+        empty_expander.expand_morph_fsm()
+        self.assertEqual((2, 1), edited.size())
+        self.assertEqual(empty_expander.size(), edited.size())
+        self.assertEqual(empty_expander.print_in_carmel_format(), edited.print_in_carmel_format())
+
+    def test_save_open(self):
+        """
+        Tests writing the expanded FSM to a compiled file and reading it back
+        :return: void
+        """
+        with open('./TestFiles/lexicon', "r") as lexicon:
+            test_lexicon = lexicon.readlines()
+
+        with open('./TestFiles/morph_rules', "r") as morph_rules:
+            test_morph_rules = morph_rules.readlines()
+
+        expander = ExpandMorphFSM(test_lexicon, test_morph_rules)
+        expander.expand_morph_fsm()
+
+        with tempfile.TemporaryDirectory() as directory:
+            compiled_file = os.path.join(directory, "fst.compiled")
+            expander.save(compiled_file)
+            compiled = ExpandMorphFSM.open(compiled_file)
+
+            self.assertEqual(expander.print_in_carmel_format(), compiled.print_in_carmel_format())
+            self.assertEqual(expander.lexicon, compiled.lexicon)
+
+            expander.add_word("eat", "irreg_verb_stem")
+            compiled.add_word("eat", "irreg_verb_stem")
+            self.assertEqual(expander.print_in_carmel_format(), compiled.print_in_carmel_format())
+
+            # the lexicon and rules are only expanded again if they change
+            lexicon_filename = os.path.join(directory, "lexicon")
+            with open(lexicon_filename, "w") as lexicon:
+                lexicon.writelines(test_lexicon)
+
+            loaded = ExpandMorphFSM.load(lexicon_filename, './TestFiles/morph_rules')
+            self.assertIsNone(loaded.compiled)
+            loaded = ExpandMorphFSM.load(lexicon_filename, './TestFiles/morph_rules')
+            self.assertIsNotNone(loaded.compiled)
+
+            with open(lexicon_filename, "a") as lexicon:
+                lexicon.write("\neat irreg_verb_stem\n")
+            loaded = ExpandMorphFSM.load(lexicon_filename, './TestFiles/morph_rules')
+            self.assertIsNone(loaded.compiled)
+            self.assertEqual(expander.size(), loaded.size())
 
 
 def main():
@@ -0,0 +1,209 @@
+import sys
+import argparse
+from unittest import TestCase
+from expand_morph_fsm import ExpandMorphFSM
+
+
+class MorphAnalyzer:
+    """
+    This class analyzes words with an FST expanded from morphological rules and a lexicon by ExpandMorphFSM
+    """
+
+    def __init__(self, expanded):
+        """
+        Initialize the class with the expanded FST
+        :param expanded: the expanded FST of an ExpandMorphFSM, a dictionary of its start state, final state and arcs
+        """
+        self.start_state = expanded['start_state']
+        self.final_state = expanded['final_state']
+        self.transitions = expanded['transitions']
+
+    @classmethod
+    def from_files(cls, lexicon, morph_rules):
+        """
+        Expand the morphological rules with the lexicon and load the resulting FST
+        :param lexicon: the lines of the lexicon
+        :param morph_rules: the lines of the morphological rules FSM
+        :return: tuple of the MorphAnalyzer and the ExpandMorphFSM
+        """
+        expander = ExpandMorphFSM(lexicon, morph_rules)
+        expander.expand_morph_fsm()
+        return cls(expander.expanded), expander
+
+    def follow_epsilons(self, states):
+        """
+        Add the states that can be reached from the given states with epsilon arcs, keeping the first output found for
+        each state
+        :param states: dictionary from each state to the tuple of outputs on the way to it
+        :return: void
+        """
+        stack = list(states)
+        while stack:
+            state = stack.pop()
+            for next_state, output in self.transitions.get(state, {}).get('', []):
+                if next_state not in states:
+                    states[next_state] = states[state] + (output,) if output else states[state]
+                    stack.append(next_state)
+
+    def analyze(self, word):
+        """
+        Analyze the word by reading it one character at a time, moving from all the states the FST could be in to the
+        next, keeping one output for each state so each character takes time proportional to the number of states
+        :param word: the word to analyze
+        :return: list of the morphemes with their labels, or None if the word isn't accepted
+        """
+        states = {self.start_state: ()}
+        self.follow_epsilons(states)
+
+        for character in word:
+            next_states = {}
+            for state, outputs in states.items():
+                for next_state, output in self.transitions.get(state, {}).get(character, []):
+                    if next_state not in next_states:
+                        next_states[next_state] = outputs + (output,) if output else outputs
+            if not next_states:
+                return None
+
+            states = next_states
+            self.follow_epsilons(states)
+
+        if self.final_state not in states:
+            return None
+        return list(states[self.final_state])
+
+    def analyze_many(self, words):
+        """
+        Analyze each of the words, one at a time
+        :param words: iterable of words, with or without newlines
+        :return: generator of "word => analysis" lines, with *NONE* as the analysis if the word isn't accepted
+        """
+        for word in words:
+            word = word.strip()
+            morphemes = self.analyze(word)
+            yield word + " => " + (" ".join(morphemes) if morphemes is not None else "*NONE*")
+
+
+def write_analyses(analyzer, word_file, output_file):
+    """
+    Write the analysis of each word in the word file as soon as it's read, skipping blank lines
+    :param analyzer: the MorphAnalyzer
+    :param word_file: the file of words, one per line
+    :param output_file: the file to write the "word => analysis" lines to
+    :return: void
+    """
+    for line in analyzer.analyze_many(word for word in word_file if word.strip()):
+        print(line, file=output_file, flush=True)
+
+
+class TestMorphAnalyzer(TestCase):
+    """
+    This class contains tests for the MorphAnalyzer class
+    """
+
+    maxDiff = None
+
+    def test_analyze(self):
+        """
+        Tests analyzing single words
+        :return: void
+        """
+        with open('./TestFiles/lexicon', "r") as lexicon:
+            test_lexicon = lexicon.readlines()
+
+        with open('./TestFiles/morph_rules', "r") as morph_rules:
+            test_morph_rules = morph_rules.readlines()
+
+        analyzer, _ = MorphAnalyzer.from_files(test_lexicon, test_morph_rules)
+
+        self.assertEqual(["walk/reg_verb_stem", "ing/pres_part"], analyzer.analyze("walking"))
+        self.assertEqual(["spoke/irreg_past_verb_form"], analyzer.analyze("spoke"))
+        self.assertEqual(["spoken/irreg_past_verb_form"], analyzer.analyze("spoken"))
+        self.assertEqual(["impeach/reg_verb_stem"], analyzer.analyze("impeach"))
+        self.assertIsNone(analyzer.analyze("spoked"))
+        self.assertIsNone(analyzer.analyze("spo"))
+        self.assertIsNone(analyzer.analyze(""))
+
+    def test_add_remove_words(self):
+        """
+        Tests that words added to or removed from the expanded FST are analyzed right away
+        :return: void
+        """
+        with open('./TestFiles/lexicon', "r") as lexicon:
+            test_lexicon = lexicon.readlines()
+
+        with open('./TestFiles/morph_rules', "r") as morph_rules:
+            test_morph_rules = morph_rules.readlines()
+
+        analyzer, expander = MorphAnalyzer.from_files(test_lexicon, test_morph_rules)
+        self.assertIsNone(analyzer.analyze("eating"))
+
+        expander.add_word("eat", "irreg_verb_stem")
+        self.assertEqual(["eat/irreg_verb_stem", "ing/pres_part"], analyzer.analyze("eating"))
+        self.assertEqual(["eaten/irreg_past_verb_form"], analyzer.analyze("eaten"))
+
+        expander.remove_word("eaten", "irreg_past_verb_form")
+        self.assertIsNone(analyzer.analyze("eaten"))
+        self.assertEqual(["eat/irreg_verb_stem", "s/3sg"], analyzer.analyze("eats"))
+
+    def test_word_list(self):
+        """
+        Tests analyzing the word list
+        :return: void
+        """
+        with open('./TestFiles/lexicon', "r") as lexicon:
+            test_lexicon = lexicon.readlines()
+
+        with open('./TestFiles/morph_rules', "r") as morph_rules:
+            test_morph_rules = morph_rules.readlines()
+
+        analyzer, _ = MorphAnalyzer.from_files(test_lexicon, test_morph_rules)
+
+        with open('./TestFiles/word_list', "r") as word_list:
+            output_list = list(analyzer.analyze_many(word for word in word_list if word.strip()))
+
+        with open('./TestFiles/analyses', "r") as expected_output:
+            expected_list = [line.strip("\n") for line in expected_output]
+
+        self.assertEqual(expected_list, output_list)
+
+
+def main():
+    """
+    Parse the system arguments, expand the morphological rules with the lexicon, and write the analysis of each word to
+    stdout as it's read
+    :return: void
+    """
+    arg_parser = argparse.ArgumentParser(description="Analyze words with morphological rules and a lexicon")
+    arg_parser.add_argument("lexicon", help="a file where each line is a morpheme followed by a label")
+    arg_parser.add_argument("morph_rules", help="an FSM file in Carmel format of the morphological rules for the labels")
+    arg_parser.add_argument("word_list", nargs="?", default="-", help="a file of words, one per line (stdin by default)")
+    arg_parser.add_argument("--fst", help="also write the expanded FST to this file in Carmel format")
+    arg_parser.add_argument("--compiled", help="load the expanded FST from this compiled file if it was built from the "
+                                               "same lexicon and rules, or write it there")
+    args = arg_parser.parse_args()
+
+    if args.compiled:
+        expander = ExpandMorphFSM.load(args.lexicon, args.morph_rules, args.compiled)
+        analyzer = MorphAnalyzer(expander.expanded)
+    else:
+        with open(args.lexicon, "r") as lexicon_file:
+            lexicon = lexicon_file.readlines()
+
+        with open(args.morph_rules, "r") as morph_rules_file:
+            morph_rules = morph_rules_file.readlines()
+
+        analyzer, expander = MorphAnalyzer.from_files(lexicon, morph_rules)
+
+    if args.fst:
+        with open(args.fst, "w") as fst_file:
+            print(expander.print_in_carmel_format(), file=fst_file)
+
+    if args.word_list == "-":
+        write_analyses(analyzer, sys.stdin, sys.stdout)
+    else:
+        with open(args.word_list, "r") as word_file:
+            write_analyses(analyzer, word_file, sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,36 @@
 from string import whitespace
+import argparse
 import sys
+from collections import deque
 from unittest import TestCase
 
 
 class NFAtoDFA:
 
-    dfa = {'start_state': '', 'final_state': '', 'transitions': {}}
-    vocabulary = []
-    final_states = []
-
     def __init__(self, nfa_rules):
         """
         Initialize the class by loading the FSA
         :param nfa_rules: a description of an FSA
         """
+        # the symbols on the arcs of the NFA, in the order they're first seen
+        self.vocabulary = []
+
         self.nfa = self.load_nfa(nfa_rules)
 
+        # the epsilon closure of each NFA state, including the state itself
+        self.closures = {}
+
+        # the NFA states with arcs for symbols other than epsilon
+        self.labeled_states = frozenset(state for state, arcs in self.nfa['transitions'].items()
+                                        if any(character != '' for character in arcs))
+
+        # the set of NFA states in each DFA state, indexed by the DFA state's id, and the id of each set
+        self.dfa_states = []
+        self.dfa_ids = {}
+
+        # the DFA, with its states as ids
+        self.dfa = {'start_state': None, 'final_states': [], 'transitions': {}}
+
     def load_nfa(self, nfa_rules):
         """
         Load the given NFA into a dictionary
@@ -23,6 +38,7 @@ class NFAtoDFA:
         :return: dictionary representation of the NFA
         """
         nfa = {'start_state': '', 'final_state': '', 'transitions': {}}
+        vocabulary = set(self.vocabulary)
 
         for line in nfa_rules:
             rule = line.strip().split()
@@ -41,7 +57,8 @@ class NFAtoDFA:
                 if "*e*" in arc_output:
                     arc_output = ''
 
-                if arc_output not in self.vocabulary and arc_output != '':
+                if arc_output != '' and arc_output not in vocabulary:
+                    vocabulary.add(arc_output)
                     self.vocabulary.append(arc_output)
 
                 if nfa['start_state'] == '':
@@ -56,80 +73,188 @@ class NFAtoDFA:
 
     def convert_nfa_to_dfa(self):
         """
-        Convert the NFA to a DFA
+        Convert the NFA to a DFA with the subset construction, adding each new set of NFA states to a worklist instead of
+        recursing, so NFAs of any size can be converted
         :return: void
         """
-        start_states = self.epsilon_closure(self.nfa['start_state'], [self.nfa['start_state']])
-        self.dfa['start_state'] = "-".join(sorted(start_states))
-        self.add_new_states(start_states)
-        if len(self.final_states) == 1:
-            self.dfa['final_state'] = self.final_states[0]
-        else:
-            self.dfa['final_state'] = 'FinalState'
-            for final_state in self.final_states:
-                self.dfa['transitions'][final_state] = {}
-                self.dfa['transitions'][final_state][''] = 'FinalState'
+        self.dfa['start_state'] = self.dfa_state(self.closure(self.nfa['start_state']))
+        worklist = deque([self.dfa['start_state']])
+
+        while worklist:
+            dfa_state = worklist.popleft()
+            states = self.dfa_states[dfa_state]
+            self.dfa['transitions'][dfa_state] = {}
 
-    def add_new_states(self, states):
+            if self.nfa['final_state'] in states:
+                self.dfa['final_states'].append(dfa_state)
+
+            labeled_states = states & self.labeled_states
+            for character in self.vocabulary:
+                next_states = set()
+                for state in labeled_states:
+                    for next_state in self.nfa['transitions'].get(state, {}).get(character, []):
+                        next_states |= self.closure(next_state)
+
+                if not next_states:
+                    continue
+
+                next_states = frozenset(next_states)
+                if next_states not in self.dfa_ids:
+                    worklist.append(self.dfa_state(next_states))
+                self.dfa['transitions'][dfa_state][character] = self.dfa_ids[next_states]
+
+    def minimize(self):
         """
-        Add a new state to the DFA
-        :param states: an array of states
+        Minimize the DFA with Hopcroft's algorithm, merging the states that accept the same strings and removing the
+        states that can't reach a final state. Each merged state keeps the id order and NFA states of the first state in
+        it, so the start state is still 0
         :return: void
         """
-        for character in self.vocabulary:
-            next_states = []
-            for state in states:
-                next_states = list(set(self.epsilon_closure(state, []) + next_states))
-                if state in self.nfa['transitions'] and character in self.nfa['transitions'][state]:
-                    for next_state in self.nfa['transitions'][state][character]:
-                        epsilon_closure_states = self.epsilon_closure(next_state, [next_state])
-                        next_states = list(set(epsilon_closure_states + next_states))
-
-            first_state = "-".join(sorted(states))
-            second_state = "-".join(sorted(next_states))
-            if first_state not in self.dfa['transitions']:
-                self.dfa['transitions'][first_state] = {}
-            if next_states:
-                self.dfa['transitions'][first_state][character] = second_state
-            if self.nfa['final_state'] in next_states and second_state not in self.final_states:
-                self.final_states.append(second_state)
-            if second_state not in self.dfa['transitions']:
-                self.add_new_states(next_states)
+        # the missing arcs go to an extra dead state, which has arcs to itself for every character
+        dead = len(self.dfa_states)
+        inverse = {character: {} for character in self.vocabulary}
+        for dfa_state in range(dead + 1):
+            arcs = self.dfa['transitions'].get(dfa_state, {})
+            for character in self.vocabulary:
+                inverse[character].setdefault(arcs.get(character, dead), []).append(dfa_state)
+
+        final_states = set(self.dfa['final_states'])
+        blocks = [block for block in [set(final_states), set(range(dead + 1)) - final_states] if block]
+        block_of = [0] * (dead + 1)
+        for index, block in enumerate(blocks):
+            for dfa_state in block:
+                block_of[dfa_state] = index
+
+        worklist = list(range(len(blocks)))
+        in_worklist = set(worklist)
+
+        while worklist:
+            splitter = worklist.pop()
+            in_worklist.discard(splitter)
+            splitter_states = list(blocks[splitter])
+
+            for character in self.vocabulary:
+                # the states in each block with an arc into the splitter on this character
+                predecessors = {}
+                for dfa_state in splitter_states:
+                    for previous_state in inverse[character].get(dfa_state, []):
+                        predecessors.setdefault(block_of[previous_state], set()).add(previous_state)
+
+                for index, split in predecessors.items():
+                    if len(split) == len(blocks[index]):
+                        continue
+
+                    new_index = len(blocks)
+                    blocks.append(split)
+                    blocks[index] -= split
+                    for dfa_state in split:
+                        block_of[dfa_state] = new_index
+
+                    if index in in_worklist or len(split) <= len(blocks[index]):
+                        worklist.append(new_index)
+                        in_worklist.add(new_index)
+                    else:
+                        worklist.append(index)
+                        in_worklist.add(index)
+
+        # number the blocks in the order their first states were found, leaving out the dead states
+        dead_block = block_of[dead] if block_of[dead] != block_of[self.dfa['start_state']] else None
+        ids = {}
+        dfa_states = []
+        for dfa_state, states in enumerate(self.dfa_states):
+            if block_of[dfa_state] != dead_block and block_of[dfa_state] not in ids:
+                ids[block_of[dfa_state]] = len(dfa_states)
+                dfa_states.append(dfa_state)
+
+        transitions = {}
+        for new_state, dfa_state in enumerate(dfa_states):
+            transitions[new_state] = {character: ids[block_of[next_state]]
+                                      for character, next_state in self.dfa['transitions'][dfa_state].items()
+                                      if block_of[next_state] != dead_block}
+
+        self.dfa = {'start_state': ids[block_of[self.dfa['start_state']]],
+                    'final_states': sorted({ids[block_of[dfa_state]] for dfa_state in self.dfa['final_states']}),
+                    'transitions': transitions}
+        self.dfa_states = [self.dfa_states[dfa_state] for dfa_state in dfa_states]
+        self.dfa_ids = {states: dfa_state for dfa_state, states in enumerate(self.dfa_states)}
+
+    def size(self):
+        """
+        Count the states and arcs of the DFA
+        :return: tuple of the number of states and the number of arcs
+        """
+        return len(self.dfa['transitions']), sum(len(arcs) for arcs in self.dfa['transitions'].values())
+
+    def dfa_state(self, states):
+        """
+        Add a new DFA state for the given set of NFA states
+        :param states: frozen set of NFA states
+        :return: the id of the new DFA state
+        """
+        self.dfa_ids[states] = len(self.dfa_states)
+        self.dfa_states.append(states)
+        return self.dfa_ids[states]
+
+    def closure(self, state):
+        """
+        Get the epsilon closure for the given state, including the state itself, finding it only the first time
+        :param state: state in NFA
+        :return: frozen set of states that can be reached
+        """
+        if state not in self.closures:
+            self.closures[state] = frozenset(self.epsilon_closure(state, [state]))
+        return self.closures[state]
 
     def epsilon_closure(self, state, next_states):
         """
-        Get the epsilon closure for the given state
+        Get the epsilon closure for the given state, in the order a depth-first search finds them, with a stack of the
+        epsilon arcs still to follow from each state rather than recursion
         :param state: state in NFA
         :param next_states: states that can be reached from the given NFA state
         :return: list of states that can be reached
         """
-        if state in self.nfa['transitions'] and '' in self.nfa['transitions'][state]:
-            for next_state in self.nfa['transitions'][state]['']:
-                if next_state not in next_states:
-                    next_states.append(next_state)
-                    next_states = self.epsilon_closure(next_state, next_states)
+        seen = set(next_states)
+        stack = [iter(self.nfa['transitions'].get(state, {}).get('', []))]
+
+        while stack:
+            next_state = next(stack[-1], None)
+            if next_state is None:
+                stack.pop()
+            elif next_state not in seen:
+                seen.add(next_state)
+                next_states.append(next_state)
+                stack.append(iter(self.nfa['transitions'].get(next_state, {}).get('', [])))
 
         return next_states
 
-    def print_in_carmel_format(self):
+    def print_in_carmel_format(self, numbered=False):
         """
         Print the DFA in carmel format
+        :param numbered: whether to name the DFA states by their ids rather than their NFA states
         :return: a string representation of the DFA in carmel format
         """
-        output_string = ""
-        output_string += self.dfa['final_state'] + "\n"
-        start_state = self.dfa['start_state']
+        lines = []
+
+        # each state is named by its id, or by its sorted NFA states joined by dashes
+        names = [str(dfa_state) if numbered else "-".join(sorted(states)) for dfa_state, states in enumerate(self.dfa_states)]
+
+        # carmel only allows one final state, so if there are more they each get an epsilon arc to a new final state
+        final_states = self.dfa['final_states']
+        final_state_set = set(final_states)
+        if len(final_states) == 1:
+            lines.append(names[final_states[0]])
+        else:
+            lines.append('FinalState')
 
-        for character in self.dfa['transitions'][start_state]:
-            second_state = self.dfa['transitions'][start_state][character]
-            output_string += "(" + start_state + " (" + second_state + ' "' + character + '"))\n'
+        # the start state's arcs come first, since carmel takes the start state from the first arc
+        dfa_states = [self.dfa['start_state']] + [state for state in self.dfa['transitions'] if state != self.dfa['start_state']]
+        for first_state in dfa_states:
+            for character, second_state in self.dfa['transitions'][first_state].items():
+                lines.append("(" + names[first_state] + " (" + names[second_state] + ' "' + character + '"))')
+            if len(final_states) != 1 and first_state in final_state_set:
+                lines.append("(" + names[first_state] + ' (FinalState ""))')
 
-        for first_state in self.dfa['transitions']:
-            if first_state != start_state:
-                for character in self.dfa['transitions'][first_state]:
-                    second_state = self.dfa['transitions'][first_state][character]
-                    output_string += "(" + first_state + " (" + second_state + ' "' + character + '"))\n'
-        return output_string.strip()
+        return "\n".join(lines)
 
 
 class TestNFAtoDFA(TestCase):
@@ -175,21 +300,122 @@ class TestNFAtoDFA(TestCase):
 
         self.assertCountEqual(expected, converter.print_in_carmel_format().split("\n"))
 
+    def test_large_nfa(self):
+        """
+        Tests an NFA with thousands of states and a long chain of epsilon arcs
+        :return: void
+        """
+        nfa_rules = ['6000'] + ['({0} ({1} "a"))'.format(state, state + 1) for state in range(0, 3000, 2)] + \
+                    ['({0} ({1} *e*))'.format(state, state + 1) for state in range(1, 3000, 2)] + \
+                    ['({0} ({1} *e*))'.format(state, state + 1) for state in range(3000, 6000)] + ['(1 (6000 *e*))']
+
+        converter = NFAtoDFA(nfa_rules)
+        converter.convert_nfa_to_dfa()
+
+        self.assertEqual(1501, len(converter.dfa_states))
+        self.assertEqual(frozenset(str(state) for state in range(2999, 6001)), converter.dfa_states[-1])
+        self.assertEqual([1, 1500], converter.dfa['final_states'])
+
+        output = converter.print_in_carmel_format(numbered=True).split("\n")
+        self.assertEqual(['FinalState', '(0 (1 "a"))', '(1 (2 "a"))', '(1 (FinalState ""))'], output[:4])
+
+    def test_minimize(self):
+        """
+        Tests merging the DFA states that accept the same strings
+        :return: void
+        """
+        nfa_rules = ['3', '(0 (1 "a"))', '(0 (2 "c"))', '(1 (3 "b"))', '(2 (4 "b"))', '(4 (3 *e*))', '(2 (5 "d"))']
+
+        converter = NFAtoDFA(nfa_rules)
+        converter.convert_nfa_to_dfa()
+        self.assertEqual((6, 5), converter.size())
+
+        converter.minimize()
+        self.assertEqual((3, 3), converter.size())
+        self.assertEqual(['2', '(0 (1 "a"))', '(0 (1 "c"))', '(1 (2 "b"))'], converter.print_in_carmel_format(numbered=True).split("\n"))
+        self.assertEqual(['3', '(0 (1 "a"))', '(0 (1 "c"))', '(1 (3 "b"))'], converter.print_in_carmel_format().split("\n"))
+
+    def test_minimize_nfa1(self):
+        """
+        Tests that minimizing the DFA for NFA1 keeps a DFA for the same strings
+        :return: void
+        """
+        with open('./TestFiles/nfa1', "r") as nfa_file:
+            nfa_rules = nfa_file.readlines()
+
+        self.assert_minimize_keeps_strings(nfa_rules, 6)
+
+    def test_minimize_final_states(self):
+        """
+        Tests that minimizing a DFA whose final states accept different strings keeps all of them final
+        :return: void
+        """
+        nfa_rules = ['2', '(0 (1 "a"))', '(1 (2 "a"))', '(1 (2 *e*))', '(0 (2 "b"))']
+
+        converter = self.assert_minimize_keeps_strings(nfa_rules, 4)
+        self.assertEqual([1, 2], converter.dfa['final_states'])
+        self.assertEqual(['FinalState', '(0 (1 "a"))', '(0 (2 "b"))', '(1 (2 "a"))', '(1 (FinalState ""))',
+                          '(2 (FinalState ""))'], converter.print_in_carmel_format(numbered=True).split("\n"))
+
+    def assert_minimize_keeps_strings(self, nfa_rules, max_length):
+        """
+        Check that minimizing the DFA for the NFA rules doesn't make it bigger, and that the DFA accepts the same
+        strings up to the given length before and after
+        :param nfa_rules: the lines of the NFA file
+        :param max_length: the length of the longest strings to check
+        :return: the NFAtoDFA with the minimized DFA
+        """
+        converter = NFAtoDFA(nfa_rules)
+        converter.convert_nfa_to_dfa()
+        before = converter.size()
+        dfa = converter.dfa
+
+        converter.minimize()
+        self.assertLessEqual(converter.size(), before)
+
+        def accepts(dfa, string):
+            state = dfa['start_state']
+            for character in string:
+                if character not in dfa['transitions'].get(state, {}):
+                    return False
+                state = dfa['transitions'][state][character]
+            return state in dfa['final_states']
+
+        strings = [[]]
+        for length in range(max_length):
+            strings += [string + [character] for string in strings for character in converter.vocabulary
+                        if len(string) == length]
+        for string in strings:
+            self.assertEqual(accepts(dfa, string), accepts(converter.dfa, string), string)
+
+        return converter
+
 
 def main():
     """
     Parse the system arguments, call the NFAtoDFA class and write results to the output file
     :return: void
     """
-    nfa_filename = sys.argv[1]
-
-    with open(nfa_filename, "r") as nfa_file:
+    arg_parser = argparse.ArgumentParser(description="Convert an NFA into an equivalent DFA")
+    arg_parser.add_argument("nfa_file", help="an FSA (NFA) file in Carmel format")
+    arg_parser.add_argument("--numbered", action="store_true",
+                            help="name the DFA states by number rather than by the NFA states in them")
+    arg_parser.add_argument("--minimize", action="store_true",
+                            help="minimize the DFA, writing its numbers of states and arcs before and after to stderr")
+    args = arg_parser.parse_args()
+
+    with open(args.nfa_file, "r") as nfa_file:
         nfa_rules = nfa_file.readlines()
 
     converter = NFAtoDFA(nfa_rules)
     converter.convert_nfa_to_dfa()
 
-    print(converter.print_in_carmel_format())
+    if args.minimize:
+        print("before minimization: {0} states, {1} arcs".format(*converter.size()), file=sys.stderr)
+        converter.minimize()
+        print("after minimization: {0} states, {1} arcs".format(*converter.size()), file=sys.stderr)
+
+    print(converter.print_in_carmel_format(args.numbered))
 
 
 if __name__ == "__main__":
@@ -1,26 +1,47 @@
-import sys
+import os
+import heapq
+import shutil
+import argparse
+import tempfile
+import numpy
+from itertools import islice
+from multiprocessing import Pool
 from unittest import TestCase
 
 
 class NgramCount:
     """
-    This class collects unigram, bigram and trigram frequency counts
+    This class collects frequency counts of the ngrams of every order up to a given order, with each word interned to an
+    integer id and the ngrams of each order kept in sorted arrays of their ids, with an array of their counts
     """
 
-    # a dictionary of unigrams and counts
-    unigrams = {}
+    # the word ids are stored big-endian, so sorting the bytes of the ngrams sorts them by their ids
+    id_dtype = numpy.dtype(">u4")
 
-    # a dictionary of bigrams and counts
-    bigrams = {}
-
-    # a dictionary of trigrams and counts
-    trigrams = {}
-
-    def __init__(self, input_sentences):
+    def __init__(self, input_sentences, order=3, buffer_size=1 << 20):
         """
         Initialize the class counting the ngrams in the given sentences
-        :param input_sentences: the given sentences
+        :param input_sentences: the given sentences, which are only read once, so they can be a file
+        :param order: the highest order of ngrams to count
+        :param buffer_size: the number of words to read before counting their ngrams
         """
+        if order < 1:
+            raise ValueError("the order must be at least 1")
+        self.order = order
+        self.buffer_size = buffer_size
+
+        # the id of each word, and the word for each id
+        self.ids = {}
+        self.vocabulary = []
+
+        # the ids of the words read but not counted yet, and the index after the end of each sentence in them
+        self.buffer = []
+        self.sentence_ends = []
+
+        # the sorted runs of counted ngrams of each order, with the unigrams first, each a tuple of an array with the ids
+        # of an ngram in each row and an array of their counts
+        self.runs = [[] for _ in range(order)]
+
         self.count_ngrams(input_sentences)
 
     def count_ngrams(self, input_sentences):
@@ -29,6 +50,7 @@ class NgramCount:
         :param input_sentences: the given sentences
         :return: void
         """
+        ids = self.ids
         for sentence in input_sentences:
 
             if not sentence.strip():
@@ -37,38 +59,361 @@ class NgramCount:
             tagged_sentence = "<s> " + sentence.strip() + " </s>"
             words = tagged_sentence.strip().split(" ")
 
-            for word_index in range(len(words)):
+            for word in words:
+                if word not in ids:
+                    ids[word] = len(self.vocabulary)
+                    self.vocabulary.append(word)
+                self.buffer.append(ids[word])
+            self.sentence_ends.append(len(self.buffer))
+
+            if len(self.buffer) >= self.buffer_size:
+                self.flush()
+
+        self.flush()
+
+    def flush(self):
+        """
+        Count the ngrams of the words in the buffer, adding a sorted run of them for each order
+        :return: void
+        """
+        if not self.buffer:
+            return
+
+        ids = numpy.array(self.buffer, dtype=self.id_dtype)
+        sentence_ends = numpy.array(self.sentence_ends)
+        ends = numpy.repeat(sentence_ends, numpy.diff(sentence_ends, prepend=0))
+        positions = numpy.arange(len(ids))
+        self.buffer = []
+        self.sentence_ends = []
 
-                unigram = words[word_index]
-                bigram = unigram + " " + words[word_index+1] if word_index + 1 < len(words) else ""
-                trigram = bigram + " " + words[word_index+2] if word_index + 2 < len(words) else ""
+        for n in range(1, self.order + 1):
+            # the ngrams start at each position that has n - 1 more words in its sentence
+            starts = positions[positions + n <= ends]
+            if not len(starts):
+                break
+            self.add_run(n, *self.sum_counts(numpy.stack([ids[starts + index] for index in range(n)], axis=1)))
 
-                self.unigrams.setdefault(unigram, 0)
-                self.unigrams[unigram] += 1
+    def add_run(self, n, ngrams, counts):
+        """
+        Add a sorted run of ngram counts, merging the last two runs while the one before the last is less than twice as
+        long, so there are only a logarithmic number of runs and each ngram is only merged a logarithmic number of times
+        :param n: the order of the ngrams
+        :param ngrams: array of the sorted, distinct ngrams
+        :param counts: array of their counts
+        :return: void
+        """
+        runs = self.runs[n - 1]
+        runs.append((ngrams, counts))
+        while len(runs) > 1 and len(runs[-2][1]) < 2 * len(runs[-1][1]):
+            last_ngrams, last_counts = runs.pop()
+            ngrams, counts = runs.pop()
+            runs.append(self.sum_counts(numpy.concatenate((ngrams, last_ngrams)), numpy.concatenate((counts, last_counts))))
+
+    @staticmethod
+    def sum_counts(ngrams, counts=None):
+        """
+        Sort the ngrams, and add up the counts of each distinct ngram
+        :param ngrams: array with the ids of an ngram in each row
+        :param counts: array of the count of each row, or None if each is 1
+        :return: tuple of the array of the sorted, distinct ngrams and the array of their counts
+        """
+        n = ngrams.shape[1]
+        rows = numpy.ascontiguousarray(ngrams).view(numpy.dtype((numpy.void, ngrams.dtype.itemsize * n))).ravel()
+        if counts is None:
+            rows = numpy.sort(rows)
+        else:
+            order = numpy.argsort(rows, kind="stable")
+            rows = rows[order]
+            counts = counts[order]
+
+        starts = numpy.flatnonzero(numpy.concatenate(([True], rows[1:] != rows[:-1])))
+        if counts is None:
+            counts = numpy.diff(starts, append=len(rows))
+        else:
+            counts = numpy.add.reduceat(counts, starts)
+        return rows[starts].view(ngrams.dtype).reshape(-1, n), counts.astype(numpy.int64)
+
+    def table(self, n):
+        """
+        Get the counts of the ngrams of the given order, merging their runs into one
+        :param n: the order of the ngrams
+        :return: tuple of the array with the ids of each distinct ngram in a row, sorted by their ids, and the array of
+        their counts
+        """
+        runs = self.runs[n - 1]
+        if not runs:
+            return numpy.zeros((0, n), dtype=self.id_dtype), numpy.zeros(0, dtype=numpy.int64)
+        if len(runs) > 1:
+            runs[:] = [self.sum_counts(numpy.concatenate([run[0] for run in runs]),
+                                       numpy.concatenate([run[1] for run in runs]))]
+        return runs[0]
+
+    def nbytes(self):
+        """
+        Count the bytes taken by the arrays of counted ngrams
+        :return: the number of bytes
+        """
+        return sum(ngrams.nbytes + counts.nbytes for runs in self.runs for ngrams, counts in runs)
 
-                if bigram:
-                    self.bigrams.setdefault(bigram, 0)
-                    self.bigrams[bigram] += 1
+    def ngram_counts(self, n):
+        """
+        Get the ngrams of the given order with their counts
+        :param n: the order of the ngrams
+        :return: list of tuples of the ngram, with its words separated by spaces, and its count, in the order of their ids
+        """
+        ngrams, counts = self.table(n)
+        vocabulary = self.vocabulary
+        return [(" ".join([vocabulary[word] for word in ngram]), count)
+                for ngram, count in zip(ngrams.tolist(), counts.tolist())]
 
-                if trigram:
-                    self.trigrams.setdefault(trigram, 0)
-                    self.trigrams[trigram] += 1
+    def sorted_ngrams(self, n):
+        """
+        Get the ngrams of the given order, sorted
+        :param n: the order of the ngrams
+        :return: list of tuples of the count and the ngram, with its words separated by spaces, in order of descending
+        count, with equal counts in alphabetical order
+        """
+        sorted_ngrams = [(count, ngram) for ngram, count in self.ngram_counts(n)]
+        sorted_ngrams.sort(key=lambda count_ngram: (-count_ngram[0], count_ngram[1]))
+        return sorted_ngrams
 
     def ngrams_to_string_sorted(self):
         """
         Return the sorted ngram counts
         :return: a sorted string representation of the ngram counts
         """
-        output_string = ""
+        lines = []
+
+        for n in range(1, self.order + 1):
+            lines.extend(str(count) + "\t" + ngram for count, ngram in self.sorted_ngrams(n))
+
+        return "\n".join(lines).strip()
+
+
+# the number of bytes of memory to allow for each ngram string and count held while sorting the merged counts
+sorted_ngram_bytes = 400
+
+# the number of bytes of memory to allow for each byte of counts held, since merging their runs and sorting them to write
+# them to disk takes more, for each word in the vocabulary, and for each word in the buffer while its ngrams are counted
+counted_ngram_overhead = 3
+vocabulary_word_bytes = 150
+buffered_word_bytes = 256
+
+
+def shard_offsets(filename, shards):
+    """
+    Split a file into shards of about the same number of bytes
+    :param filename: the file
+    :param shards: the number of shards
+    :return: list of tuples of the offsets of the start and end of each shard, each of which has the lines that start in it
+    """
+    size = os.path.getsize(filename)
+    offsets = [size * shard // shards for shard in range(shards + 1)]
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def read_shard(filename, start, end):
+    """
+    Read the sentences that start in a shard of a file, splitting the lines the same way as a file opened in text mode
+    :param filename: the file
+    :param start: the offset of the start of the shard
+    :param end: the offset of the end of the shard
+    :return: generator of sentences
+    """
+    with open(filename, "rb") as sentences_file:
+        if start > 0:
+            # skip the end of the line that started in the shard before
+            sentences_file.seek(start - 1)
+            sentences_file.readline()
+        while sentences_file.tell() < end:
+            line = sentences_file.readline()
+            if not line:
+                break
+            yield from line.decode("utf-8").replace("\r\n", "\n").split("\r")
+
+
+def write_partial_counts(counter, directory, prefix, chunk_size=1 << 16):
+    """
+    Write the counts of each order of ngrams to a file, sorted by the words of the ngrams, then dropping them from the
+    counter. The vocabulary is ranked by string once, and the arrays of ngrams are sorted by the ranks of their words with
+    numpy and written a chunk of lines at a time, so no more than a chunk of the ngrams is ever held as strings
+    :param counter: the NgramCount
+    :param directory: the directory to write the files in
+    :param prefix: the start of the names of the files
+    :param chunk_size: the number of lines to write at a time
+    :return: list of the file for each order
+    """
+    vocabulary = counter.vocabulary
+    words_by_rank = sorted(vocabulary)
+    ranks = numpy.empty(len(vocabulary), dtype=numpy.uint32)
+    ranks[sorted(range(len(vocabulary)), key=vocabulary.__getitem__)] = numpy.arange(len(vocabulary), dtype=numpy.uint32)
+
+    filenames = []
+    for n in range(1, counter.order + 1):
+        ngrams, counts = counter.table(n)
+        ngrams = ranks[ngrams]
+        counter.runs[n - 1] = []
+        # lexsort sorts by its last key first
+        order = numpy.lexsort(ngrams.T[::-1])
+
+        filenames.append(os.path.join(directory, prefix + "-" + str(n)))
+        with open(filenames[-1], "w", encoding="utf-8", newline="\n") as partial_file:
+            for start in range(0, len(order), chunk_size):
+                rows = order[start:start + chunk_size]
+                partial_file.write("".join([" ".join([words_by_rank[word] for word in ngram]) + "\t" + str(count) + "\n"
+                                            for ngram, count in zip(ngrams[rows].tolist(), counts[rows].tolist())]))
+    return filenames
+
+
+def count_shard(filename, start, end, order, memory_limit, directory, shard):
+    """
+    Count the ngrams in a shard of a file, writing the counts to sorted partial files each time the counts and the
+    vocabulary would take more than their share of the memory limit, and at the end
+    :param filename: the file of sentences
+    :param start: the offset of the start of the shard
+    :param end: the offset of the end of the shard
+    :param order: the highest order of ngrams to count
+    :param memory_limit: the number of bytes of memory to use for the counts, the vocabulary and the buffer of words
+    :param directory: the directory to write the partial files in
+    :param shard: the number of the shard
+    :return: list of the list of partial files for each order
+    """
+    partial_files = [[] for _ in range(order)]
+    sentences = read_shard(filename, start, end)
+    # count a batch of sentences at a time, checking the memory after each, with a quarter of the memory limit for the
+    # buffer of words, half for the counts and the vocabulary, and an eighth for the lines of counts written at a time
+    buffer_size = max(1, min(1 << 20, memory_limit // 4 // buffered_word_bytes))
+    batch_size = max(1, buffer_size // 16)
+    counts_limit = memory_limit // 2
+    chunk_size = max(1, min(1 << 16, memory_limit // 8 // sorted_ngram_bytes))
 
-        for unigram, count in sorted(self.unigrams.items(), key=lambda kv: (-kv[1], kv[0])):
-            output_string += str(count) + "\t" + unigram + "\n"
-        for bigram, count in sorted(self.bigrams.items(), key=lambda kv: (-kv[1], kv[0])):
-            output_string += str(count) + "\t" + bigram + "\n"
-        for trigram, count in sorted(self.trigrams.items(), key=lambda kv: (-kv[1], kv[0])):
-            output_string += str(count) + "\t" + trigram + "\n"
+    counter = NgramCount([], order, buffer_size)
+    batch = list(islice(sentences, batch_size))
+    while batch:
+        counter.count_ngrams(batch)
+        batch = list(islice(sentences, batch_size))
 
-        return output_string.strip()
+        if counter.nbytes() * counted_ngram_overhead + len(counter.vocabulary) * vocabulary_word_bytes > counts_limit \
+                or not batch:
+            prefix = str(shard) + "-" + str(len(partial_files[0]))
+            for n, partial_file in enumerate(write_partial_counts(counter, directory, prefix, chunk_size)):
+                partial_files[n].append(partial_file)
+            counter = NgramCount([], order, buffer_size)
+
+    return partial_files
+
+
+def read_partial_counts(filename):
+    """
+    Read a partial count file
+    :param filename: the partial count file
+    :return: generator of tuples of each ngram and its count, sorted by the words of the ngrams
+    """
+    with open(filename, "r", encoding="utf-8", newline="\n") as partial_file:
+        for line in partial_file:
+            ngram, count = line[:-1].rsplit("\t", 1)
+            yield ngram, int(count)
+
+
+def merge_partial_counts(filenames):
+    """
+    Merge partial count files, adding up the counts of each ngram
+    :param filenames: the partial count files
+    :return: generator of tuples of each ngram and its total count, sorted by the words of the ngrams
+    """
+    ngram, total = None, 0
+    for next_ngram, count in heapq.merge(*[read_partial_counts(filename) for filename in filenames],
+                                         key=lambda ngram_count: ngram_count[0].split(" ")):
+        if next_ngram != ngram:
+            if ngram is not None:
+                yield ngram, total
+            ngram, total = next_ngram, 0
+        total += count
+    if ngram is not None:
+        yield ngram, total
+
+
+def read_sorted_run(filename):
+    """
+    Read a run of sorted ngram counts
+    :param filename: the file of the run
+    :return: generator of tuples of the negated count and the ngram
+    """
+    with open(filename, "r", encoding="utf-8", newline="\n") as run_file:
+        for line in run_file:
+            count, ngram = line[:-1].split("\t", 1)
+            yield -int(count), ngram
+
+
+def sort_partial_counts(filenames, output_filename, memory_limit):
+    """
+    Merge the partial count files of one order, and write the total counts in order of descending count, with equal
+    counts in alphabetical order, sorting runs that fit in the memory limit and merging them
+    :param filenames: the partial count files of the order
+    :param output_filename: the file to write the sorted counts to, one "count\tngram" line each
+    :param memory_limit: the number of bytes of memory to use for the ngrams sorted at a time
+    :return: the number of ngrams
+    """
+    run_size = max(1, memory_limit // sorted_ngram_bytes)
+    run_filenames = []
+    ngrams = 0
+
+    counts = ((-count, ngram) for ngram, count in merge_partial_counts(filenames))
+    run = list(islice(counts, run_size))
+    while run:
+        run.sort()
+        ngrams += len(run)
+        next_ngram = list(islice(counts, 1))
+        if not next_ngram and not run_filenames:
+            # the only run is merged from memory
+            break
+
+        run_filenames.append(output_filename + "-" + str(len(run_filenames)))
+        with open(run_filenames[-1], "w", encoding="utf-8", newline="\n") as run_file:
+            for count, ngram in run:
+                run_file.write(str(-count) + "\t" + ngram + "\n")
+        run = next_ngram + list(islice(counts, run_size - 1))
+
+    with open(output_filename, "w", encoding="utf-8", newline="\n") as output_file:
+        for count, ngram in heapq.merge(run, *[read_sorted_run(filename) for filename in run_filenames]):
+            output_file.write(str(-count) + "\t" + ngram + "\n")
+
+    for filename in run_filenames:
+        os.remove(filename)
+    return ngrams
+
+
+def count_sharded(filename, output_file, order=3, workers=1, memory_limit=1 << 30, temp_dir=None):
+    """
+    Count the ngrams in a file with a pool of processes, each counting a shard of the file and writing its counts to
+    sorted partial files on disk, then merge the partial files of each order in parallel and write the same counts, in
+    the same order, as ngrams_to_string_sorted
+    :param filename: the file of sentences
+    :param output_file: the file to write the sorted ngram counts to
+    :param order: the highest order of ngrams to count
+    :param workers: the number of processes
+    :param memory_limit: the number of bytes of memory each process can use for counting and sorting, beyond what the
+    interpreter and numpy take
+    :param temp_dir: the directory to make the directory of partial files in, by default the system's
+    :return: void
+    """
+    if order < 1:
+        raise ValueError("the order must be at least 1")
+
+    with tempfile.TemporaryDirectory(dir=temp_dir) as directory:
+        with Pool(workers) as pool:
+            shards = pool.starmap(count_shard, [(filename, start, end, order, memory_limit, directory, shard)
+                                                for shard, (start, end) in enumerate(shard_offsets(filename, workers))])
+
+            sorted_filenames = [os.path.join(directory, "sorted-" + str(n)) for n in range(1, order + 1)]
+            ngrams = pool.starmap(sort_partial_counts, [([partial_file for shard in shards for partial_file in shard[n]],
+                                                         sorted_filenames[n], memory_limit) for n in range(order)])
+
+        for sorted_filename in sorted_filenames:
+            with open(sorted_filename, "r", encoding="utf-8", newline="\n") as sorted_file:
+                shutil.copyfileobj(sorted_file, output_file)
+        if not sum(ngrams):
+            output_file.write("\n")
 
 
 class TestNgramCount(TestCase):
@@ -93,20 +438,108 @@ class TestNgramCount(TestCase):
             test_expected = expected_ngrams.readlines()
         self.assertEqual(ngrams.split("\n"), [x.strip("\n") for x in test_expected])
 
+    def test_order(self):
+        """
+        Tests counting the ngrams of other orders
+        :return: void
+        """
+        counter = NgramCount(self.test_sentences, 5)
+        ngrams = counter.ngrams_to_string_sorted().split("\n")
+
+        with open('./TestFiles/ngrams', "r") as expected_ngrams:
+            test_expected = [x.strip("\n") for x in expected_ngrams.readlines()]
+
+        # the counts of the first three orders are the same, and the 15 words with the sentence boundaries have 12 4-grams,
+        # one of them twice, and 11 5-grams
+        self.assertEqual(test_expected, ngrams[:len(test_expected)])
+        self.assertEqual(["2\tthis is a test", "1\t<s> this is a"], ngrams[len(test_expected):len(test_expected) + 2])
+        self.assertEqual(11 + 11, len(ngrams) - len(test_expected))
+
+        unigrams = NgramCount(self.test_sentences, 1).ngrams_to_string_sorted().split("\n")
+        self.assertEqual(test_expected[:len(unigrams)], unigrams)
+        self.assertTrue(all(len(line.split()) == 2 for line in unigrams))
+
+    def test_instances(self):
+        """
+        Tests that each counter has its own counts
+        :return: void
+        """
+        first = NgramCount(self.test_sentences)
+        second = NgramCount(["another sentence"])
+
+        self.assertEqual(["1\t</s>", "1\t<s>", "1\tanother", "1\tsentence"],
+                         second.ngrams_to_string_sorted().split("\n")[:4])
+        self.assertEqual(NgramCount(self.test_sentences).ngrams_to_string_sorted(), first.ngrams_to_string_sorted())
+
+    def test_buffer_size(self):
+        """
+        Tests that counting the words a few at a time, and merging the runs of counts, gives the same counts
+        :return: void
+        """
+        sentences = self.test_sentences * 3 + ["", "a", "test sentence for the counter"] + self.test_sentences
+
+        expected = NgramCount(sentences, 4).ngrams_to_string_sorted()
+        for buffer_size in [1, 2, 5, 17]:
+            counter = NgramCount(sentences, 4, buffer_size)
+            self.assertEqual(expected, counter.ngrams_to_string_sorted())
+            self.assertEqual(1, len(counter.runs[3]))
+
+    def test_count_sharded(self):
+        """
+        Tests that counting shards of a file in parallel, with the counts written to disk and merged, gives the same
+        counts in the same order
+        :return: void
+        """
+        # a word with a tab sorts before the same word followed by a space, so the partial files are sorted by words
+        sentences = self.test_sentences * 3 + ["", "a", "test sentence for the counter\r", "so\rthis", "a\tb c", "a c"] + \
+            ["sentence {0} for the counter".format(index % 7) for index in range(100)]
+        with tempfile.TemporaryDirectory() as directory:
+            sentences_filename = os.path.join(directory, "sentences")
+            with open(sentences_filename, "w", newline="") as sentences_file:
+                sentences_file.write("\n".join(sentences))
+
+            # the file is split into lines the same way as when it's read in text mode
+            with open(sentences_filename, "r") as sentences_file:
+                expected = NgramCount(sentences_file, 4).ngrams_to_string_sorted() + "\n"
+            self.assertIn("1\t<s> so </s>\n", expected)
+
+            for workers, memory_limit in [(1, 1 << 20), (3, 1 << 20), (4, 100)]:
+                output_filename = os.path.join(directory, "ngrams")
+                with open(output_filename, "w", encoding="utf-8", newline="\n") as output_file:
+                    count_sharded(sentences_filename, output_file, 4, workers, memory_limit, directory)
+
+                with open(output_filename, "r", encoding="utf-8", newline="\n") as output_file:
+                    self.assertEqual(expected, output_file.read())
+                self.assertEqual(["sentences", "ngrams"], sorted(os.listdir(directory), reverse=True))
+
 
 def main():
     """
     Parse the system arguments, call the NgramCount class and write results to the output file
     :return:
     """
-    sentence_filename = sys.argv[1]
-    sentences_file = open(sentence_filename, "r")
-    sentences = sentences_file.readlines()
+    arg_parser = argparse.ArgumentParser(description="Count the ngrams in a file of sentences")
+    arg_parser.add_argument("training_data", help="the input file with one sentence per line, tokenized")
+    arg_parser.add_argument("output_file", help="the file to write the ngram counts to")
+    arg_parser.add_argument("--order", type=int, default=3, help="the highest order of ngrams to count")
+    arg_parser.add_argument("--workers", type=int, default=1,
+                            help="count shards of the training data in this many processes, merging their counts on disk")
+    arg_parser.add_argument("--memory-limit", type=int,
+                            help="the number of megabytes of memory each process uses for counting and sorting, "
+                                 "writing the counts to disk when they fill it (1024 by default)")
+    arg_parser.add_argument("--temp-dir", help="with --workers, the directory to write the partial counts in")
+    args = arg_parser.parse_args()
+
+    if args.workers > 1 or args.memory_limit:
+        with open(args.output_file, "w", encoding="utf-8", newline="\n") as output_file:
+            count_sharded(args.training_data, output_file, args.order, args.workers,
+                          (args.memory_limit or 1024) << 20, args.temp_dir)
+        return
 
-    output_filename = sys.argv[2]
+    with open(args.training_data, "r") as sentences_file:
+        counter = NgramCount(sentences_file, args.order)
 
-    with open(output_filename, "w") as output_file:
-        counter = NgramCount(sentences)
+    with open(args.output_file, "w") as output_file:
         print(counter.ngrams_to_string_sorted(), file=output_file)
 
 
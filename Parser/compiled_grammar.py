@@ -0,0 +1,391 @@
+#! /usr/bin/env python3
+
+import os
+import sys
+import json
+import hashlib
+import heapq
+import shutil
+import tempfile
+import nltk
+import numpy
+from nltk.grammar import is_terminal
+from unittest import TestCase
+from math import log
+
+
+class CompiledGrammar:
+    """
+    This class holds a CNF PCFG as interned symbols, a lexical index and a binary rule index with pre-computed log
+    probabilities, and saves it to a compact binary file that can be memory-mapped on startup
+    """
+
+    # the first bytes of every compiled grammar file
+    magic = b"PCKYGRM2"
+
+    # the arrays stored in a compiled grammar file, in order
+    array_names = ["lexical_offsets", "lexical_lhs", "lexical_prob", "rule_lhs", "rule_left", "rule_right", "rule_prob",
+                   "unary_lhs", "unary_child", "unary_next", "unary_prob"]
+
+    def __init__(self, start, symbols, words, arrays, source_hash=""):
+        """
+        Initialize the class from the interned symbols and the rule arrays
+        :param start: the start symbol
+        :param symbols: the list of nonterminal symbols, indexed by id
+        :param words: the sorted list of terminal words, indexed by id
+        :param arrays: dictionary of the numpy arrays named in array_names
+        :param source_hash: the hash of the grammar file this was compiled from
+        """
+        self.start = start
+        self.symbols = symbols
+        self.words = words
+        self.source_hash = source_hash
+
+        # the lexical rules for word w are at lexical_offsets[w]:lexical_offsets[w+1]
+        self.lexical_offsets = arrays["lexical_offsets"]
+        self.lexical_lhs = arrays["lexical_lhs"]
+        self.lexical_prob = arrays["lexical_prob"]
+
+        self.rule_lhs = arrays["rule_lhs"]
+        self.rule_left = arrays["rule_left"]
+        self.rule_right = arrays["rule_right"]
+        self.rule_prob = arrays["rule_prob"]
+
+        # the best chain of unary rules from unary_lhs down to unary_child, starting with the rule unary_lhs -> unary_next
+        self.unary_lhs = arrays["unary_lhs"]
+        self.unary_child = arrays["unary_child"]
+        self.unary_next = arrays["unary_next"]
+        self.unary_prob = arrays["unary_prob"]
+
+    @staticmethod
+    def unary_closure(unary_rules):
+        """
+        Find the most probable chain of unary rules between each pair of nonterminals, searching up from each child like
+        Dijkstra's algorithm so that cycles of unary rules are never followed
+        :param unary_rules: list of (lhs, child, log prob) for each unary rule
+        :return: list of (lhs, child, next, log prob) where next is the child of the first rule in the chain
+        """
+        parents = {}
+        for lhs, child, prob in unary_rules:
+            parents.setdefault(child, []).append((lhs, prob))
+
+        closure = []
+        for child in sorted(parents):
+            best = {child: 0.0}
+            queue = [(0.0, child, child)]
+            done = set()
+            while queue:
+                cost, symbol, next_symbol = heapq.heappop(queue)
+                if symbol in done:
+                    continue
+                done.add(symbol)
+                if symbol != child:
+                    closure.append((symbol, child, next_symbol, -cost))
+                for lhs, prob in parents.get(symbol, []):
+                    if lhs not in best or cost - prob < best[lhs]:
+                        best[lhs] = cost - prob
+                        heapq.heappush(queue, (cost - prob, lhs, symbol))
+
+        return closure
+
+    @staticmethod
+    def from_pcfg(cnf_grammar, source_hash=""):
+        """
+        Compile the given NLTK grammar
+        :param cnf_grammar: the given CNF grammar
+        :param source_hash: the hash of the grammar file, if it was read from one
+        :return: the compiled grammar
+        """
+        rules = []
+        for rule in cnf_grammar.productions():
+            rhs = rule.rhs()
+            if len(rhs) == 1 and is_terminal(rhs[0]):
+                rules.append((rule.lhs().symbol(), rhs[0], rule.prob()))
+            else:
+                rules.append((rule.lhs().symbol(), tuple(x.symbol() for x in rhs), rule.prob()))
+
+        return CompiledGrammar.from_rules(cnf_grammar.start().symbol(), rules, source_hash)
+
+    @staticmethod
+    def from_rules(start, rules, source_hash=""):
+        """
+        Compile the given rules, ordering the rules for each word and pair of children by increasing probability
+        :param start: the start symbol
+        :param rules: iterable of (lhs, rhs, prob) where rhs is a word or a tuple of one or two nonterminal symbols
+        :param source_hash: the hash of the grammar file, if it was read from one
+        :return: the compiled grammar
+        """
+        rules = sorted(rules, key=lambda x: x[2])
+
+        symbols = sorted({lhs for lhs, _, _ in rules} |
+                         {x for _, rhs, _ in rules if isinstance(rhs, tuple) for x in rhs})
+        symbol_ids = {symbol: index for index, symbol in enumerate(symbols)}
+
+        lexical = {}
+        binary = []
+        unary = []
+        for lhs, rhs, prob in rules:
+            if not isinstance(rhs, tuple):
+                lexical.setdefault(rhs, []).append((symbol_ids[lhs], log(prob)))
+            elif len(rhs) == 1:
+                unary.append((symbol_ids[lhs], symbol_ids[rhs[0]], log(prob)))
+            elif len(rhs) == 2:
+                binary.append((symbol_ids[lhs], symbol_ids[rhs[0]], symbol_ids[rhs[1]], log(prob)))
+
+        words = sorted(lexical)
+        tags = [tag for word in words for tag in lexical[word]]
+        closure = CompiledGrammar.unary_closure(unary)
+
+        arrays = {
+            "lexical_offsets": numpy.cumsum([0] + [len(lexical[word]) for word in words], dtype=numpy.int64),
+            "lexical_lhs": numpy.array([tag[0] for tag in tags], dtype=numpy.int32),
+            "lexical_prob": numpy.array([tag[1] for tag in tags], dtype=numpy.float64),
+            "rule_lhs": numpy.array([rule[0] for rule in binary], dtype=numpy.int32),
+            "rule_left": numpy.array([rule[1] for rule in binary], dtype=numpy.int32),
+            "rule_right": numpy.array([rule[2] for rule in binary], dtype=numpy.int32),
+            "rule_prob": numpy.array([rule[3] for rule in binary], dtype=numpy.float64),
+            "unary_lhs": numpy.array([chain[0] for chain in closure], dtype=numpy.int32),
+            "unary_child": numpy.array([chain[1] for chain in closure], dtype=numpy.int32),
+            "unary_next": numpy.array([chain[2] for chain in closure], dtype=numpy.int32),
+            "unary_prob": numpy.array([chain[3] for chain in closure], dtype=numpy.float64)
+        }
+
+        return CompiledGrammar(start, symbols, words, arrays, source_hash)
+
+    def lexical_index(self):
+        """
+        Index the lexical rules by word
+        :return: dictionary mapping each word to a list of (lhs, log prob)
+        """
+        lexical_rules = {}
+        for index, word in enumerate(self.words):
+            start, end = int(self.lexical_offsets[index]), int(self.lexical_offsets[index + 1])
+            lexical_rules[word] = [(self.symbols[lhs], float(prob)) for lhs, prob in
+                                   zip(self.lexical_lhs[start:end].tolist(), self.lexical_prob[start:end].tolist())]
+        return lexical_rules
+
+    def binary_index(self):
+        """
+        Index the binary rules by their pair of children
+        :return: dictionary mapping each (left, right) pair of symbols to a list of (lhs, log prob)
+        """
+        binary_rules = {}
+        for lhs, left, right, prob in zip(self.rule_lhs.tolist(), self.rule_left.tolist(), self.rule_right.tolist(),
+                                          self.rule_prob.tolist()):
+            binary_rules.setdefault((self.symbols[left], self.symbols[right]), []).append((self.symbols[lhs], prob))
+        return binary_rules
+
+    def unary_index(self):
+        """
+        Index the best unary chains by the child at the bottom of the chain
+        :return: dictionary mapping each child symbol to a list of (lhs, log prob, chain of symbols from lhs to child)
+        """
+        next_symbols = {(lhs, child): next_symbol for lhs, child, next_symbol in
+                        zip(self.unary_lhs.tolist(), self.unary_child.tolist(), self.unary_next.tolist())}
+
+        unary_rules = {}
+        for lhs, child, prob in zip(self.unary_lhs.tolist(), self.unary_child.tolist(), self.unary_prob.tolist()):
+            chain = [lhs]
+            while chain[-1] != child:
+                chain.append(next_symbols[(chain[-1], child)])
+            unary_rules.setdefault(self.symbols[child], []).append((self.symbols[lhs], prob,
+                                                                    [self.symbols[symbol] for symbol in chain]))
+        return unary_rules
+
+    def save(self, filename):
+        """
+        Write the compiled grammar to the given file, replacing it atomically
+        :param filename: the compiled grammar file
+        :return: void
+        """
+        layout = {}
+        offset = 0
+        for name in self.array_names:
+            array = numpy.ascontiguousarray(getattr(self, name))
+            layout[name] = [array.dtype.str, len(array), offset]
+            offset += array.nbytes
+            offset += -offset % 8
+
+        header = json.dumps({"hash": self.source_hash, "start": self.start, "symbols": self.symbols,
+                             "words": self.words, "arrays": layout}).encode("utf-8")
+        header += b" " * (-(len(self.magic) + 8 + len(header)) % 8)
+
+        directory = os.path.dirname(os.path.abspath(filename))
+        with tempfile.NamedTemporaryFile("wb", dir=directory, delete=False) as f:
+            f.write(self.magic)
+            f.write(len(header).to_bytes(8, "little"))
+            f.write(header)
+            for name in self.array_names:
+                array = numpy.ascontiguousarray(getattr(self, name))
+                f.write(array.tobytes())
+                f.write(b"\0" * (-array.nbytes % 8))
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, filename)
+
+    @staticmethod
+    def read_header(filename):
+        """
+        Read the header of a compiled grammar file
+        :param filename: the compiled grammar file
+        :return: a tuple of the header dictionary and the offset of the arrays in the file, or (None, 0) if not valid
+        """
+        with open(filename, "rb") as f:
+            if f.read(len(CompiledGrammar.magic)) != CompiledGrammar.magic:
+                return None, 0
+            length = int.from_bytes(f.read(8), "little")
+            header = json.loads(f.read(length).decode("utf-8"))
+        return header, len(CompiledGrammar.magic) + 8 + length
+
+    @staticmethod
+    def open(filename):
+        """
+        Memory-map a compiled grammar file
+        :param filename: the compiled grammar file
+        :return: the compiled grammar
+        """
+        header, data_offset = CompiledGrammar.read_header(filename)
+        if header is None:
+            raise ValueError(filename + " is not a compiled grammar")
+
+        arrays = {}
+        for name, (dtype, length, offset) in header["arrays"].items():
+            if length:
+                arrays[name] = numpy.memmap(filename, dtype=dtype, mode="r", offset=data_offset + offset, shape=(length,))
+            else:
+                arrays[name] = numpy.zeros(0, dtype=dtype)
+
+        return CompiledGrammar(header["start"], header["symbols"], header["words"], arrays, header["hash"])
+
+    @staticmethod
+    def hash_file(filename):
+        """
+        Hash the contents of the given file
+        :param filename: the file to hash
+        :return: the hex digest of the file
+        """
+        digest = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def load(grammar_file, compiled_file=None):
+        """
+        Load the compiled version of the given grammar file, compiling it first if there is no compiled file or if the
+        grammar has changed since it was compiled
+        :param grammar_file: the PCFG grammar file
+        :param compiled_file: the compiled grammar file, by default the grammar file with a .compiled extension
+        :return: the compiled grammar
+        """
+        compiled_file = compiled_file or grammar_file + ".compiled"
+        source_hash = CompiledGrammar.hash_file(grammar_file)
+
+        if os.path.exists(compiled_file):
+            header, _ = CompiledGrammar.read_header(compiled_file)
+            if header is not None and header["hash"] == source_hash:
+                return CompiledGrammar.open(compiled_file)
+
+        compiled = CompiledGrammar.from_pcfg(nltk.data.load(grammar_file), source_hash)
+        try:
+            compiled.save(compiled_file)
+        except OSError:
+            # the grammar can still be used if the compiled file can't be written
+            return compiled
+
+        return CompiledGrammar.open(compiled_file)
+
+
+class TestCompiledGrammar(TestCase):
+    """
+    This class contains tests for the CompiledGrammar class
+    """
+
+    def setUp(self):
+        """
+        Copy the test grammar into a temporary directory so it can be compiled there
+        :return: void
+        """
+        self.directory = tempfile.mkdtemp()
+        self.grammar_file = os.path.join(self.directory, "pcfg.pcfg")
+        shutil.copy('./TestFiles/unk_pcfg.pcfg', self.grammar_file)
+
+    def tearDown(self):
+        """
+        Remove the temporary directory
+        :return: void
+        """
+        shutil.rmtree(self.directory)
+
+    def test_compile(self):
+        """
+        Test the compiled file holds the same rules as the grammar and is memory-mapped when loaded
+        :return: void
+        """
+        grammar = nltk.data.load('./TestFiles/unk_pcfg.pcfg')
+        expected = CompiledGrammar.from_pcfg(grammar)
+
+        compiled = CompiledGrammar.load(self.grammar_file)
+
+        self.assertTrue(os.path.exists(self.grammar_file + ".compiled"))
+        self.assertIsInstance(compiled.rule_prob, numpy.memmap)
+        self.assertEqual("S", compiled.start)
+        self.assertEqual(expected.symbols, compiled.symbols)
+        self.assertEqual(expected.lexical_index(), compiled.lexical_index())
+        self.assertEqual(expected.binary_index(), compiled.binary_index())
+        self.assertEqual([("N", log(0.2))], compiled.lexical_index()["cat"])
+        self.assertEqual([("NP", log(0.875))], compiled.binary_index()[("Det", "N")])
+
+    def test_unary_closure(self):
+        """
+        Test the best chain of unary rules is found between each pair of nonterminals, even through a cycle
+        :return: void
+        """
+        grammar = nltk.data.load('./TestFiles/unary_pcfg.pcfg')
+        compiled = CompiledGrammar.from_pcfg(grammar)
+
+        expected = {
+            "N": [("Nom", log(0.7), ["Nom", "N"]), ("NP", log(0.4) + log(0.7), ["NP", "Nom", "N"])],
+            "Nom": [("NP", log(0.4), ["NP", "Nom"])],
+            "NP": [("Nom", log(0.1), ["Nom", "NP"])],
+            "V": [("VP", log(0.3), ["VP", "V"])]
+        }
+
+        closure = compiled.unary_index()
+        self.assertCountEqual(expected.keys(), closure.keys())
+        for child in expected:
+            self.assertEqual([(lhs, chain) for lhs, _, chain in expected[child]], [(lhs, chain) for lhs, _, chain in closure[child]])
+            for (_, expected_prob, _), (_, prob, _) in zip(expected[child], closure[child]):
+                self.assertAlmostEqual(expected_prob, prob)
+
+    def test_recompile(self):
+        """
+        Test the compiled file is rebuilt when the grammar changes
+        :return: void
+        """
+        compiled = CompiledGrammar.load(self.grammar_file)
+        self.assertNotIn("bird", compiled.words)
+
+        with open(self.grammar_file, "r") as grammar:
+            rules = grammar.read().replace('N -> "UNK" [0.2]', 'N -> "UNK" [0.1]\nN -> "bird" [0.1]')
+        with open(self.grammar_file, "w") as grammar:
+            grammar.write(rules)
+
+        compiled = CompiledGrammar.load(self.grammar_file)
+        self.assertEqual([("N", log(0.1))], compiled.lexical_index()["bird"])
+        self.assertEqual(CompiledGrammar.hash_file(self.grammar_file), compiled.source_hash)
+
+
+def main():
+    """
+    Parse the system arguments and compile the given grammar file
+    :return: void
+    """
+    grammar_file = sys.argv[1]
+    compiled_file = sys.argv[2] if len(sys.argv) > 2 else None
+
+    CompiledGrammar.load(grammar_file, compiled_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,17 @@
 #! /usr/bin/env python3
 
+import os
 import sys
+import shutil
+import tempfile
 import nltk
-import re
-from nltk import Nonterminal, Tree
+import argparse
+import heapq
+import numpy
+from multiprocessing import Pool
+from nltk import Tree
 from unittest import TestCase
+from compiled_grammar import CompiledGrammar
 from math import log
 
 
@@ -13,15 +20,36 @@ class PCKY:
     This class parses a given sentence according the the given CNF grammar using a probabilistic CKY algorithm
     """
 
-    def __init__(self, cnf_grammar):
+    def __init__(self, cnf_grammar, beam_width=None, threshold=None):
         """
         Initialize the class by loading the grammar
-        :param cnf_grammar: the given CNF grammar
+        :param cnf_grammar: the given CNF grammar, either an NLTK grammar or a CompiledGrammar
+        :param beam_width: if given, the number of best nonterminals to keep in each cell of the chart
+        :param threshold: if given, drop nonterminals whose log probability is more than this below the best in the cell
         """
+        if not isinstance(cnf_grammar, CompiledGrammar):
+            cnf_grammar = CompiledGrammar.from_pcfg(cnf_grammar)
         self.grammar = cnf_grammar
+        self.index_grammar()
         self.matrix = []
         self.i = self.k = self.j = 0
 
+        self.beam_width = beam_width
+        self.threshold = threshold
+
+        # running totals of the cells that lost entries to pruning and the entries they lost
+        self.pruned_cells = 0
+        self.pruned_edges = 0
+
+    def index_grammar(self):
+        """
+        Index the lexical rules by word and the binary rules by their pair of children
+        :return: void
+        """
+        self.lexical_rules = self.grammar.lexical_index()
+        self.binary_rules = self.grammar.binary_index()
+        self.unary_rules = self.grammar.unary_index()
+
     def setup(self, length):
         """
         Set up the matrix and indices for a new parse
@@ -43,33 +71,70 @@ class PCKY:
         self.i = self.j - 1
         self.matrix[self.i][self.j] = {}
 
-        possible_tags = self.grammar.productions(rhs=words[self.j - 1])
+        possible_tags = self.lexical_rules.get(words[self.j - 1])
 
         if not possible_tags:
-            possible_tags = self.grammar.productions(rhs="UNK")
+            possible_tags = self.lexical_rules.get("UNK", [])
 
-        for rule in sorted(possible_tags, key=lambda x: x.prob()):
-            lhs = rule.lhs().symbol()
-            self.matrix[self.i][self.j][lhs] = (log(rule.prob()), Tree(lhs, [words[self.j - 1]]))
+        for lhs, prob in possible_tags:
+            self.matrix[self.i][self.j][lhs] = (prob, Tree(lhs, [words[self.j - 1]]))
 
     def compose_children(self):
         """
         Combine all valid left and right children for the current location in the matrix
         :return:
         """
+        cell = self.matrix[self.i][self.j]
         for l_symbol, l_info in self.matrix[self.i][self.k].items():
-            l_rhs = Nonterminal(l_symbol)
             for r_symbol, r_info in self.matrix[self.k][self.j].items():
-                r_rhs = Nonterminal(r_symbol)
 
                 # check the subtrees in [i][k] and [k][j] to see if you can make a valid rhs
-                potential_rules = [p for p in self.grammar.productions(rhs=l_rhs) if p.rhs()[1] == r_rhs]
-                for potential_rule in sorted(potential_rules, key=lambda x: x.prob()):
-                    new_lhs = potential_rule.lhs().symbol()
-                    new_tree = Tree(new_lhs, [l_info[1], r_info[1]])
-                    new_prob = log(potential_rule.prob()) + l_info[0] + r_info[0]
-                    if new_lhs not in self.matrix[self.i][self.j] or new_prob > self.matrix[self.i][self.j][new_lhs][0]:
-                            self.matrix[self.i][self.j][new_lhs] = (new_prob, new_tree)
+                potential_rules = self.binary_rules.get((l_symbol, r_symbol))
+                if not potential_rules:
+                    continue
+                for new_lhs, rule_prob in potential_rules:
+                    new_prob = rule_prob + l_info[0] + r_info[0]
+                    if new_lhs not in cell or new_prob > cell[new_lhs][0]:
+                        cell[new_lhs] = (new_prob, Tree(new_lhs, [l_info[1], r_info[1]]))
+
+    def apply_unary_closure(self):
+        """
+        Add every nonterminal that can reach one already in the current cell through a chain of unary rules, if that
+        makes it more probable
+        :return: void
+        """
+        cell = self.matrix[self.i][self.j]
+
+        for child, child_info in list(cell.items()):
+            for new_lhs, chain_prob, chain in self.unary_rules.get(child, []):
+                new_prob = chain_prob + child_info[0]
+                if new_lhs not in cell or new_prob > cell[new_lhs][0]:
+                    new_tree = child_info[1]
+                    for symbol in reversed(chain[:-1]):
+                        new_tree = Tree(symbol, [new_tree])
+                    cell[new_lhs] = (new_prob, new_tree)
+
+    def prune_cell(self):
+        """
+        Drop the nonterminals that fall outside the beam width or the threshold from the current cell of the matrix
+        :return: void
+        """
+        cell = self.matrix[self.i][self.j]
+        if not cell or (self.beam_width is None and self.threshold is None):
+            return
+
+        ranked = sorted(cell, key=lambda x: -cell[x][0])
+        best_prob = cell[ranked[0]][0]
+        if self.beam_width is not None:
+            ranked = ranked[:self.beam_width]
+        if self.threshold is not None:
+            ranked = [symbol for symbol in ranked if cell[symbol][0] >= best_prob - self.threshold]
+
+        if len(ranked) < len(cell):
+            self.pruned_cells += 1
+            self.pruned_edges += len(cell) - len(ranked)
+            kept = set(ranked)
+            self.matrix[self.i][self.j] = {symbol: info for symbol, info in cell.items() if symbol in kept}
 
     def parse(self, sentence):
         """
@@ -83,6 +148,8 @@ class PCKY:
         while self.j < len(words):
             # we start each column at the bottom by tagging the POS of the word
             self.tag_word(words)
+            self.apply_unary_closure()
+            self.prune_cell()
             while self.i > 0:
                 # move up the column row by row
                 self.i -= 1
@@ -93,14 +160,423 @@ class PCKY:
                     # for each value between i and j, look for potential child trees to connect
                     self.compose_children()
                     self.k += 1
+                self.apply_unary_closure()
+                self.prune_cell()
 
         for root in self.matrix[0][len(words)]:
-            if root == self.grammar.start().symbol():
-                best_parse = self.matrix[0][len(words)][root][1].pformat(margin=100000000000000)
-                return re.sub("\^[^\s]*", "", best_parse)
+            if root == self.grammar.start:
+                return self.tree_to_string(self.matrix[0][len(words)][root][1])
 
         return ""
 
+    @staticmethod
+    def tree_to_string(tree):
+        """
+        Print the given tree on one line, stripping any parent annotations from the labels and replacing the intermediate
+        symbols made by Markovized binarization, like NP<PP>, with their children
+        :param tree: the parse tree
+        :return: the string representation of the tree
+        """
+        tree = tree.copy(deep=True)
+        tree.un_chomsky_normal_form(expandUnary=False, childChar="<", parentChar="^")
+        return tree.pformat(margin=100000000000000)
+
+
+class ArrayPCKY(PCKY):
+    """
+    This class parses a given sentence like PCKY, but maps nonterminals to integer ids and keeps the chart in dense numpy
+    arrays of scores and backpointers, building the parse tree only once the chart is full
+    """
+
+    def __init__(self, cnf_grammar, beam_width=None, threshold=None):
+        """
+        Initialize the class by loading the grammar and encoding its rules as arrays of symbol ids
+        :param cnf_grammar: the given CNF grammar, either an NLTK grammar or a CompiledGrammar
+        :param beam_width: if given, the number of best nonterminals to keep in each cell of the chart
+        :param threshold: if given, drop nonterminals whose log probability is more than this below the best in the cell
+        """
+        self.scores = self.base_scores = self.splits = self.rules = self.unary_chains = None
+        super().__init__(cnf_grammar, beam_width, threshold)
+
+    def index_grammar(self):
+        """
+        Use the compiled grammar's arrays of symbol ids directly, and index the lexical rules by word
+        :return: void
+        """
+        self.symbols = self.grammar.symbols
+        self.symbol_ids = {symbol: index for index, symbol in enumerate(self.symbols)}
+
+        self.rule_lhs = self.grammar.rule_lhs
+        self.rule_left = self.grammar.rule_left
+        self.rule_right = self.grammar.rule_right
+        self.rule_prob = self.grammar.rule_prob
+
+        self.unary_lhs = self.grammar.unary_lhs
+        self.unary_child = self.grammar.unary_child
+        self.unary_next = self.grammar.unary_next
+        self.unary_prob = self.grammar.unary_prob
+        self.unary_chain_ids = {(lhs, child): index for index, (lhs, child) in
+                                enumerate(zip(self.unary_lhs.tolist(), self.unary_child.tolist()))}
+
+        offsets = self.grammar.lexical_offsets.tolist()
+        self.lexical_ids = {word: (self.grammar.lexical_lhs[offsets[index]:offsets[index + 1]],
+                                   self.grammar.lexical_prob[offsets[index]:offsets[index + 1]])
+                            for index, word in enumerate(self.grammar.words)}
+
+    def setup(self, length):
+        """
+        Set up the score and backpointer arrays for a new parse
+        :param length: the length of the sentence to parse
+        :return: void
+        """
+        shape = (length, length, len(self.symbols))
+        self.scores = numpy.full(shape, -numpy.inf)
+        self.base_scores = numpy.full(shape, -numpy.inf)
+        self.splits = numpy.zeros(shape, dtype=numpy.int32)
+        self.rules = numpy.full(shape, -1, dtype=numpy.int32)
+        self.unary_chains = numpy.full(shape, -1, dtype=numpy.int32)
+        self.i = self.k = self.j = 0
+
+    def tag_word(self, words):
+        """
+        Add the scores of the POS tags for each word at the edge of the chart
+        :param words: the list of words to parse
+        :return: void
+        """
+        self.j += 1
+        self.i = self.j - 1
+
+        tags = self.lexical_ids.get(words[self.j - 1])
+
+        if tags is None:
+            tags = self.lexical_ids.get("UNK")
+
+        if tags is not None:
+            self.scores[self.i, self.j, tags[0]] = tags[1]
+
+    def compose_children(self):
+        """
+        Combine the best left and right children over every split point for the current span, keeping the best rule and
+        split for each lhs as backpointers
+        :return: void
+        """
+        # rows are the split points k, columns are the binary rules
+        candidates = (self.scores[self.i, self.i + 1:self.j][:, self.rule_left] +
+                      self.scores[self.i + 1:self.j, self.j][:, self.rule_right] + self.rule_prob)
+        best_splits = candidates.argmax(axis=0)
+        rule_scores = candidates[best_splits, numpy.arange(len(self.rule_prob))]
+
+        valid = rule_scores > -numpy.inf
+        if not valid.any():
+            return
+
+        cell = self.scores[self.i, self.j]
+        numpy.maximum.at(cell, self.rule_lhs[valid], rule_scores[valid])
+
+        winners = numpy.flatnonzero(valid & (rule_scores == cell[self.rule_lhs]))
+        self.rules[self.i, self.j, self.rule_lhs[winners]] = winners
+        self.splits[self.i, self.j, self.rule_lhs[winners]] = self.i + 1 + best_splits[winners]
+
+    def apply_unary_closure(self):
+        """
+        Add every nonterminal that can reach one already in the current cell through a chain of unary rules, if that
+        makes it more probable, keeping the chain used as a separate backpointer
+        :return: void
+        """
+        cell = self.scores[self.i, self.j]
+        # keep the scores from lexical and binary rules alone for k-best extraction
+        self.base_scores[self.i, self.j] = cell
+
+        if not len(self.unary_prob):
+            return
+
+        chain_scores = cell[self.unary_child] + self.unary_prob
+
+        improved = chain_scores > cell[self.unary_lhs]
+        if not improved.any():
+            return
+
+        numpy.maximum.at(cell, self.unary_lhs[improved], chain_scores[improved])
+
+        winners = numpy.flatnonzero(improved & (chain_scores == cell[self.unary_lhs]))
+        self.unary_chains[self.i, self.j, self.unary_lhs[winners]] = winners
+
+    def prune_cell(self):
+        """
+        Drop the nonterminals that fall outside the beam width or the threshold from the current cell of the chart
+        :return: void
+        """
+        cell = self.scores[self.i, self.j]
+        if self.beam_width is None and self.threshold is None:
+            return
+
+        found = numpy.count_nonzero(cell > -numpy.inf)
+        if not found:
+            return
+
+        if self.beam_width is not None and found > self.beam_width:
+            cell[numpy.argsort(-cell, kind="stable")[self.beam_width:]] = -numpy.inf
+        if self.threshold is not None:
+            cell[cell < cell.max() - self.threshold] = -numpy.inf
+
+        kept = numpy.count_nonzero(cell > -numpy.inf)
+        if kept < found:
+            self.pruned_cells += 1
+            self.pruned_edges += found - kept
+
+            # drop the pruned nonterminals from the k-best derivations too, except the bottoms of the kept unary chains
+            pruned = cell == -numpy.inf
+            chains = self.unary_chains[self.i, self.j][~pruned]
+            pruned[self.unary_child[chains[chains >= 0]]] = False
+            self.base_scores[self.i, self.j][pruned] = -numpy.inf
+
+    def fill_chart(self, words):
+        """
+        Fill the chart for the given words using the CKY algorithm
+        :param words: the list of words to parse
+        :return: the id of the start symbol if the words parse, otherwise None
+        """
+        self.setup(len(words)+1)
+
+        while self.j < len(words):
+            self.tag_word(words)
+            self.apply_unary_closure()
+            self.prune_cell()
+            # fill the column from the bottom up, considering every split point of each span at once
+            for self.i in range(self.j - 2, -1, -1):
+                self.compose_children()
+                self.apply_unary_closure()
+                self.prune_cell()
+
+        start = self.symbol_ids.get(self.grammar.start)
+        if start is None or not words or self.scores[0, len(words), start] == -numpy.inf:
+            return None
+        return start
+
+    def parse(self, sentence):
+        """
+        Parse the given sentence using the CKY algorithm
+        :param sentence: the sentence to parse as a string
+        :return: the best parse tree as a string, or an empty string if the sentence does not parse
+        """
+        words = nltk.word_tokenize(sentence)
+        start = self.fill_chart(words)
+        if start is None:
+            return ""
+
+        return self.tree_to_string(self.build_tree(words, 0, len(words), start))
+
+    def parse_k_best(self, sentence, k):
+        """
+        Parse the given sentence and lazily extract the k most probable parses from the chart, only finding the next best
+        derivations of the items those parses are built from
+        :param sentence: the sentence to parse as a string
+        :param k: the number of parses to return
+        :return: generator of (log prob, parse tree as a string) in order of decreasing probability
+        """
+        words = nltk.word_tokenize(sentence)
+        start = self.fill_chart(words)
+        if start is None:
+            return
+
+        extractor = KBestExtractor(self, words)
+        root = (0, len(words), start, False)
+        for rank in range(k):
+            derivation = extractor.kth_best(root, rank)
+            if derivation is None:
+                return
+            yield derivation[0], self.tree_to_string(extractor.build_tree(root, rank))
+
+    def unary_chain_tree(self, chain, tree):
+        """
+        Wrap the given tree for the bottom of a unary chain in the symbols of the rest of the chain
+        :param chain: the index of the unary chain
+        :param tree: the tree for the child at the bottom of the chain
+        :return: the tree for the lhs at the top of the chain
+        """
+        child = int(self.unary_child[chain])
+        symbols = [int(self.unary_lhs[chain])]
+        while symbols[-1] != child:
+            symbols.append(int(self.unary_next[self.unary_chain_ids[(symbols[-1], child)]]))
+        for chain_symbol in reversed(symbols[:-1]):
+            tree = Tree(self.symbols[chain_symbol], [tree])
+        return tree
+
+    def build_tree(self, words, i, j, symbol, follow_unary=True):
+        """
+        Rebuild the best tree for the given span and symbol by following the backpointers
+        :param words: the list of parsed words
+        :param i: the start of the span
+        :param j: the end of the span
+        :param symbol: the id of the symbol at the root of the span
+        :param follow_unary: whether to follow a unary chain into the span, or only the lexical or binary backpointer
+        :return: the best parse tree for the span
+        """
+        chain = self.unary_chains[i, j, symbol]
+        if follow_unary and chain >= 0:
+            # the chain was built on the child's own lexical or binary derivation in this span
+            return self.unary_chain_tree(chain, self.build_tree(words, i, j, self.unary_child[chain], False))
+
+        rule = self.rules[i, j, symbol]
+        if rule < 0:
+            return Tree(self.symbols[symbol], [words[i]])
+
+        k = self.splits[i, j, symbol]
+        return Tree(self.symbols[symbol], [self.build_tree(words, i, k, self.rule_left[rule]),
+                                           self.build_tree(words, k, j, self.rule_right[rule])])
+
+
+class KBestExtractor:
+    """
+    This class lazily finds the k best derivations of items in a filled ArrayPCKY chart, following algorithm 3 of Huang
+    and Chiang (2005), "Better k-best parsing"
+
+    An item is (i, j, symbol, base), where a base item is derived by a lexical or binary rule and a full item is derived
+    from a base item in the same span by at most one unary chain, so there are no cycles. A derivation is a tuple of
+    (log prob, edge, ranks), where ranks are the ranks of the derivations used for each of the edge's tail items
+    """
+
+    def __init__(self, parser, words):
+        """
+        Initialize the class with the parser whose chart has been filled
+        :param parser: the ArrayPCKY parser
+        :param words: the list of parsed words
+        """
+        self.parser = parser
+        self.words = words
+
+        # the derivations of each item found so far, best first, and the heap of candidates for the next one
+        self.derivations = {}
+        self.candidates = {}
+        self.pushed = {}
+
+        # the number of candidates pushed, to break ties between equally probable candidates in the heaps
+        self.counter = 0
+
+    def edges(self, item):
+        """
+        Find the incoming edges of the given item, along with the log prob of their best derivation
+        :param item: the item
+        :return: list of (log prob, edge, tail items) where edge is ("lexical",), ("base",), ("unary", chain) or
+        ("binary", rule, split)
+        """
+        i, j, symbol, base = item
+        parser = self.parser
+
+        if not base:
+            edges = []
+            if parser.base_scores[i, j, symbol] > -numpy.inf:
+                edges.append((parser.base_scores[i, j, symbol], ("base",), [(i, j, symbol, True)]))
+            for chain in numpy.flatnonzero(parser.unary_lhs == symbol):
+                child = parser.unary_child[chain]
+                if parser.base_scores[i, j, child] > -numpy.inf:
+                    edges.append((parser.unary_prob[chain] + parser.base_scores[i, j, child], ("unary", chain),
+                                  [(i, j, child, True)]))
+            return edges
+
+        if j == i + 1:
+            return [(parser.base_scores[i, j, symbol], ("lexical",), [])]
+
+        # rows are the split points k, columns are the binary rules for this symbol
+        rules = numpy.flatnonzero(parser.rule_lhs == symbol)
+        candidates = (parser.scores[i, i + 1:j][:, parser.rule_left[rules]] +
+                      parser.scores[i + 1:j, j][:, parser.rule_right[rules]] + parser.rule_prob[rules])
+        edges = []
+        for split, column in zip(*numpy.nonzero(candidates > -numpy.inf)):
+            rule, k = rules[column], i + 1 + split
+            edges.append((candidates[split, column], ("binary", rule, k),
+                          [(i, k, parser.rule_left[rule], False), (k, j, parser.rule_right[rule], False)]))
+        return edges
+
+    def push(self, item, edge, tails, ranks):
+        """
+        Push a candidate derivation of the item onto its heap, if its tail derivations exist and it hasn't been pushed
+        :param item: the item
+        :param edge: the edge of the candidate
+        :param tails: the tail items of the edge
+        :param ranks: the rank of the derivation to use for each tail item
+        :return: void
+        """
+        if (edge, ranks) in self.pushed[item]:
+            return
+
+        prob = self.edge_prob(item, edge)
+        for tail, rank in zip(tails, ranks):
+            derivation = self.kth_best(tail, rank)
+            if derivation is None:
+                return
+            prob += derivation[0]
+
+        self.pushed[item].add((edge, ranks))
+        self.counter += 1
+        heapq.heappush(self.candidates[item], (-prob, self.counter, edge, tails, ranks))
+
+    def edge_prob(self, item, edge):
+        """
+        Get the log prob of the given edge itself, not counting its tails
+        :param item: the item the edge leads to
+        :param edge: the edge
+        :return: the log prob of the edge
+        """
+        if edge[0] == "unary":
+            return float(self.parser.unary_prob[edge[1]])
+        if edge[0] == "binary":
+            return float(self.parser.rule_prob[edge[1]])
+        if edge[0] == "lexical":
+            i, j, symbol, _ = item
+            return float(self.parser.base_scores[i, j, symbol])
+        return 0.0
+
+    def kth_best(self, item, k):
+        """
+        Find the kth best derivation of the given item, finding the ones before it first if they haven't been found yet
+        :param item: the item
+        :param k: the rank of the derivation, from 0
+        :return: the derivation as (log prob, edge, tails, ranks), or None if the item has no more than k derivations
+        """
+        if item not in self.derivations:
+            self.derivations[item] = []
+            self.pushed[item] = set()
+            # the best derivation of each incoming edge uses the best derivation of each of its tails
+            self.candidates[item] = []
+            for prob, edge, tails in self.edges(item):
+                self.pushed[item].add((edge, (0,) * len(tails)))
+                self.counter += 1
+                self.candidates[item].append((-float(prob), self.counter, edge, tails, (0,) * len(tails)))
+            heapq.heapify(self.candidates[item])
+
+        derivations = self.derivations[item]
+        while len(derivations) <= k:
+            if derivations:
+                # only now find the successors of the last derivation, each using the next best derivation of one tail
+                _, edge, tails, ranks = derivations[-1]
+                for index in range(len(tails)):
+                    self.push(item, edge, tails, ranks[:index] + (ranks[index] + 1,) + ranks[index + 1:])
+            if not self.candidates[item]:
+                return None
+            prob, _, edge, tails, ranks = heapq.heappop(self.candidates[item])
+            derivations.append((-prob, edge, tails, ranks))
+
+        return derivations[k]
+
+    def build_tree(self, item, k):
+        """
+        Build the tree for the kth best derivation of the given item
+        :param item: the item
+        :param k: the rank of the derivation
+        :return: the parse tree
+        """
+        i, j, symbol, _ = item
+        _, edge, tails, ranks = self.kth_best(item, k)
+
+        if edge[0] == "lexical":
+            return Tree(self.parser.symbols[symbol], [self.words[i]])
+        if edge[0] == "base":
+            return self.build_tree(tails[0], ranks[0])
+        if edge[0] == "unary":
+            return self.parser.unary_chain_tree(edge[1], self.build_tree(tails[0], ranks[0]))
+        return Tree(self.parser.symbols[symbol], [self.build_tree(tails[0], ranks[0]), self.build_tree(tails[1], ranks[1])])
+
 
 class TestPCKY(TestCase):
     """
@@ -128,6 +604,16 @@ class TestPCKY(TestCase):
             output = parser.parse(sentence)
             self.assertEquals(expected.strip("\n"), output)
 
+    def test_tree_to_string(self):
+        """
+        Test annotations and Markovized intermediate symbols are removed from parses
+        :return: void
+        """
+        tree = Tree.fromstring("(S (NP^S John) (S<VP-PP> (VP^S sleeps) (S<PP> (PP^S (P^PP on) (NP^PP Sunday)) (ADV^S "
+                               "soundly))))")
+        self.assertEqual("(S (NP John) (VP sleeps) (PP (P on) (NP Sunday)) (ADV soundly))", PCKY.tree_to_string(tree))
+        self.assertEqual("NP^S", tree[0].label())
+
     def test_unk(self):
         """
         Test unknown words
@@ -147,27 +633,263 @@ class TestPCKY(TestCase):
             output = parser.parse(sentence)
             self.assertEquals(expected.strip("\n"), output)
 
+    def test_array_chart(self):
+        """
+        Test the array backed chart gives the same parses, including for unknown words
+        :return: void
+        """
+        for grammar_file, sentence_file, tree_file in [('./TestFiles/pcfg.pcfg', './TestFiles/sentences', './TestFiles/trees'),
+                                                       ('./TestFiles/unk_pcfg.pcfg', './TestFiles/unk_sentences', './TestFiles/unk_trees')]:
+            grammar = nltk.data.load(grammar_file)
+
+            with open(sentence_file, "r") as sentences:
+                test_sentences = sentences.readlines()
+
+            with open(tree_file, "r") as trees:
+                expected_trees = trees.readlines()
+
+            parser = ArrayPCKY(grammar)
+
+            for sentence, expected in zip(test_sentences, expected_trees):
+                output = parser.parse(sentence)
+                self.assertEqual(expected.strip("\n"), output)
+
+        self.assertEqual("", parser.parse("cat the"))
+
+    def test_pruning(self):
+        """
+        Test beam and threshold pruning, where the unknown word's best tags are not the ones the parse needs
+        :return: void
+        """
+        grammar = nltk.data.load('./TestFiles/unk_pcfg.pcfg')
+
+        with open('./TestFiles/unk_sentences', "r") as sentences:
+            test_sentence = sentences.readlines()[1]
+
+        with open('./TestFiles/unk_trees', "r") as trees:
+            expected = trees.readlines()[1].strip("\n")
+
+        for parser_class in [PCKY, ArrayPCKY]:
+            parser = parser_class(grammar, threshold=1.0)
+            self.assertEqual(expected, parser.parse(test_sentence))
+            self.assertEqual(0, parser.pruned_edges)
+
+            # "shark" can be a Det, N, P or V, and N is the least likely
+            parser = parser_class(grammar, threshold=0.5)
+            self.assertEqual("", parser.parse(test_sentence))
+            self.assertEqual(1, parser.pruned_cells)
+            self.assertEqual(1, parser.pruned_edges)
+
+            parser = parser_class(grammar, beam_width=2)
+            self.assertEqual("", parser.parse(test_sentence))
+            self.assertEqual(2, parser.pruned_edges)
+
+    def test_unary(self):
+        """
+        Test unary rules, including a cycle of unary rules, are parsed directly
+        :return: void
+        """
+        grammar = nltk.data.load('./TestFiles/unary_pcfg.pcfg')
+
+        with open('./TestFiles/unary_sentences', "r") as sentences:
+            test_sentences = sentences.readlines()
+
+        with open('./TestFiles/unary_trees', "r") as trees:
+            expected_trees = trees.readlines()
+
+        for parser_class in [PCKY, ArrayPCKY]:
+            parser = parser_class(grammar)
+
+            for sentence, expected in zip(test_sentences, expected_trees):
+                output = parser.parse(sentence)
+                self.assertEqual(expected.strip("\n"), output)
+
+    def test_k_best(self):
+        """
+        Test the k best parses of sentences with ambiguous prepositional phrase attachments
+        :return: void
+        """
+        grammar = nltk.data.load('./TestFiles/ambiguous_pcfg.pcfg')
+
+        with open('./TestFiles/ambiguous_sentences', "r") as sentences:
+            test_sentences = sentences.readlines()
+
+        parser = ArrayPCKY(grammar)
+
+        parses = list(parser.parse_k_best(test_sentences[0], 50))
+        self.assertEqual(2, len(parses))
+        self.assertEqual(parser.parse(test_sentences[0]), parses[0][1])
+        # the prepositional phrase attaches to the noun phrase in the best parse and to the verb phrase in the next
+        self.assertAlmostEqual(log(0.6 * 0.4 * 0.7 * 0.4 * 0.6 * 0.4 * 0.6 * 0.2), parses[0][0])
+        self.assertAlmostEqual(log(0.6 * 0.4 * 0.3 * 0.7 * 0.6 * 0.4 * 0.6 * 0.2), parses[1][0])
+        self.assertIn("(VP (VP (V saw)", parses[1][1])
+
+        parses = list(parser.parse_k_best(test_sentences[1], 50))
+        self.assertEqual(5, len(parses))
+        self.assertEqual(5, len(set(tree for _, tree in parses)))
+        self.assertEqual(sorted([prob for prob, _ in parses], reverse=True), [prob for prob, _ in parses])
+        self.assertEqual(parses[:3], list(parser.parse_k_best(test_sentences[1], 3)))
+
+        self.assertEqual([], list(parser.parse_k_best("the the", 5)))
+
+    def test_k_best_pruning(self):
+        """
+        Test the k best parses don't use nonterminals pruned from the chart
+        :return: void
+        """
+        grammar = nltk.PCFG.fromstring("""
+            S -> P B [1.0]
+            P -> A [0.9] | C [0.1]
+            A -> 'a' [1.0]
+            B -> 'b' [1.0]
+            C -> 'a' [0.01] | 'c' [0.99]
+            """)
+
+        parses = list(ArrayPCKY(grammar).parse_k_best("a b", 5))
+        self.assertEqual(2, len(parses))
+        self.assertIn("(C a)", parses[1][1])
+
+        # C is pruned from the cell for "a", leaving only the parse through A
+        for parser in [ArrayPCKY(grammar, threshold=1.0), ArrayPCKY(grammar, beam_width=2)]:
+            parses = list(parser.parse_k_best("a b", 5))
+            self.assertEqual(1, parser.pruned_edges)
+            self.assertEqual([parser.parse("a b")], [tree for _, tree in parses])
+            self.assertAlmostEqual(log(0.9), parses[0][0])
+
+    def test_parse_batch(self):
+        """
+        Test parsing across worker processes keeps the sentences in order
+        :return: void
+        """
+        with open('./TestFiles/sentences', "r") as sentences:
+            test_sentences = sentences.readlines()
+
+        with open('./TestFiles/trees', "r") as trees:
+            expected_trees = [tree.strip("\n") for tree in trees.readlines()]
+
+        with tempfile.TemporaryDirectory() as directory:
+            grammar_file = os.path.join(directory, "pcfg.pcfg")
+            shutil.copy('./TestFiles/pcfg.pcfg', grammar_file)
+
+            results = parse_batch(grammar_file, test_sentences * 3, 2)
+            self.assertEqual(expected_trees[:len(test_sentences)] * 3, [tree for tree, _, _ in results])
+
+
+def parse_output(parser, sentence, k_best=None):
+    """
+    Parse a sentence and format the output for it
+    :param parser: the parser
+    :param sentence: the sentence to parse
+    :param k_best: if given, the number of best parses to output, which needs an ArrayPCKY parser
+    :return: the best parse, or a line with the log prob and tree of each of the k best parses followed by a blank line
+    """
+    if not k_best:
+        return parser.parse(sentence)
+
+    lines = ["{0} {1}".format(prob, tree) for prob, tree in parser.parse_k_best(sentence, k_best)]
+    return "\n".join(lines + [""])
+
+
+# the parser loaded by each worker process in batch mode, and the number of best parses it should output
+worker_parser = None
+worker_k_best = None
+
+
+def init_worker(grammar_file, parser_class, beam_width, threshold, k_best):
+    """
+    Load the grammar once in a worker process
+    :param grammar_file: the PCFG grammar file
+    :param parser_class: the parser class to use, PCKY or ArrayPCKY
+    :param beam_width: the beam width for pruning, if any
+    :param threshold: the threshold for pruning, if any
+    :param k_best: the number of best parses to output, if more than one
+    :return: void
+    """
+    global worker_parser, worker_k_best
+    worker_parser = parser_class(CompiledGrammar.load(grammar_file), beam_width, threshold)
+    worker_k_best = k_best
+
+
+def parse_in_worker(sentence):
+    """
+    Parse a sentence with this worker process's parser
+    :param sentence: the sentence to parse
+    :return: a tuple of the output for the sentence, and the number of edges and cells pruned while parsing it
+    """
+    pruned_edges, pruned_cells = worker_parser.pruned_edges, worker_parser.pruned_cells
+    output = parse_output(worker_parser, sentence, worker_k_best)
+    return output, worker_parser.pruned_edges - pruned_edges, worker_parser.pruned_cells - pruned_cells
+
+
+def parse_batch(grammar_file, sentences, workers, parser_class=PCKY, beam_width=None, threshold=None, k_best=None):
+    """
+    Parse the sentences in chunks across a pool of worker processes, each memory-mapping the compiled grammar
+    :param grammar_file: the PCFG grammar file
+    :param sentences: the sentences to parse
+    :param workers: the number of worker processes
+    :param parser_class: the parser class to use, PCKY or ArrayPCKY
+    :param beam_width: the beam width for pruning, if any
+    :param threshold: the threshold for pruning, if any
+    :param k_best: the number of best parses to output for each sentence, if more than one
+    :return: generator of (output, pruned edges, pruned cells) in the same order as the sentences
+    """
+    chunk_size = max(1, len(sentences) // (workers * 4))
+    # compile the grammar up front if it has changed, so the workers only have to map it
+    CompiledGrammar.load(grammar_file)
+
+    with Pool(workers, init_worker, (grammar_file, parser_class, beam_width, threshold, k_best)) as pool:
+        for result in pool.imap(parse_in_worker, sentences, chunk_size):
+            yield result
+
 
 def main():
     """
     Parse the system arguments, call the PCKY class and write results to the output file
     :return:
     """
-    grammar_file = sys.argv[1]
-    cfg_grammar = nltk.data.load(grammar_file)
-
-    sentence_file = sys.argv[2]
-    sentences = open(sentence_file, "r")
+    arg_parser = argparse.ArgumentParser(description="Write the best parse of each sentence according to a PCFG")
+    arg_parser.add_argument("grammar_file", help="the induced PCFG grammar to be read")
+    arg_parser.add_argument("sentence_file", help="the file containing test sentences to be parsed")
+    arg_parser.add_argument("output_file", help="the file to which the best parse for each sentence will be written")
+    arg_parser.add_argument("--chart", choices=["tree", "array"], default="tree",
+                            help="keep a tree in each chart cell, or integer ids in numpy arrays with backpointers")
+    arg_parser.add_argument("--beam", type=int, default=None,
+                            help="the number of best nonterminals to keep in each chart cell")
+    arg_parser.add_argument("--threshold", type=float, default=None,
+                            help="drop nonterminals whose log probability is more than this below the best in their cell")
+    arg_parser.add_argument("--workers", type=int, default=1,
+                            help="the number of processes to parse with, each mapping the compiled grammar")
+    arg_parser.add_argument("--k-best", type=int, default=None,
+                            help="write the log prob and tree of this many best parses for each sentence, using the array chart")
+    args = arg_parser.parse_args()
+
+    sentences = open(args.sentence_file, "r")
     sentences = sentences.readlines()
 
-    output_file = sys.argv[3]
-    with open(output_file, "w") as f:
+    # k-best extraction follows the backpointers of the array chart
+    parser_class = ArrayPCKY if args.chart == "array" or args.k_best else PCKY
+    pruned_edges = pruned_cells = 0
+
+    with open(args.output_file, "w") as f:
+
+        if args.workers > 1:
+            results = parse_batch(args.grammar_file, sentences, args.workers, parser_class, args.beam, args.threshold,
+                                  args.k_best)
+            for output, edges, cells in results:
+                print(output, file=f)
+                pruned_edges += edges
+                pruned_cells += cells
+        else:
+            cfg_grammar = CompiledGrammar.load(args.grammar_file)
+            parser = parser_class(cfg_grammar, args.beam, args.threshold)
+
+            for sentence in sentences:
+                print(parse_output(parser, sentence, args.k_best), file=f)
 
-        parser = PCKY(cfg_grammar)
+            pruned_edges, pruned_cells = parser.pruned_edges, parser.pruned_cells
 
-        for sentence in sentences:
-            tree = parser.parse(sentence)
-            print(tree, file=f)
+    if args.beam is not None or args.threshold is not None:
+        print("pruned {0} edges from {1} cells".format(pruned_edges, pruned_cells), file=sys.stderr)
 
 
 if __name__ == "__main__":
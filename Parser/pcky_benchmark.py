@@ -0,0 +1,68 @@
+#! /usr/bin/env python3
+
+import sys
+import random
+import nltk
+from timeit import default_timer
+from pcky import PCKY, ArrayPCKY
+from compiled_grammar import CompiledGrammar
+
+
+def random_sentences(parser, length, count):
+    """
+    Build random sentences of the given length from the words in the parser's lexicon
+    :param parser: the PCKY parser
+    :param length: the number of words in each sentence
+    :param count: the number of sentences to build
+    :return: list of sentences as strings
+    """
+    words = [word for word in parser.grammar.words if word != "UNK"]
+    return [" ".join(random.choice(words) for _ in range(length)) for _ in range(count)]
+
+
+def time_parses(parser, sentences):
+    """
+    Time how long the parser takes to parse each of the given sentences
+    :param parser: the PCKY parser
+    :param sentences: the sentences to parse
+    :return: the average number of seconds per sentence
+    """
+    start = default_timer()
+    for sentence in sentences:
+        parser.parse(sentence)
+    return (default_timer() - start) / len(sentences)
+
+
+def main():
+    """
+    Parse the system arguments, time loading the grammar and each PCKY chart on random sentences of length 10, 20 and 40
+    and print the results
+    :return: void
+    """
+    grammar_file = sys.argv[1]
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    start = default_timer()
+    nltk.data.load(grammar_file)
+    print("text grammar loading: {0:.3f}s".format(default_timer() - start))
+
+    # make sure the compiled grammar is up to date before timing how long it takes to map
+    CompiledGrammar.load(grammar_file)
+    start = default_timer()
+    grammar = CompiledGrammar.load(grammar_file)
+    print("compiled grammar loading: {0:.3f}s".format(default_timer() - start))
+
+    for name, parser_class in [("tree", PCKY), ("array", ArrayPCKY)]:
+        random.seed(0)
+
+        start = default_timer()
+        parser = parser_class(grammar)
+        print("{0} chart grammar indexing: {1:.3f}s".format(name, default_timer() - start))
+
+        for length in [10, 20, 40]:
+            sentences = random_sentences(parser, length, count)
+            print("{0} chart length {1}: {2:.3f}s per sentence".format(name, length, time_parses(parser, sentences)))
+
+
+if __name__ == "__main__":
+    main()